@@ -1 +1 @@
-from .base import TimeSeriesDatabase
+from .base import TimeSeriesDatabase, FetchResult, DownsampledResult, InconsistentRead
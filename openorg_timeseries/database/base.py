@@ -1,16 +1,22 @@
 from __future__ import division
 
+import array
+import bisect
 import calendar
 import copy
 import datetime
+import itertools
 import logging
 import math
 import mmap
 import os
 import struct
+import time
 
 import pytz
 
+from . import compression, downsample, encodings
+
 try:
     isnan = math.isnan
 except AttributeError:
@@ -23,45 +29,222 @@ def _to_timestamp(dt):
 def _from_timestamp(ts):
     return pytz.utc.localize(datetime.datetime.utcfromtimestamp(ts))
 
+def _fold_summary(summary, values):
+    # Folds values into a [count, sum, minimum, maximum] summary
+    present = [value for value in values if not isnan(value)]
+    if present:
+        summary[0] += len(present)
+        summary[1] += sum(present)
+        summary[2], summary[3] = min(summary[2], min(present)), max(summary[3], max(present))
+
+def _counter_increase(previous, value):
+    if value >= previous or isnan(previous):
+        return value - previous
+    for bits in (32, 64):
+        # A counter in the top half of its range is taken to have wrapped
+        if 2 ** (bits - 1) <= previous < 2 ** bits:
+            return 2 ** bits - previous + value
+    # Otherwise it was reset to zero
+    return value
+
 logger = logging.getLogger(__name__)
 
+class InconsistentRead(IOError):
+    """
+    Raised by a read-only database that couldn't read a consistent state,
+    the database having been written to throughout.
+    """
+
+class FetchResult(object):
+    """
+    A contiguous run of samples returned by TimeSeriesDatabase.fetch.
+
+    The data are held column-wise: ``start`` is the timestamp (in seconds
+    since the epoch) of the first sample, each subsequent sample is ``step``
+    seconds later, and ``values`` is an array of floats. Iterating over the
+    result yields ``(datetime, value)`` pairs in the series' time zone, with
+    the datetimes only being constructed as they are needed.
+    """
+
+    def __init__(self, start, step, values, timezone_name='UTC'):
+        self.start, self.step, self.values = start, step, values
+        self.timezone_name = timezone_name
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        timezone = pytz.timezone(self.timezone_name)
+        timestamp, step = self.start, self.step
+        for value in self.values:
+            yield _from_timestamp(timestamp).astimezone(timezone), value
+            timestamp += step
+
+    def timestamps(self):
+        return xrange(self.start, self.start + len(self.values) * self.step, self.step)
+
+    end = property(lambda self: self.start + (len(self.values) - 1) * self.step)
+
+    def downsample(self, points, method='lttb'):
+        """
+        Returns at most points of the samples, chosen by one of the methods
+        in the downsample module, or this result if it's already small enough.
+        """
+        if len(self.values) <= points:
+            return self
+        indices = downsample.methods[method](self.values, points)
+        return DownsampledResult(self.start, self.step,
+                                 array.array('L', indices),
+                                 array.array(self.values.typecode, [self.values[i] for i in indices]),
+                                 self.timezone_name)
+
+class DownsampledResult(FetchResult):
+    """
+    A selection of the samples of a FetchResult, with ``indices`` giving the
+    position of each of ``values`` in the run they were chosen from.
+    """
+
+    def __init__(self, start, step, indices, values, timezone_name='UTC'):
+        super(DownsampledResult, self).__init__(start, step, values, timezone_name)
+        self.indices = indices
+
+    def __iter__(self):
+        timezone = pytz.timezone(self.timezone_name)
+        for timestamp, value in itertools.izip(self.timestamps(), self.values):
+            yield _from_timestamp(timestamp).astimezone(timezone), value
+
+    def timestamps(self):
+        return [self.start + index * self.step for index in self.indices]
+
+    def downsample(self, points, method='lttb'):
+        raise TypeError("Samples can only be downsampled once.")
+
+    end = property(lambda self: self.start + self.indices[-1] * self.step)
+
+
 class TimeSeriesDatabase(object):
     _series_types = dict(enumerate('period gauge counter'.split()))
     _series_types_inv = dict((v, k) for k, v in _series_types.items())
     _aggregation_types = dict(enumerate('average min max'.split()))
     _aggregation_types_inv = dict((v, k) for k, v in _aggregation_types.items())
 
-    _value_format = '<f'
-    _value_format_size = struct.calcsize(_value_format)
-
+    # Version 1 files have a header, followed by the metadata for each
+    # archive, followed by the data for each archive as float32s.
     _header_format = '<qqLL64sq'
     _header_format_size = struct.calcsize(_header_format)
 
-    # For recording the most recent timestamp
-    _last_format = '<L'
-    _last_offset = struct.calcsize(_header_format[:-1])
-
     _archive_meta_format = '<LLLLLfff'
     _archive_meta_format_size = struct.calcsize(_archive_meta_format)
 
-    def __init__(self, filename):
+    # Version 2 files start with a magic number and a version, and use 64-bit
+    # timestamps and cycle counts, and 64-bit floats for archive state.
+    # Headers and archive metadata are padded to fixed sizes, leaving room
+    # for new fields, and each archive's data starts on a page boundary.
+    _magic = '\x89TSDB\r\n\x1a'
+    _format_version = 2
+    _page_size = 4096
+
+    _v2_header_format = '<8sLLqLL64sq'
+    _v2_header_size = 256
+
+    # The reorder window, in seconds, follows the header proper. After that
+    # is a sequence number that's odd while an update is being written, so
+    # that readers in other processes can tell whether they saw a consistent
+    # state. Older files have zeros here, for no window.
+    _v2_reorder_window_format = '<L'
+    _v2_reorder_window_offset = struct.calcsize(_v2_header_format)
+    _v2_sequence_format = '<Q'
+    _v2_sequence_offset = _v2_reorder_window_offset + 8
+
+    # Archive value encoding, scale, offset, kind and block length follow the
+    # data offset and size, then the timestamp of the last reading the
+    # archive has seen (or zero to take that in the header), and then the
+    # offset of its block summaries (or zero if it has none).
+    _v2_archive_meta_format = '<LLLQLfddQQLddLLqQ'
+    _v2_archive_meta_size = 128
+
+    # Archives are either plain ring buffers of values, or compressed. A
+    # compressed archive has an uncompressed tail block, followed by slots
+    # for the blocks sealed from it, each being Gorilla-compressed behind a
+    # header of its start index, value count and payload length. Slots are
+    # only written as far as their payloads reach, leaving the rest sparse.
+    _archive_kinds = ('ring', 'compressed')
+    _default_block_length = 4096
+    _block_header_format = '<QLL'
+    _block_header_size = struct.calcsize(_block_header_format)
+
+    # Version 2 archives summarise each block of _summary_block_length values
+    # by their block index plus one (zero marking a slot never written), the
+    # number of values present, and their sum, minimum and maximum. As with
+    # compressed blocks, summaries are kept in a ring of slots, enough for
+    # every block holding one of the last count values, plus one.
+    _summary_block_length = 256
+    _summary_format = '<QL4xddd'
+    _summary_size = struct.calcsize(_summary_format)
+
+    # How many times a read-only database tries to read a consistent state
+    _max_read_attempts = 1000
+
+    def __init__(self, filename, readonly=False):
+        """
+        Opens a database. A read-only database may be read while another
+        process updates it, as it checks each fetch saw a consistent state.
+        """
         self.filename = filename
         if not os.path.exists(filename):
             raise IOError("There is no time-series database to be found at %r" % filename)
 
-        f = open(filename, 'r+b')
-        self._map = mmap.mmap(f.fileno(), 0)
+        self._readonly = readonly
+        self._file = open(filename, 'rb' if readonly else 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0,
+                              access=mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE)
+
+        if self._map[:len(self._magic)] == self._magic:
+            magic, version, series_type, start, self._interval, archive_count, timezone_name, last = self._read(self._v2_header_format, 0)
+            if version != 2:
+                raise IOError("Unsupported time-series database version %d in %r" % (version, filename))
+            self._version = version
+            self._archive_meta_format = self._v2_archive_meta_format
+            self._archive_meta_offset = self._v2_header_size
+            self._archive_meta_size = self._v2_archive_meta_size
+            self._last_format = '<q'
+            self._last_offset = struct.calcsize(self._v2_header_format[:-1])
+            self._reorder_window = self._read(self._v2_reorder_window_format, self._v2_reorder_window_offset)
+            self._sequence = self._read(self._v2_sequence_format, self._v2_sequence_offset)
+            if self._sequence % 2 and not readonly:
+                # Left odd by a writer that died mid-update, which would
+                # have readers wait for it forever.
+                self._sequence += 1
+                self._write(self._v2_sequence_format, self._sequence, self._v2_sequence_offset)
+        else:
+            series_type, start, self._interval, archive_count, timezone_name, last = self._read(self._header_format, 0)
+            self._version = 1
+            self._archive_meta_offset = self._header_format_size
+            self._archive_meta_size = self._archive_meta_format_size
+            # The most recent timestamp was only ever written as 32 bits
+            self._last_format = '<L'
+            self._last_offset = struct.calcsize(self._header_format[:-1])
+            self._reorder_window = 0
 
-        series_type, start, self._interval, archive_count, timezone_name, last = self._read(self._header_format)
         self._timezone_name = timezone_name.rstrip('\0')
         self._timezone = pytz.timezone(self._timezone_name)
         self._series_type = self._series_types[series_type]
         self._start = _from_timestamp(start)
         self._last = _from_timestamp(last)
+        self._archives = self._read_archives(archive_count, last)
 
-        self._archives = []
+        if self._version == 1:
+            pos = self._archive_meta_offset + archive_count * self._archive_meta_size
+            for archive in self._archives:
+                archive['offset'] = pos
+                archive['size'] = archive['count'] * self._encoding(archive).size
+                pos += archive['size']
+
+    def _read_archives(self, archive_count, last):
+        archives = []
         for i in range(archive_count):
-            aggregation_type, aggregation, count, cycles, position, threshold, state_a, state_b = self._read(self._archive_meta_format)
+            meta = self._read(self._archive_meta_format, self._archive_meta_offset + i * self._archive_meta_size)
+            aggregation_type, aggregation, count, cycles, position, threshold, state_a, state_b = meta[:8]
             archive = {'aggregation_type': self._aggregation_types[aggregation_type],
                        'aggregation': aggregation,
                        'count': count,
@@ -69,14 +252,41 @@ class TimeSeriesDatabase(object):
                        'position': position,
                        'threshold': threshold,
                        'state': (state_a, state_b)}
-            self._archives.append(archive)
-        pos = self._map.tell()
-        for archive in self._archives:
-            archive['offset'] = pos
-            pos += archive['count'] * self._value_format_size
+            if self._version > 1:
+                archive['offset'], archive['size'] = meta[8:10]
+                archive['encoding'] = encodings.encodings[meta[10]]
+                archive['scale'], archive['value_offset'] = meta[11:13]
+                archive['kind'] = self._archive_kinds[meta[13]]
+                archive['block_length'] = meta[14]
+                archive['last'] = meta[15] or last
+                archive['summary_offset'] = meta[16]
+            else:
+                archive.update({'encoding': 'float32', 'scale': 1, 'value_offset': 0, 'kind': 'ring', 'block_length': 0,
+                                'last': last, 'summary_offset': 0})
+            archives.append(archive)
+        return archives
+
+    @staticmethod
+    def _encoding(archive):
+        return encodings.get_encoding(archive['encoding'], archive['scale'], archive['value_offset'])
 
+    @classmethod
+    def _block_layout(cls, archive):
+        """
+        Returns the size of a compressed archive's tail, and the number and
+        size of its block slots. There are enough slots for every block
+        holding one of the last count values, plus one being overwritten.
+        """
+        size, length = cls._encoding(archive).size, archive['block_length']
+        return (cls._page_align(length * size),
+                archive['count'] // length + 2,
+                cls._page_align(cls._block_header_size + length * size))
+
+    @classmethod
+    def _summary_slots(cls, archive):
+        return archive['count'] // cls._summary_block_length + 2
 
-    def _read(self, fmt, pos=None, whence=None):
+    def _read(self, fmt, pos=None, whence=os.SEEK_SET):
         if pos is not None:
             self._map.seek(pos, whence)
         data = self._map.read(struct.calcsize(fmt))
@@ -85,7 +295,7 @@ class TimeSeriesDatabase(object):
             return result[0]
         return result
 
-    def _write(self, fmt, data, pos=None, whence=None):
+    def _write(self, fmt, data, pos=None, whence=os.SEEK_SET):
         if pos is not None:
             self._map.seek(pos, whence)
         if not isinstance(data, tuple):
@@ -93,12 +303,14 @@ class TimeSeriesDatabase(object):
         self._map.write(struct.pack(fmt, *data))
 
     @classmethod
-    def create(cls, filename, series_type, start, interval, archives, timezone_name):
+    def create(cls, filename, series_type, start, interval, archives, timezone_name, reorder_window=0,
+               version=_format_version):
         assert series_type in cls._series_types_inv
         assert isinstance(start, datetime.datetime)
         assert start.tzinfo is not None
         assert isinstance(interval, int)
         assert isinstance(archives, list)
+        assert version in (1, 2)
 
         start_timestamp = _to_timestamp(start)
         start_timestamp -= (-start_timestamp) % interval
@@ -111,168 +323,844 @@ class TimeSeriesDatabase(object):
         if len(timezone_name) > 63:
             raise ValueError("Timezone specifier too long.")
 
-        f = open(filename, 'wb')
-        f.write(struct.pack(cls._header_format,
-                            cls._series_types_inv[series_type],
-                            start_timestamp,
-                            interval,
-                            len(archives),
-                            timezone_name,
-                            start_timestamp))
+        reorder_window = reorder_window or 0
+        if not isinstance(reorder_window, (int, long)) or reorder_window < 0:
+            raise ValueError("The reorder window must be a non-negative number of seconds.")
+        if version == 1 and reorder_window:
+            raise ValueError("Version 1 databases don't have a reorder window.")
 
+        if version == 1:
+            header = struct.pack(cls._header_format,
+                                 cls._series_types_inv[series_type],
+                                 start_timestamp,
+                                 interval,
+                                 len(archives),
+                                 timezone_name,
+                                 start_timestamp)
+            pos = cls._header_format_size + len(archives) * cls._archive_meta_format_size
+        else:
+            header = struct.pack(cls._v2_header_format,
+                                 cls._magic,
+                                 version,
+                                 cls._series_types_inv[series_type],
+                                 start_timestamp,
+                                 interval,
+                                 len(archives),
+                                 timezone_name,
+                                 start_timestamp)
+            header += struct.pack(cls._v2_reorder_window_format, reorder_window)
+            header = header.ljust(cls._v2_header_size, '\0')
+            pos = cls._page_align(cls._v2_header_size + len(archives) * cls._v2_archive_meta_size)
+
+        metas = []
         for archive in archives:
             archive['threshold'] = archive.get('threshold') or 0.5
-            f.write(struct.pack(cls._archive_meta_format,
-                                cls._aggregation_types_inv[archive['aggregation_type']],
-                                archive['aggregation'],
-                                archive['count'],
-                                0,
-                                0,
-                                archive['threshold'],
-                                float('nan'),
-                                float('nan')))
-
-        pos = f.tell()
-        zeros = struct.pack(cls._value_format, float('nan')) * 1024
-        for archive in archives:
-            archive['offset'] = pos
-            pos += archive['count'] * cls._value_format_size
+            archive['encoding'] = archive.get('encoding') or 'float32'
+            archive['scale'] = archive.get('scale') or 1
+            archive['value_offset'] = archive.get('value_offset') or 0
+            archive['kind'] = archive.get('kind') or 'ring'
+            if version == 1 and archive['encoding'] != 'float32':
+                raise ValueError("Version 1 databases can only store float32 values.")
+            if archive['kind'] not in cls._archive_kinds:
+                raise ValueError("Unknown archive kind %r" % archive['kind'])
+            if version == 1 and archive['kind'] != 'ring':
+                raise ValueError("Version 1 databases can only have ring archives.")
+            encoding = cls._encoding(archive)
+            if archive['kind'] == 'compressed':
+                archive['block_length'] = archive.get('block_length') or cls._default_block_length
+                tail_size, slot_count, slot_size = cls._block_layout(archive)
+                archive['offset'], archive['size'] = pos, tail_size + slot_count * slot_size
+            else:
+                archive['block_length'] = 0
+                archive['offset'], archive['size'] = pos, archive['count'] * encoding.size
+            meta = (cls._aggregation_types_inv[archive['aggregation_type']],
+                    archive['aggregation'],
+                    archive['count'],
+                    0,
+                    0,
+                    archive['threshold'],
+                    float('nan'),
+                    float('nan'))
+            if version == 1:
+                archive['summary_offset'] = 0
+                metas.append(struct.pack(cls._archive_meta_format, *meta))
+                pos += archive['size']
+            else:
+                archive['summary_offset'] = pos + cls._page_align(archive['size'])
+                metas.append(struct.pack(cls._v2_archive_meta_format,
+                                         *meta + (archive['offset'],
+                                                  archive['size'],
+                                                  encodings.encodings.index(archive['encoding']),
+                                                  archive['scale'],
+                                                  archive['value_offset'],
+                                                  cls._archive_kinds.index(archive['kind']),
+                                                  archive['block_length'],
+                                                  start_timestamp,
+                                                  archive['summary_offset'])).ljust(cls._v2_archive_meta_size, '\0'))
+                pos = archive['summary_offset'] + cls._page_align(cls._summary_slots(archive) * cls._summary_size)
+
+        f = open(filename, 'wb')
+        f.write(header)
+        f.write(''.join(metas))
+        # Version 1 readers expect unwritten values to be NaN. Later versions
+        # only read values below each archive's high-water mark, so the file
+        # can be left sparse, with each page allocated when first written.
+        for archive in archives if version == 1 else ():
+            encoding = cls._encoding(archive)
+            zeros = encoding.encode([float('nan')] * 1024)
+            f.seek(archive['offset'])
             for i in xrange(0, archive['count'], 1024):
                 zero_count = min(archive['count'] - i, 1024)
                 if zero_count == 1024:
                     f.write(zeros)
                 else:
-                    f.write(struct.pack(cls._value_format, float('nan')) * zero_count)
+                    f.write(encoding.encode([float('nan')] * zero_count))
+        f.truncate(pos)
 
         f.close()
         return cls(filename)
 
+    @classmethod
+    def _page_align(cls, pos):
+        return -(-pos // cls._page_size) * cls._page_size
+
+    @classmethod
+    def upgrade(cls, filename):
+        """
+        Converts the database at filename to the current file format in place,
+        returning False if it was already in that format. The conversion is
+        written to a temporary file which then replaces the original, so it
+        shouldn't be performed while anything else has the database open.
+        """
+        db = cls(filename)
+        try:
+            if db._version == cls._format_version:
+                return False
+            new_filename = filename + '.upgrade'
+            archives = [dict((k, archive[k]) for k in ('aggregation_type', 'aggregation', 'count', 'threshold'))
+                        for archive in db._archives]
+            new_db = cls.create(new_filename, db._series_type, db._start, db._interval, archives, db._timezone_name)
+            try:
+                for archive, new_archive in zip(db._archives, new_db._archives):
+                    for key in ('cycles', 'position', 'state', 'last'):
+                        new_archive[key] = archive[key]
+                    new_db._map[new_archive['offset']:new_archive['offset'] + archive['size']] = \
+                        db._map[archive['offset']:archive['offset'] + archive['size']]
+                    total = archive['cycles'] * archive['count'] + archive['position']
+                    first = -(-max(total - archive['count'], 0) // cls._summary_block_length) * cls._summary_block_length
+                    new_db._summarise(new_archive, new_db._read_values(new_archive, first, total), total)
+                new_db._sync_archive_meta()
+                new_db._sync_last_timestamp(db._last)
+                new_db.flush()
+            finally:
+                new_db.close()
+            os.rename(new_filename, filename)
+        except Exception:
+            if os.path.exists(filename + '.upgrade'):
+                os.unlink(filename + '.upgrade')
+            raise
+        finally:
+            db.close()
+        return True
+
+    def reconfigure(self, archives):
+        """
+        Replaces the database's archives with those given, returning the
+        database reopened. An archive with the same aggregation type and
+        aggregation as an existing one keeps its values, up to its new count,
+        and others are computed from the finest existing archive that can
+        provide them. The new file is built alongside and renamed over the
+        original, which remains readable until then; this database is closed.
+        """
+        new_filename = self.filename + '.reconfigure'
+        try:
+            new_db = self.create(new_filename, self._series_type, self._start, self._interval,
+                                 [dict(archive) for archive in archives], self._timezone_name,
+                                 self._reorder_window)
+            try:
+                for archive in new_db._archives:
+                    values, archive['state'], total = self._archive_contents(archive)
+                    archive['last'] = _to_timestamp(self._last)
+                    new_db._insert_data(archive, values, total - len(values))
+                new_db._sync_archive_meta()
+                new_db._sync_last_timestamp(self._last)
+                new_db.flush()
+            finally:
+                new_db.close()
+            os.rename(new_filename, self.filename)
+        except Exception:
+            if os.path.exists(new_filename):
+                os.unlink(new_filename)
+            raise
+        self.close()
+        return type(self)(self.filename)
+
+    def _archive_contents(self, archive):
+        """
+        Returns the values this database holds for a new archive, with its
+        state and its total number of values, as if it had always existed.
+        """
+        step, epoch = archive['aggregation'] * self._interval, self._archive_epoch(archive)
+        total = (_to_timestamp(self._last) - epoch) // step
+        first = max(total - archive['count'], 0)
+
+        sources = [source for source in self._archives
+                   if source['aggregation_type'] == archive['aggregation_type']
+                      and step % (source['aggregation'] * self._interval) == 0]
+        if not sources:
+            previous = self._archives[0]['state'][1] if self._archives else float('nan')
+            return [], (float('nan'), float('nan') if self._series_type == 'period' else previous), total
+        for source in sources:
+            if source['aggregation'] == archive['aggregation']:
+                return list(self._read_values(source, first, total)), source['state'], total
+        source = min(sources, key=lambda source: source['aggregation'])
+
+        source_step = source['aggregation'] * self._interval
+        factor = step // source_step
+        # The index in the source of the first value in each of this archive's periods
+        offset = (epoch - self._archive_epoch(source)) // source_step
+        source_total = source['cycles'] * source['count'] + source['position']
+        values = self._roll_up(archive, self._read_values(source, offset + first * factor, offset + total * factor), factor)
+        unfinished = self._read_values(source, offset + total * factor, source_total)
+        return values, self._unfinished_state(archive, source, unfinished), total
+
+    def _unfinished_state(self, archive, source, values):
+        """
+        Returns the state of an archive's unfinished period, given the values
+        of a finer source archive finished within it, and the source's state.
+        """
+        accumulated, other = source['state']
+        ratio = source['aggregation'] / archive['aggregation']
+        if self._series_type == 'period':
+            # Period values are NaN when they had too few readings, and these
+            # count towards the archive's threshold.
+            values = [value for value in values if not isnan(value)]
+            if not values and isnan(accumulated):
+                return source['state']
+            if isnan(accumulated):
+                accumulated, other = None, 0
+            other += len(values) * source['aggregation']
+        elif any(isnan(value) for value in values) or isnan(accumulated):
+            return float('nan'), other
+
+        if archive['aggregation_type'] == 'average':
+            accumulated = (accumulated or 0) * ratio + sum(values) * ratio
+        else:
+            extreme = {'min': min, 'max': max}[archive['aggregation_type']]
+            accumulated = extreme(list(values) + ([] if accumulated is None else [accumulated]))
+        return accumulated, other
+
     def update(self, data):
         if not data:
             return
-        for archive in self._archives:
-            self._update_archive(archive, data)
-        self._sync_archive_meta()
-        self._sync_last_timestamp(data[-1][0])
-
-    def _update_archive(self, archive, data):
-        last_timestamp, state = self._last, archive['state']
-        data_to_insert = []
-        for i, (timestamp, value) in enumerate(data):
+        # Convert the batch to epoch timestamps and floats once, rather than
+        # once per reading per archive.
+        last_timestamp, timestamps, values = self._last, [], []
+        for timestamp, value in data:
             if timestamp <= last_timestamp:
                 logger.warning("Datum with timestamp '%s' ignored (should be after '%s')" % (timestamp, last_timestamp))
                 continue
-            state, new_data_to_insert = self._combine(archive, last_timestamp, state, timestamp, value)
-            data_to_insert.extend(new_data_to_insert)
+            timestamps.append(_to_timestamp(timestamp))
+            values.append(float(value))
             last_timestamp = timestamp
-        archive['state'] = state
+        if not timestamps:
+            return
+        self._ingest(timestamps, values, last_timestamp)
 
-        self._insert_data(archive, data_to_insert)
+    def update_epoch(self, timestamps, values):
+        """
+        As update, but for readings as sorted lists of epoch timestamps and
+        floats, sparing bulk loads the conversion to and from datetimes.
+        Readings are only ignored once every archive has seen them, so this
+        can replay readings whose update was interrupted.
+        """
+        skip = bisect.bisect_right(timestamps, min(archive['last'] for archive in self._archives))
+        if skip:
+            logger.warning("%d data ignored (should be after '%s')" % (skip, self._last))
+            timestamps, values = timestamps[skip:], values[skip:]
+        if not timestamps:
+            return
+        self._ingest(timestamps, values, _from_timestamp(timestamps[-1]))
 
-    def _insert_data(self, archive, data):
-        last_timestamp, state = self._last, archive['state']
+    def _ingest(self, timestamps, values, last_timestamp):
+        self._sync_sequence()
+        try:
+            for archive in self._archives:
+                skip = bisect.bisect_right(timestamps, archive['last'])
+                if skip < len(timestamps):
+                    self._update_archive(archive, timestamps[skip:], values[skip:])
+            self._sync_archive_meta()
+            self._sync_last_timestamp(last_timestamp)
+        finally:
+            self._sync_sequence()
 
-        self._map.seek(archive['offset'] + archive['position'] * self._value_format_size)
-        for datum in data:
-            self._write(self._value_format, datum)
-            archive['position'] += 1
-            if archive['position'] == archive['count']:
-                archive['position'] = 0
-                archive['cycles'] += 1
-                self._map.seek(archive['offset'])
+    def _sync_sequence(self):
+        # Called either side of writing an update, leaving the sequence number
+        # odd in between.
+        if self._version > 1:
+            self._sequence += 1
+            self._write(self._v2_sequence_format, self._sequence, self._v2_sequence_offset)
 
-    def _combine(self, archive, old_timestamp, state, timestamp, value):
-        ots, ts = old_timestamp, timestamp
-        old_timestamp, timestamp = _to_timestamp(old_timestamp), _to_timestamp(timestamp)
-        interval = self._interval * archive['aggregation']
+    def _read_consistently(self, method, *args):
+        """
+        Calls method with the metadata of a read-only database reloaded,
+        until no update was written during the call. Raises InconsistentRead
+        if there's been one every time.
+        """
+        for attempt in xrange(self._max_read_attempts):
+            sequence = self._read(self._v2_sequence_format, self._v2_sequence_offset)
+            if sequence % 2:
+                # Being updated, which takes the writer no time at all
+                time.sleep(0.001)
+                continue
+            try:
+                last = self._read(self._last_format, self._last_offset)
+                self._last = _from_timestamp(last)
+                self._archives = self._read_archives(len(self._archives), last)
+                result = method(*args)
+            except Exception:
+                # Torn reads may not make sense, so only complain about
+                # consistent ones.
+                if self._read(self._v2_sequence_format, self._v2_sequence_offset) == sequence:
+                    raise
+                continue
+            if self._read(self._v2_sequence_format, self._v2_sequence_offset) == sequence:
+                return result
+        raise InconsistentRead("Gave up reading a consistent state from %r" % self.filename)
 
-        intermediates, intermediate = [], math.ceil(old_timestamp / interval) * interval
-        while intermediate <= timestamp:
-            if intermediate > old_timestamp:
-                intermediates.append(intermediate)
-            intermediate += interval
+    def _update_archive(self, archive, timestamps, values):
+        combine = getattr(self, '_combine_%s' % self._series_type)
+        state, data_to_insert, skipped = combine(archive, archive['state'], archive['last'],
+                                                 timestamps, values, archive['count'])
+        archive['state'], archive['last'] = state, timestamps[-1]
 
-        data_to_insert = []
-        if self._series_type == 'period':
-            default_state = {'average': 0,
-                             'min': float('inf'),
-                             'max': float('-inf')}.get(archive['aggregation_type'])
-            combine_function = {'average': lambda state, value: state + value * period / self.interval / archive['aggregation'],
-                                'min': min,
-                                'max': max}.get(archive['aggregation_type'])
-            state_value, state_count = state
+        self._insert_data(archive, data_to_insert, skipped)
 
-            if isnan(state_value):
-                state_value, state_count = default_state, 0
+    def _insert_data(self, archive, data, skipped=0):
+        """
+        Writes data to the archive's ring buffer with at most two slice
+        assignments, advancing its position and cycle count. skipped is the
+        number of values that would have preceded data, but which needn't be
+        written as data will overwrite them.
+        """
+        if archive['summary_offset']:
+            self._update_summaries(archive, data, skipped)
+        if archive['kind'] == 'compressed':
+            return self._insert_compressed(archive, data, skipped)
+        encoding = self._encoding(archive)
+        count, offset, size = archive['count'], archive['offset'], encoding.size
+        total = archive['cycles'] * count + archive['position'] + skipped + len(data)
+        # Anything before the last count values would be overwritten anyway
+        data = data[-count:]
+        slot = (total - len(data)) % count
+        data = encoding.encode(data)
+        head, tail = data[:(count - slot) * size], data[(count - slot) * size:]
+        self._map[offset + slot * size:offset + slot * size + len(head)] = head
+        if tail:
+            self._map[offset:offset + len(tail)] = tail
+        archive['cycles'], archive['position'] = divmod(total, count)
 
-            state_count += 1
+    def _insert_compressed(self, archive, data, skipped=0):
+        """
+        Appends data to a compressed archive's tail block, preceded by
+        skipped NaNs, sealing each block that fills into its slot. Blocks
+        which would be entirely overwritten are never built.
+        """
+        encoding, length = self._encoding(archive), archive['block_length']
+        count, offset = archive['count'], archive['offset']
+        old_total = archive['cycles'] * count + archive['position']
+        total = old_total + skipped + len(data)
+        tail_start, new_tail_start = old_total // length * length, total // length * length
 
-            last_intermediate = old_timestamp
-            for intermediate in intermediates:
-                period = intermediate - last_intermediate
-                if archive['aggregation_type'] == 'average' and (state_value < 0 or value < 0):
-                    raise Exception
-                if state_count / archive['aggregation'] >= archive['threshold']:
-                    data_to_insert.append(combine_function(state_value, value))
-                else:
-                    data_to_insert.append(float('nan'))
-                last_intermediate, state_value, state_count = intermediate, default_state, 0
+        # Build the values from the start of the first block to be written
+        first = max(tail_start, (total - count) // length * length)
+        values = list(self._read_values(archive, first, old_total))
+        if total - len(data) < first:
+            data = data[first - total + len(data):]
+        values.extend([float('nan')] * (total - len(data) - max(first, old_total)))
+        values.extend(data)
 
-            period = timestamp - last_intermediate
-            state_value = combine_function(state_value, value)
-            state = state_value, state_count
+        for block_start in xrange(first, new_tail_start, length):
+            self._write_block(archive, encoding, block_start, values[block_start - first:block_start - first + length])
 
-        elif self._series_type == 'gauge':
-            state_value, _ = state
-            if isnan(state_value):
-                state_value = value
-            last_intermediate = old_timestamp
-            for intermediate in intermediates:
-                data_to_insert.append(state_value + (value - state_value) * (timestamp - intermediate) / (timestamp - old_timestamp))
-            state = state_value, _
-        elif self._series_type == 'counter':
-            state_value, _ = state
+        # Only the new part of the tail block needs writing
+        tail_first = max(old_total, new_tail_start)
+        tail_data = encoding.encode(values[tail_first - first:])
+        pos = offset + (tail_first - new_tail_start) * encoding.size
+        self._map[pos:pos + len(tail_data)] = tail_data
+        archive['cycles'], archive['position'] = divmod(total, count)
+
+    def _update_summaries(self, archive, data, skipped):
+        """
+        Folds data about to be inserted into the summaries of the blocks it
+        lies in, and clears the summaries of blocks that will no longer lie
+        wholly within the archive's last count values. Only blocks that do
+        are summarised, so summaries don't depend on how data was batched.
+        """
+        length, count, slots = self._summary_block_length, archive['count'], self._summary_slots(archive)
+        old_total = archive['cycles'] * count + archive['position']
+        end = old_total + skipped + len(data)
+        kept_block = -(-max(end - count, 0) // length)
+        first = max(end - len(data), kept_block * length)
+        if first < end:
+            self._summarise(archive, data[first - end:], end)
+        for block in xrange(max(-(-max(old_total - count, 0) // length), kept_block - slots), kept_block):
+            pos = archive['summary_offset'] + block % slots * self._summary_size
+            if struct.unpack('<Q', self._map[pos:pos + 8])[0] == block + 1:
+                self._map[pos:pos + self._summary_size] = '\0' * self._summary_size
+
+    def _summarise(self, archive, values, end):
+        """
+        Folds values, those with absolute indices up to end, into the
+        summaries of the blocks they lie in. Values are summarised as they'll
+        be read back, after encoding.
+        """
+        if not len(values):
+            return
+        encoding = self._encoding(archive)
+        values = encoding.decode(encoding.encode(values))
+        length, slots, size = self._summary_block_length, self._summary_slots(archive), self._summary_size
+        first = end - len(values)
+        for block in xrange(first // length, -(-end // length)):
+            pos = archive['summary_offset'] + block % slots * size
+            marker, count, total, minimum, maximum = struct.unpack(self._summary_format, self._map[pos:pos + size])
+            if marker != block + 1:
+                count, total, minimum, maximum = 0, 0.0, float('inf'), float('-inf')
+            present = [value for value in values[max(block * length, first) - first:(block + 1) * length - first]
+                       if not isnan(value)]
+            if present:
+                count, total = count + len(present), total + sum(present)
+                minimum, maximum = min(minimum, min(present)), max(maximum, max(present))
+            self._map[pos:pos + size] = struct.pack(self._summary_format, block + 1, count, total, minimum, maximum)
+
+    def _write_block(self, archive, encoding, block_start, values):
+        raw = encoding.encode(values)
+        payload = compression.compress(raw, encoding.size)
+        # Incompressible blocks are stored as they are
+        if len(payload) >= len(raw):
+            payload = raw
+        tail_size, slot_count, slot_size = self._block_layout(archive)
+        pos = archive['offset'] + tail_size + (block_start // archive['block_length']) % slot_count * slot_size
+        block = struct.pack(self._block_header_format, block_start, len(values), len(payload)) + payload
+        self._map[pos:pos + len(block)] = block
+
+    def _read_block(self, archive, encoding, block_start):
+        """
+        Returns the values in the block starting at block_start, which will
+        be fewer than the block length if some were never written, or none
+        if the block's slot now holds another.
+        """
+        tail_size, slot_count, slot_size = self._block_layout(archive)
+        pos = archive['offset'] + tail_size + (block_start // archive['block_length']) % slot_count * slot_size
+        start, count, payload_length = struct.unpack(self._block_header_format,
+                                                     self._map[pos:pos + self._block_header_size])
+        if start != block_start:
+            return array.array(encoding.decoded_typecode)
+        pos += self._block_header_size
+        payload = self._map[pos:pos + payload_length]
+        if payload_length != count * encoding.size:
+            payload = compression.decompress(payload, count, encoding.size)
+        return encoding.decode(payload)
+
+    def _combine_period(self, archive, state, old_timestamp, timestamps, values, limit=None):
+        """
+        Folds a sorted batch of period readings (as epoch timestamps and
+        floats) into an archive's state, returning the new state, the values
+        completed at each archive boundary crossed, and a count of values
+        skipped.
+
+        If limit is given, only the last limit values are returned, with
+        those before them counted as skipped rather than built. This keeps
+        the cost of long gaps proportional to the size of the archive rather
+        than to the length of the gap.
+        """
+        step = self._interval * archive['aggregation']
+        interval, aggregation, threshold = self._interval, archive['aggregation'], archive['threshold']
+        aggregation_type = archive['aggregation_type']
+        default = {'average': 0,
+                   'min': float('inf'),
+                   'max': float('-inf')}[aggregation_type]
+        average = aggregation_type == 'average'
+        combine = {'min': min, 'max': max}.get(aggregation_type)
+        nan = float('nan')
+
+        state_value, state_count = state
+        data_to_insert, skipped = [], 0
+        for timestamp, value in itertools.izip(timestamps, values):
             if isnan(state_value):
-                state_value = value
+                state_value, state_count = default, 0
+            state_count += 1
+
+            boundaries = timestamp // step - old_timestamp // step
+            if boundaries:
+                if average and (state_value < 0 or value < 0):
+                    raise ValueError("Negative values cannot be averaged in a period series")
+                last_boundary = (old_timestamp // step + 1) * step
+                if state_count / aggregation < threshold:
+                    data_to_insert.append(nan)
+                elif average:
+                    data_to_insert.append(state_value + value * (last_boundary - old_timestamp) / interval / aggregation)
+                else:
+                    data_to_insert.append(combine(state_value, value))
+                if boundaries > 1:
+                    # Boundaries with no readings of their own
+                    if 0 < threshold:
+                        fill = nan
+                    elif average:
+                        fill = default + value * step / interval / aggregation
+                    else:
+                        fill = combine(default, value)
+                    gap = boundaries - 1
+                    if limit is not None and gap >= limit:
+                        # The gap wraps the whole ring, so just fill it
+                        skipped += len(data_to_insert) + gap - limit
+                        data_to_insert = [fill] * limit
+                    else:
+                        data_to_insert.extend([fill] * gap)
+                if limit is not None and len(data_to_insert) > 2 * limit:
+                    skipped += len(data_to_insert) - limit
+                    del data_to_insert[:-limit]
+                old_timestamp = timestamp // step * step
+                state_value, state_count = default, 0
+
+            if average:
+                state_value = state_value + value * (timestamp - old_timestamp) / interval / aggregation
             else:
-                for intermediate in intermediates:
-                    data_to_insert.append()
-            state = state_value, _
+                state_value = combine(state_value, value)
+            old_timestamp = timestamp
+
+        return (state_value, state_count), data_to_insert, skipped
 
+    def _combine(self, archive, old_timestamp, state, timestamp, value):
+        combine = getattr(self, '_combine_%s' % self._series_type)
+        state, data_to_insert, skipped = combine(archive, state, _to_timestamp(old_timestamp),
+                                                 [_to_timestamp(timestamp)], [float(value)])
         return state, data_to_insert
 
+    def _combine_gauge(self, archive, state, old_timestamp, timestamps, values, limit=None):
+        """
+        Gauge readings are instantaneous values, between which we interpolate
+        linearly. The archive state holds the aggregate of the current archive
+        period so far, and the most recent reading.
+        """
+        accumulated, previous = state
+        accumulated, data_to_insert, skipped = self._combine_segments(archive, accumulated, old_timestamp, timestamps,
+                                                                      [previous] + values[:-1], values, limit)
+        return (accumulated, values[-1]), data_to_insert, skipped
+
+    def _combine_counter(self, archive, state, old_timestamp, timestamps, values, limit=None):
+        """
+        Counter readings are cumulative, and are stored as the increase per
+        interval, which we take to be constant between readings. Counters that
+        go backwards are assumed to have been reset or to have wrapped around.
+        The archive state holds the aggregate of the current archive period so
+        far, and the most recent counter value.
+        """
+        accumulated, previous = state
+        interval, last_timestamp, segment_timestamps, rates = self._interval, old_timestamp, [], []
+        for timestamp, value in itertools.izip(timestamps, values):
+            if timestamp == last_timestamp:
+                # No time has passed, so leave the increase to the next reading
+                continue
+            rates.append(_counter_increase(previous, value) * interval / (timestamp - last_timestamp))
+            segment_timestamps.append(timestamp)
+            last_timestamp, previous = timestamp, value
+        accumulated, data_to_insert, skipped = self._combine_segments(archive, accumulated, old_timestamp,
+                                                                      segment_timestamps, rates, rates, limit)
+        return (accumulated, previous), data_to_insert, skipped
+
+    def _combine_segments(self, archive, accumulated, old_timestamp, timestamps, starts, ends, limit=None):
+        """
+        Aggregates a piecewise-linear function into archive periods. The nth
+        segment runs from the previous timestamp (or old_timestamp) to
+        timestamps[n], going from starts[n] to ends[n]; a NaN start means the
+        function is unknown before that timestamp. Returns the aggregate of
+        the unfinished archive period, the values for the periods finished,
+        and a count of values skipped as for _combine_period.
+
+        Periods the function doesn't fully cover are NaN, and the archive's
+        threshold doesn't apply.
+        """
+        step = self._interval * archive['aggregation']
+        aggregation_type = archive['aggregation_type']
+        nan = float('nan')
+        if aggregation_type == 'average':
+            identity = 0
+            def fold(accumulated, x, y, fx, fy):
+                return accumulated + (y - x) * (fx + fy) / 2 / step if y > x else accumulated
+            def whole(fx, fy):
+                return (fx + fy) / 2
+        else:
+            identity, extreme = {'min': (float('inf'), min), 'max': (float('-inf'), max)}[aggregation_type]
+            def whole(fx, fy):
+                return nan if isnan(fx) or isnan(fy) else extreme(fx, fy)
+            def fold(accumulated, x, y, fx, fy):
+                if y <= x:
+                    return accumulated
+                value = whole(fx, fy)
+                return nan if isnan(accumulated) or isnan(value) else extreme(accumulated, value)
+
+        data_to_insert, skipped = [], 0
+        for timestamp, start, end in itertools.izip(timestamps, starts, ends):
+            duration = timestamp - old_timestamp
+            slope = (end - start) / duration if duration else 0
+
+            boundaries = timestamp // step - old_timestamp // step
+            if not boundaries:
+                accumulated = fold(accumulated, old_timestamp, timestamp, start, end)
+            else:
+                first = (old_timestamp // step + 1) * step
+                at_first = end if first == timestamp else start + slope * (first - old_timestamp)
+                data_to_insert.append(fold(accumulated, old_timestamp, first, start, at_first))
+
+                # Periods entirely within this segment
+                interior = boundaries - 1
+                if limit is not None and interior >= limit:
+                    skipped += len(data_to_insert) + interior - limit
+                    data_to_insert, interior_start = [], interior - limit
+                else:
+                    interior_start = 0
+                for i in xrange(interior_start, interior):
+                    x, y = first + i * step, first + (i + 1) * step
+                    data_to_insert.append(whole(start + slope * (x - old_timestamp),
+                                                end if y == timestamp else start + slope * (y - old_timestamp)))
+                if limit is not None and len(data_to_insert) > 2 * limit:
+                    skipped += len(data_to_insert) - limit
+                    del data_to_insert[:-limit]
+
+                last = timestamp // step * step
+                at_last = end if last == timestamp else start + slope * (last - old_timestamp)
+                accumulated = fold(identity, last, timestamp, at_last, end)
+            old_timestamp = timestamp
+
+        return accumulated, data_to_insert, skipped
+
     def fetch(self, aggregation_type, interval, period_start, period_end):
+        if self._readonly and self._version > 1:
+            return self._read_consistently(self._fetch, aggregation_type, interval, period_start, period_end)
+        return self._fetch(aggregation_type, interval, period_start, period_end)
+
+    def _fetch_range(self, interval, period_start, period_end):
         if not period_end:
             period_end = pytz.utc.localize(datetime.datetime.utcnow())
         if not period_start:
             period_start = period_end - datetime.timedelta(2)
         period_start = max(period_start, self._start)
 
+        period_start, period_end = map(_to_timestamp, [period_start, period_end])
+        return -(-period_start // interval) * interval, period_end // interval * interval
+
+    def _fetch(self, aggregation_type, interval, period_start, period_end):
+        period_start, period_end = self._fetch_range(interval, period_start, period_end)
+        plan = self._plan_fetch(aggregation_type, interval, period_start, period_end)
+        typecodes = set(self._encoding(archive).decoded_typecode for archive, first, last in plan if archive)
+        values = array.array('d' if 'd' in typecodes else 'f')
+        for archive, first, last in plan:
+            samples = (last - first) // interval + 1
+            if archive is None:
+                values.extend(array.array(values.typecode, [float('nan')]) * samples)
+                continue
+            step = archive['aggregation'] * self._interval
+            index = (first - interval - self._archive_epoch(archive)) // step
+            archive_values = self._read_values(archive, index, index + samples * interval // step)
+            if step != interval:
+                archive_values = self._roll_up(archive, archive_values, interval // step)
+            elif archive_values.typecode != values.typecode:
+                archive_values = archive_values.tolist()
+            values.extend(archive_values)
+
+        return FetchResult(plan[0][1] if plan else period_start + interval,
+                           interval,
+                           values,
+                           self._timezone_name)
+
+    def aggregate(self, aggregation_type, interval, period_start, period_end):
+        """
+        Returns the count, sum, mean, minimum and maximum of the samples that
+        fetch would return for the same arguments, ignoring missing ones.
+        Where samples come straight from an archive, whole blocks of them are
+        taken from its block summaries, leaving only the edges to be read.
+        """
+        if self._readonly and self._version > 1:
+            return self._read_consistently(self._aggregate, aggregation_type, interval, period_start, period_end)
+        return self._aggregate(aggregation_type, interval, period_start, period_end)
+
+    def _aggregate(self, aggregation_type, interval, period_start, period_end):
+        period_start, period_end = self._fetch_range(interval, period_start, period_end)
+        plan = self._plan_fetch(aggregation_type, interval, period_start, period_end)
+        # Rolled-up values are rounded as fetch would return them
+        typecodes = set(self._encoding(archive).decoded_typecode for archive, first, last in plan if archive)
+        typecode = 'd' if 'd' in typecodes else 'f'
+        summary = [0, 0.0, float('inf'), float('-inf')]
+        for archive, first, last in plan:
+            if archive is None:
+                continue
+            samples = (last - first) // interval + 1
+            step = archive['aggregation'] * self._interval
+            index = (first - interval - self._archive_epoch(archive)) // step
+            if step == interval and archive['summary_offset']:
+                self._aggregate_summaries(archive, index, index + samples, summary)
+            else:
+                values = self._read_values(archive, index, index + samples * interval // step)
+                if step != interval:
+                    values = array.array(typecode, self._roll_up(archive, values, interval // step))
+                _fold_summary(summary, values)
+        count, total, minimum, maximum = summary
+        nan = float('nan')
+        return {'count': count,
+                'sum': total,
+                'mean': total / count if count else nan,
+                'min': minimum if count else nan,
+                'max': maximum if count else nan}
+
+    def _aggregate_summaries(self, archive, first, end, summary):
+        """
+        Folds the values with absolute indices in [first, end) into summary,
+        using the summaries of whole blocks that are still entirely stored,
+        and reading values only for the blocks at either edge.
+        """
+        length, slots, size = self._summary_block_length, self._summary_slots(archive), self._summary_size
+        total = archive['cycles'] * archive['count'] + archive['position']
+        block_first = -(-max(first, total - archive['count'], 0) // length)
+        block_end = min(end, total) // length
+        if block_end <= block_first:
+            _fold_summary(summary, self._read_values(archive, first, end))
+            return
+        _fold_summary(summary, self._read_values(archive, first, block_first * length))
+        for block in xrange(block_first, block_end):
+            pos = archive['summary_offset'] + block % slots * size
+            marker, count, block_total, minimum, maximum = struct.unpack(self._summary_format, self._map[pos:pos + size])
+            # Blocks that were skipped over have no summary
+            if marker == block + 1 and count:
+                summary[0] += count
+                summary[1] += block_total
+                summary[2], summary[3] = min(summary[2], minimum), max(summary[3], maximum)
+        _fold_summary(summary, self._read_values(archive, block_end * length, end))
+
+    def _archive_epoch(self, archive):
+        """
+        Returns the timestamp at which the archive's first period starts.
+        Archive periods are aligned to multiples of their length.
+        """
+        step = archive['aggregation'] * self._interval
+        return _to_timestamp(self._start) // step * step
+
+    def _plan_fetch(self, aggregation_type, interval, period_start, period_end):
+        """
+        Works out how to answer a fetch of samples at the given resolution
+        whose timestamps lie in (period_start, period_end], both of which
+        should be multiples of interval.
+
+        Any archive of the right aggregation type whose resolution divides
+        interval can provide samples, rolling up its own if need be. Each
+        sample is taken from the coarsest archive that holds all the data
+        for it, so reading as few values as possible. Returns a list of
+        (archive, first, last) tuples giving the timestamps of the first and
+        last samples to be taken from each archive, in order; samples no
+        archive can provide between others are planned with an archive of
+        None.
+        """
+        candidates = []
         for archive in self._archives:
-            if archive['aggregation_type'] == aggregation_type and archive['aggregation'] * self._interval == interval:
-                break
-        else:
+            step = archive['aggregation'] * self._interval
+            if archive['aggregation_type'] == aggregation_type and interval % step == 0:
+                candidates.append((step, archive))
+        if not candidates:
             raise ValueError("No suitable archive")
+        candidates.sort(key=lambda candidate: -candidate[0])
 
-        period_start, period_end = map(_to_timestamp, [period_start, period_end])
-        period_start = math.ceil(period_start / interval) * interval
-        period_end = math.floor(period_end / interval) * interval
+        unplanned, plan = [(period_start + interval, period_end)], []
+        for step, archive in candidates:
+            epoch = self._archive_epoch(archive)
+            total = archive['cycles'] * archive['count'] + archive['position']
+            # The samples for which this archive holds all the data
+            available_start = -(-(epoch + max(total - archive['count'], 0) * step + interval) // interval) * interval
+            available_end = (epoch + total * step) // interval * interval
+            remaining = []
+            for first, last in unplanned:
+                if max(first, available_start) <= min(last, available_end):
+                    plan.append((archive, max(first, available_start), min(last, available_end)))
+                if first < available_start:
+                    remaining.append((first, min(last, available_start - interval)))
+                if last > available_end:
+                    remaining.append((max(first, available_end + interval), last))
+            unplanned = [(first, last) for first, last in remaining if first <= last]
 
-        offset_start = int(period_start - _to_timestamp(self._start)) // interval
-        offset_end = int(period_end - _to_timestamp(self._start)) // interval
-        offset_end = min(offset_end, archive['cycles'] * archive['count'] + archive['position']) - 1
+        plan.sort(key=lambda part: part[1])
+        for (_, _, last), (_, first, _) in zip(plan[:-1], plan[1:]):
+            if first > last + interval:
+                plan.append((None, last + interval, first - interval))
+        plan.sort(key=lambda part: part[1])
+        return plan
 
-        seek_to = max(offset_start, (archive['cycles'] - 1) * archive['count'] + archive['position'])
-        self._map.seek(archive['offset'] + (seek_to % archive['count']) * self._value_format_size)
+    def _roll_up(self, archive, values, factor):
+        """
+        Combines each run of factor values into one, according to the
+        archive's aggregation type. Runs with fewer values present than the
+        archive's threshold are NaN, or for gauge and counter series, as when
+        ingested, runs with any value missing.
+        """
+        combine = {'average': lambda present: sum(present) / len(present),
+                   'min': min,
+                   'max': max}[archive['aggregation_type']]
+        if self._series_type == 'period':
+            minimum_present = archive['threshold'] * factor
+        else:
+            minimum_present = factor
+        nan = float('nan')
+        rolled_up = []
+        for i in xrange(0, len(values), factor):
+            present = [value for value in values[i:i + factor] if not isnan(value)]
+            if present and len(present) >= minimum_present:
+                rolled_up.append(combine(present))
+            else:
+                rolled_up.append(nan)
+        return rolled_up
 
+    def _read_values(self, archive, first, end):
+        """
+        Returns the values with absolute indices in [first, end) as an array,
+        copying at most two slices out of the archive's ring buffer. Values
+        not among the last count written are NaN.
+        """
+        encoding = self._encoding(archive)
+        values = array.array(encoding.decoded_typecode)
+        if end <= first:
+            return values
+        if archive['kind'] == 'compressed':
+            return self._read_compressed(archive, encoding, first, end)
+        count, offset, size = archive['count'], archive['offset'], encoding.size
+        total = archive['cycles'] * count + archive['position']
+        nans = array.array(encoding.decoded_typecode, [float('nan')])
+        valid_first, valid_end = min(max(first, total - count, 0), end), max(min(end, total), first)
+        values.extend(nans * (valid_first - first))
+        slot = valid_first % count
+        for a, b in ((slot, min(slot + valid_end - valid_first, count)), (0, slot + valid_end - valid_first - count)):
+            if b > a:
+                values.extend(encoding.decode(self._map[offset + a * size:offset + b * size]))
+        values.extend(nans * (end - max(valid_first, valid_end)))
+        return values
 
-        timestamp = _to_timestamp(self._start) + seek_to * self._interval * archive['aggregation']
-        for i in xrange(seek_to, offset_end + 1):
-            if i % archive['count'] == 0:
-                self._map.seek(archive['offset'])
-            timestamp += self._interval * archive['aggregation']
-            yield (_from_timestamp(timestamp).astimezone(self.timezone),
-                   self._read(self._value_format))
+    def _read_compressed(self, archive, encoding, first, end):
+        """
+        Returns the values with absolute indices in [first, end) from a
+        compressed archive, decompressing only the blocks they lie in, with
+        NaN for any that aren't stored.
+        """
+        length, size = archive['block_length'], encoding.size
+        total = archive['cycles'] * archive['count'] + archive['position']
+        tail_start = total // length * length
+        values, nans = array.array(encoding.decoded_typecode), array.array(encoding.decoded_typecode, [float('nan')])
+        for block_start in xrange(first // length * length, end, length):
+            if block_start == tail_start:
+                block = encoding.decode(self._map[archive['offset']:archive['offset'] + (total - tail_start) * size])
+            elif block_start < tail_start:
+                block = self._read_block(archive, encoding, block_start)
+            else:
+                block = array.array(encoding.decoded_typecode)
+            block.extend(nans * (length - len(block)))
+            values.extend(block[max(first, block_start) - block_start:min(end, block_start + length) - block_start])
+        return values
 
     def info(self):
         result = {
@@ -289,17 +1177,27 @@ class TimeSeriesDatabase(object):
         return result
 
     def _sync_archive_meta(self):
-        self._map.seek(self._header_format_size)
-        for archive in self._archives:
-            self._write(self._archive_meta_format,
-                        (self._aggregation_types_inv[archive['aggregation_type']],
-                         archive['aggregation'],
-                         archive['count'],
-                         archive['cycles'],
-                         archive['position'],
-                         archive['threshold'],
-                         archive['state'][0],
-                         archive['state'][1]))
+        for i, archive in enumerate(self._archives):
+            meta = (self._aggregation_types_inv[archive['aggregation_type']],
+                    archive['aggregation'],
+                    archive['count'],
+                    archive['cycles'],
+                    archive['position'],
+                    archive['threshold'],
+                    archive['state'][0],
+                    archive['state'][1])
+            if self._version > 1:
+                meta += (archive['offset'],
+                         archive['size'],
+                         encodings.encodings.index(archive['encoding']),
+                         archive['scale'],
+                         archive['value_offset'],
+                         self._archive_kinds.index(archive['kind']),
+                         archive['block_length'],
+                         archive['last'],
+                         archive['summary_offset'])
+            self._write(self._archive_meta_format, meta,
+                        self._archive_meta_offset + i * self._archive_meta_size)
 
     def _sync_last_timestamp(self, last):
         self._last = last
@@ -311,6 +1209,10 @@ class TimeSeriesDatabase(object):
         self._map.flush()
     def close(self):
         self._map.close()
+        self._file.close()
+
+    def fileno(self):
+        return self._file.fileno()
 
     series_type = property(lambda self: self._series_type)
     start = property(lambda self: self._start)
@@ -319,3 +1221,5 @@ class TimeSeriesDatabase(object):
     timezone = property(lambda self: self._timezone)
     timezone_name = property(lambda self: self._timezone_name)
     last = property(lambda self: self._last)
+    reorder_window = property(lambda self: self._reorder_window)
+    version = property(lambda self: self._version)
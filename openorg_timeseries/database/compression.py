@@ -0,0 +1,84 @@
+"""
+Gorilla-style XOR compression of archive values, after Pelkonen et al.,
+"Gorilla: A Fast, Scalable, In-Memory Time Series Database" (VLDB 2015).
+
+Archives hold values at a fixed interval, so there are no timestamps to
+compress. Each value's bit pattern is XORed with that of its predecessor;
+a repeated value costs a single bit, and a value that differs only in a
+few bits costs little more than those bits.
+
+Python 2 has no cheap bit-level access to strings, so the bitstream is
+built and parsed as a string of '0' and '1' characters, converting to and
+from bytes through a long in one go.
+"""
+
+import binascii
+import struct
+
+_word_formats = {2: 'H', 4: 'I', 8: 'Q'}
+
+def compress(data, size):
+    """
+    Compresses data, a string of little-endian size-byte values, returning
+    the packed bitstream.
+    """
+    count = len(data) // size
+    if not count:
+        return ''
+    words = struct.unpack('<%d%s' % (count, _word_formats[size]), data)
+    width = size * 8
+    word_format = '0%db' % width
+    # Enough bits to hold any count of leading zeros, or any length less one
+    field_format = '0%db' % (width.bit_length() - 1)
+
+    bits, previous = [format(words[0], word_format)], words[0]
+    # The window of meaningful bits, initially one that nothing can reuse
+    lead, trail = width, width
+    for word in words[1:]:
+        xor, previous = previous ^ word, word
+        if not xor:
+            bits.append('0')
+            continue
+        xor_bits = format(xor, word_format)
+        new_lead = width - len(xor_bits.lstrip('0'))
+        new_trail = width - len(xor_bits.rstrip('0'))
+        if new_lead >= lead and new_trail >= trail:
+            bits.append('10' + xor_bits[lead:width - trail])
+        else:
+            lead, trail = new_lead, new_trail
+            bits.append('11' + format(lead, field_format)
+                             + format(width - lead - trail - 1, field_format)
+                             + xor_bits[lead:width - trail])
+    bits = ''.join(bits)
+    bits += '0' * (-len(bits) % 8)
+    return binascii.unhexlify('%0*x' % (len(bits) // 4, int(bits, 2)))
+
+def decompress(payload, count, size):
+    """
+    Decompresses count values from a bitstream returned by compress,
+    returning them as a string of little-endian size-byte values.
+    """
+    if not count:
+        return ''
+    width = size * 8
+    field = width.bit_length() - 1
+    bits = bin(int(binascii.hexlify(payload), 16))[2:].zfill(len(payload) * 8)
+
+    word, position = int(bits[:width], 2), width
+    words, length, shift = [word], 0, 0
+    append = words.append
+    for i in xrange(count - 1):
+        if bits[position] == '0':
+            position += 1
+        else:
+            if bits[position + 1] == '1':
+                lead = int(bits[position + 2:position + 2 + field], 2)
+                length = int(bits[position + 2 + field:position + 2 + 2 * field], 2) + 1
+                shift = width - lead - length
+                position += 2 + 2 * field
+            else:
+                position += 2
+            word ^= int(bits[position:position + length], 2) << shift
+            position += length
+        append(word)
+    return struct.pack('<%d%s' % (count, _word_formats[size]), *words)
@@ -0,0 +1,80 @@
+"""
+Downsampling of fetched samples for display, choosing which samples to keep
+rather than averaging them, so that what is drawn are values that were
+actually recorded.
+
+Samples come at a fixed interval, so their indices stand in for their
+timestamps. Each method returns the indices of the samples to keep, in
+order. Missing (NaN) samples are never chosen over recorded ones, but a
+bucket with nothing recorded keeps its first sample, so that gaps still
+show.
+"""
+
+def lttb(values, points):
+    """
+    Largest-Triangle-Three-Buckets, after Steinarsson, "Downsampling Time
+    Series for Visual Representation" (2013). Keeps the first and last
+    samples, and from each of points - 2 buckets in between, the sample
+    forming the largest triangle with the one kept from the previous bucket
+    and the average of the next.
+    """
+    count = len(values)
+    if count <= points:
+        return range(count)
+    if points < 3:
+        return [0, count - 1][:points]
+
+    width = (count - 2) / float(points - 2)
+    bounds = [int(i * width) + 1 for i in xrange(points - 2)] + [count - 1, count]
+    indices, a = [0], 0 if values[0] == values[0] else None
+    for bucket in xrange(points - 2):
+        start, end = bounds[bucket], bounds[bucket + 1]
+        next_values = [(i, values[i]) for i in xrange(end, bounds[bucket + 2]) if values[i] == values[i]]
+        best, best_area = start, -1.0
+        if a is not None and next_values:
+            ax, ay = a, values[a]
+            cx = sum(i for i, v in next_values) / float(len(next_values))
+            cy = sum(v for i, v in next_values) / len(next_values)
+            for i in xrange(start, end):
+                value = values[i]
+                if value == value:
+                    # Twice the triangle's area, which orders them as well
+                    area = abs((ax - cx) * (value - ay) - (ax - i) * (cy - ay))
+                    if area > best_area:
+                        best, best_area = i, area
+        else:
+            for i in xrange(start, end):
+                if values[i] == values[i]:
+                    best, best_area = i, 0.0
+                    break
+        indices.append(best)
+        if best_area >= 0:
+            a = best
+    indices.append(count - 1)
+    return indices
+
+def minmax(values, points):
+    """
+    Keeps the smallest and largest samples from each of points // 2
+    buckets, so that no peak or trough is lost, whatever the width of each
+    bucket when drawn.
+    """
+    count = len(values)
+    if count <= points:
+        return range(count)
+    buckets = max(points // 2, 1)
+    width = count / float(buckets)
+    indices = []
+    for bucket in xrange(buckets):
+        start, end = int(bucket * width), int((bucket + 1) * width)
+        recorded = [i for i in xrange(start, end) if values[i] == values[i]]
+        if not recorded:
+            indices.append(start)
+            continue
+        low = min(recorded, key=values.__getitem__)
+        high = max(recorded, key=values.__getitem__)
+        indices.extend(sorted(set([low, high])))
+    return indices
+
+methods = {'lttb': lttb,
+           'minmax': minmax}
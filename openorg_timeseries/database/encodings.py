@@ -0,0 +1,144 @@
+"""
+Encodings for the values stored in archives.
+
+Each encoding converts between a sequence of floats and the little-endian
+bytes stored in a database file, a whole slice at a time. NaN is always
+representable, as it marks missing data.
+"""
+
+from __future__ import division
+
+import array
+import sys
+
+def _pack_values(values):
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+def _unpack_values(data, typecode='f'):
+    values = array.array(typecode)
+    values.fromstring(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+class Encoding(object):
+    # The array typecode in which values are stored, and in which they are
+    # returned when decoded.
+    typecode = 'f'
+    decoded_typecode = 'f'
+
+    def __init__(self, name):
+        self.name = name
+        self.size = array.array(self.typecode).itemsize
+
+    def encode(self, values):
+        return _pack_values(array.array(self.typecode, values))
+
+    def decode(self, data):
+        return _unpack_values(data, self.typecode)
+
+class Float64Encoding(Encoding):
+    typecode = decoded_typecode = 'd'
+
+class Float16Encoding(Encoding):
+    """
+    IEEE 754 half-precision floats, which have an 11-bit significand and a
+    range of about +/-65504. Python 2 has no native support for them, so
+    they're converted via their float32 bit patterns.
+    """
+    typecode = 'H'
+    _decode_table = None
+
+    def encode(self, values):
+        bits = _unpack_values(_pack_values(array.array('f', values)), 'I')
+        return _pack_values(array.array('H', map(self._half_bits, bits)))
+
+    def decode(self, data):
+        if self._decode_table is None:
+            Float16Encoding._decode_table = tuple(map(self._half_value, xrange(0x10000)))
+        table = self._decode_table
+        return array.array('f', [table[half] for half in _unpack_values(data, 'H')])
+
+    @staticmethod
+    def _half_bits(bits):
+        sign = (bits >> 16) & 0x8000
+        exponent, mantissa = (bits >> 23) & 0xff, bits & 0x7fffff
+        if exponent == 0xff:
+            # Infinity or NaN
+            return sign | 0x7c00 | (0x200 if mantissa else 0)
+        exponent -= 127 - 15
+        if exponent >= 0x1f:
+            return sign | 0x7c00
+        if exponent <= 0:
+            # Subnormal, or too small to represent
+            if exponent < -10:
+                return sign
+            mantissa, shift = mantissa | 0x800000, 14 - exponent
+        else:
+            mantissa, shift = (exponent << 23) | mantissa, 13
+        half, remainder = mantissa >> shift, mantissa & ((1 << shift) - 1)
+        # Round to nearest, ties to even. A carry into the exponent is correct,
+        # including rounding up to infinity.
+        if remainder > 1 << (shift - 1) or (remainder == 1 << (shift - 1) and half & 1):
+            half += 1
+        return sign | half
+
+    @staticmethod
+    def _half_value(half):
+        sign = -1 if half & 0x8000 else 1
+        exponent, mantissa = (half >> 10) & 0x1f, half & 0x3ff
+        if exponent == 0x1f:
+            return sign * float('inf') if not mantissa else float('nan')
+        if exponent == 0:
+            return sign * mantissa * 2.0 ** -24
+        return sign * (0x400 | mantissa) * 2.0 ** (exponent - 25)
+
+class ScaledInt16Encoding(Encoding):
+    """
+    Values stored as round((value - offset) / scale) in a signed 16-bit
+    integer, saturating at the ends of its range, with -32768 marking NaN.
+    """
+    typecode, decoded_typecode = 'h', 'd'
+    _missing = -0x8000
+
+    def __init__(self, name, scale, offset):
+        super(ScaledInt16Encoding, self).__init__(name)
+        if not scale > 0:
+            raise ValueError("The scale of an int16 encoding must be positive.")
+        self.scale, self.offset = scale, offset
+
+    def encode(self, values):
+        scale, offset, missing = self.scale, self.offset, self._missing
+        return _pack_values(array.array('h', [missing if value != value
+                                              else max(-0x7fff, min(0x7fff, int(round((value - offset) / scale))))
+                                              for value in values]))
+
+    def decode(self, data):
+        scale, offset, missing, nan = self.scale, self.offset, self._missing, float('nan')
+        return array.array('d', [nan if value == missing else value * scale + offset
+                                 for value in _unpack_values(data, 'h')])
+
+# Indexed by the value stored in archive metadata, with 0 being the default
+encodings = ('float32', 'float64', 'float16', 'int16')
+
+_encoding_classes = {'float32': Encoding,
+                     'float64': Float64Encoding,
+                     'float16': Float16Encoding,
+                     'int16': ScaledInt16Encoding}
+_cache = {}
+
+def get_encoding(name, scale=1, offset=0):
+    key = name, scale, offset
+    if key not in _cache:
+        try:
+            cls = _encoding_classes[name]
+        except KeyError:
+            raise ValueError("Unknown value encoding %r" % name)
+        if cls is ScaledInt16Encoding:
+            _cache[key] = cls(name, scale, offset)
+        else:
+            _cache[key] = cls(name)
+    return _cache[key]
@@ -1,3 +1,5 @@
+import array
+import copy
 import datetime
 import math
 import operator
@@ -11,7 +13,8 @@ import unittest2
 
 import pytz
 
-from .base import TimeSeriesDatabase, _from_timestamp, _to_timestamp, isnan
+from . import downsample
+from .base import TimeSeriesDatabase, FetchResult, InconsistentRead, _from_timestamp, _to_timestamp, isnan
 
 class TimeSeriesDatabaseTestCase(unittest2.TestCase):
     _create_kwargs = {'series_type': 'period',
@@ -44,11 +47,11 @@ class TimeSeriesDatabaseTestCase(unittest2.TestCase):
             self._timezone = pytz.timezone(kwargs['timezone_name'])
             self._map = mock.Mock()
 
-    def createDatabase(self):
+    def createDatabase(self, **kwargs):
         fd, filename = tempfile.mkstemp()
         os.close(fd)
         try:
-            return filename, TimeSeriesDatabase.create(filename, **self._create_kwargs)
+            return filename, TimeSeriesDatabase.create(filename, **dict(self._create_kwargs, **kwargs))
         except Exception:
             os.unlink(filename)
             raise
@@ -64,6 +67,319 @@ class TimeSeriesDatabaseTestCase(unittest2.TestCase):
         finally:
             os.unlink(filename)
 
+    def testPageAligned(self):
+        filename, db = self.createDatabase()
+        try:
+            self.assertEqual(db.version, 2)
+            for archive in db.archives:
+                self.assertEqual(archive['offset'] % TimeSeriesDatabase._page_size, 0)
+            self.assertEqual(os.path.getsize(filename) % TimeSeriesDatabase._page_size, 0)
+        finally:
+            os.unlink(filename)
+
+    def testSparse(self):
+        archives = [{'aggregation_type': 'average',
+                     'aggregation': 1,
+                     'count': 1000000}]
+        filename, db = self.createDatabase(archives=archives)
+        try:
+            # Only the header pages have been written
+            self.assert_(os.stat(filename).st_blocks * 512 < 64 * 1024)
+            self.assert_(all(map(isnan, db._read_values(db.archives[0], 0, 10))))
+
+            db.update([(db.start + datetime.timedelta(0, i * db.interval), i) for i in xrange(1, 6)])
+            values = db._read_values(db.archives[0], 0, 10)
+            self.assertEqual(list(values[:5]), [1, 2, 3, 4, 5])
+            self.assert_(all(map(isnan, values[5:])))
+        finally:
+            os.unlink(filename)
+
+    def testUpgrade(self):
+        filename, db = self.createDatabase(version=1)
+        try:
+            self.assertEqual(db.version, 1)
+            data, timestamp = [], db.start
+            for i in xrange(1500):
+                timestamp += datetime.timedelta(0, self._create_kwargs['interval'])
+                data.append((timestamp, i))
+            db.update(data[:1400])
+            db.close()
+
+            self.assert_(TimeSeriesDatabase.upgrade(filename))
+            self.assertFalse(TimeSeriesDatabase.upgrade(filename))
+            db, db_expected = TimeSeriesDatabase(filename), TimeSeriesDatabase.create(filename + '.expected', **self._create_kwargs)
+            db_expected.update(data[:1400])
+            self.assertEqual(db.version, 2)
+            self.assertEqual(db.last, data[1399][0])
+
+            # Carry on updating, and check the archives are as if they'd been
+            # in the new format all along.
+            db.update(data[1400:])
+            db_expected.update(data[1400:])
+            for archive, expected_archive in zip(db.archives, db_expected.archives):
+                self.assertEqual(archive, expected_archive)
+                self.assertEqual(list(db.fetch(archive['aggregation_type'], archive['aggregation'] * db.interval, db.start, timestamp)),
+                                 list(db_expected.fetch(archive['aggregation_type'], archive['aggregation'] * db.interval, db.start, timestamp)))
+        finally:
+            os.unlink(filename)
+            os.unlink(filename + '.expected')
+
+    def testUpdateEpoch(self):
+        filename, db = self.createDatabase()
+        expected_filename, db_expected = self.createDatabase()
+        try:
+            data, timestamp = [], db.start
+            for i in xrange(1500):
+                timestamp += datetime.timedelta(0, db.interval)
+                data.append((timestamp, i))
+            db_expected.update(data)
+            db.update_epoch([_to_timestamp(ts) for ts, val in data[:1000]], [float(val) for ts, val in data[:1000]])
+            # Those already seen are ignored
+            db.update_epoch([_to_timestamp(ts) for ts, val in data[900:]], [float(val) for ts, val in data[900:]])
+            self.assertEqual(db.last, db_expected.last)
+            self.assertEqual(db.archives, db_expected.archives)
+        finally:
+            os.unlink(filename)
+            os.unlink(expected_filename)
+
+    def testReplayInterruptedUpdate(self):
+        filename, db = self.createDatabase()
+        expected_filename, db_expected = self.createDatabase()
+        try:
+            timestamps, values, timestamp = [], [], _to_timestamp(db.start)
+            for i in xrange(1500):
+                timestamp += db.interval
+                timestamps.append(timestamp)
+                values.append(float(random.randint(0, 100)))
+            db_expected.update_epoch(timestamps, values)
+            db.update_epoch(timestamps[:1000], values[:1000])
+            # As if we'd died having only updated the first archive
+            db._update_archive(db._archives[0], timestamps[1000:1200], values[1000:1200])
+            db._sync_archive_meta()
+            db.update_epoch(timestamps[1000:], values[1000:])
+            self.assertEqual(db.last, db_expected.last)
+            self.assertEqual(db.archives, db_expected.archives)
+            for archive in db.archives:
+                self.assertEqual(db._map[archive['offset']:archive['offset'] + archive['size']],
+                                 db_expected._map[archive['offset']:archive['offset'] + archive['size']])
+        finally:
+            os.unlink(filename)
+            os.unlink(expected_filename)
+
+    def testReadOnly(self):
+        filename, db = self.createDatabase()
+        try:
+            reader = TimeSeriesDatabase(filename, readonly=True)
+            data, timestamp = [], db.start
+            for i in xrange(100):
+                timestamp += datetime.timedelta(0, db.interval)
+                data.append((timestamp, i))
+            db.update(data[:50])
+            # The reader sees updates made since it was opened
+            self.assertEqual(list(reader.fetch('average', db.interval, db.start, timestamp))[-1], data[49])
+            self.assertEqual(reader.last, data[49][0])
+
+            # It waits for an update being written to finish
+            db._sync_sequence()
+            def finish_update(seconds):
+                db.update(data[50:])
+                db._sync_sequence()
+            with mock.patch('time.sleep', side_effect=finish_update) as sleep:
+                self.assertEqual(list(reader.fetch('average', db.interval, db.start, timestamp))[-1], data[-1])
+                self.assertEqual(sleep.call_count, 1)
+            reader.close()
+        finally:
+            os.unlink(filename)
+
+    def testReadOnlyAfterCrash(self):
+        filename, db = self.createDatabase()
+        try:
+            # A writer that died mid-update left the sequence number odd
+            db._sync_sequence()
+            db.close()
+            db = TimeSeriesDatabase(filename)
+            timestamp = db.start + datetime.timedelta(0, db.interval)
+            db.update([(timestamp, 1)])
+            reader = TimeSeriesDatabase(filename, readonly=True)
+            self.assertEqual(list(reader.fetch('average', db.interval, db.start, timestamp))[-1], (timestamp, 1))
+
+            # Readers give up on a database that's never consistent
+            db._sync_sequence()
+            with mock.patch('time.sleep') as sleep:
+                self.assertRaises(InconsistentRead, reader.fetch, 'average', db.interval, db.start, timestamp)
+                self.assertEqual(sleep.call_count, reader._max_read_attempts)
+            reader.close()
+        finally:
+            os.unlink(filename)
+
+    def testReconfigure(self):
+        archives = [{'aggregation_type': aggregation_type,
+                     'aggregation': 1,
+                     'count': 2000} for aggregation_type in ('average', 'max')]
+        new_archives = [{'aggregation_type': 'average', 'aggregation': 1, 'count': 1000},
+                        {'aggregation_type': 'average', 'aggregation': 10, 'count': 100},
+                        {'aggregation_type': 'max', 'aggregation': 5, 'count': 300, 'kind': 'compressed'}]
+        # Fewer readings leave the first, partly covered, periods in the archives
+        for series_type, length in (('period', 3000), ('gauge', 3000), ('period', 500), ('gauge', 500), ('counter', 500)):
+            filename, db = self.createDatabase(series_type=series_type, archives=copy.deepcopy(archives))
+            expected_filename, db_expected = self.createDatabase(series_type=series_type, archives=copy.deepcopy(new_archives))
+            try:
+                data, timestamp = [], db.start
+                for i in xrange(length):
+                    timestamp += datetime.timedelta(0, db.interval)
+                    data.append((timestamp, random.randint(0, 100)))
+                db.update(data[:length - 5])
+                db_expected.update(data[:length - 5])
+
+                db = db.reconfigure(copy.deepcopy(new_archives))
+                self.assertEqual([(a['aggregation_type'], a['aggregation'], a['count'], a['kind']) for a in db.archives],
+                                 [(a['aggregation_type'], a['aggregation'], a['count'], a['kind']) for a in db_expected.archives])
+                self.assertFalse(os.path.exists(filename + '.reconfigure'))
+
+                # Check the rebuilt archives and their states by carrying on
+                for i in (length - 5, len(data)):
+                    db.update(data[length - 5:i])
+                    db_expected.update(data[length - 5:i])
+                    for archive, expected_archive in zip(db.archives, db_expected.archives):
+                        self.assertEqual(archive['cycles'], expected_archive['cycles'])
+                        self.assertEqual(archive['position'], expected_archive['position'])
+                        step = archive['aggregation'] * db.interval
+                        period_start = max(timestamp - datetime.timedelta(0, (archive['count'] - 1) * step), db.start)
+                        values = db.fetch(archive['aggregation_type'], step, period_start, timestamp).values
+                        expected_values = db_expected.fetch(archive['aggregation_type'], step, period_start, timestamp).values
+                        self.assertEqual(len(values), len(expected_values))
+                        for value, expected_value in zip(values, expected_values):
+                            if isnan(expected_value):
+                                self.assert_(isnan(value))
+                            else:
+                                self.assertAlmostEqual(value, expected_value, 3)
+            finally:
+                os.unlink(filename)
+                os.unlink(expected_filename)
+
+    def assertAggregate(self, db, aggregation_type, interval, period_start, period_end):
+        values = [val for ts, val in db.fetch(aggregation_type, interval, period_start, period_end) if not isnan(val)]
+        result = db.aggregate(aggregation_type, interval, period_start, period_end)
+        self.assertEqual(result['count'], len(values))
+        if values:
+            self.assertAlmostEqual(result['sum'], sum(values), places=6)
+            self.assertAlmostEqual(result['mean'], sum(values) / len(values), places=6)
+            self.assertEqual((result['min'], result['max']), (min(values), max(values)))
+        else:
+            self.assert_(all(map(isnan, (result['mean'], result['min'], result['max']))))
+
+    def testAggregate(self):
+        archives = [{'aggregation_type': 'average', 'aggregation': 1, 'count': 3000},
+                    {'aggregation_type': 'average', 'aggregation': 1, 'count': 2000,
+                     'encoding': 'float16', 'kind': 'compressed', 'block_length': 300},
+                    {'aggregation_type': 'max', 'aggregation': 5, 'count': 1000}]
+        filename, db = self.createDatabase(series_type='gauge', archives=archives)
+        try:
+            data, timestamp = [], db.start
+            for i in xrange(5000):
+                # With a gap, and the first archive wrapping around
+                timestamp += datetime.timedelta(0, db.interval * (300 if i == 1000 else 1))
+                data.append((timestamp, random.random() * 100))
+            db.update(data[:2000])
+            db.update(data[2000:])
+
+            for period_start, period_end in ((db.start, timestamp),
+                                             (data[10][0], data[20][0]),
+                                             (data[900][0], data[1500][0]),
+                                             (data[1][0], data[3100][0]),
+                                             (data[2500][0], timestamp + datetime.timedelta(1))):
+                for aggregation_type, interval in (('average', db.interval), ('average', db.interval * 3),
+                                                   ('max', db.interval * 5), ('max', db.interval * 20)):
+                    self.assertAggregate(db, aggregation_type, interval, period_start, period_end)
+
+            # Readings older than the archives hold don't count
+            result = db.aggregate('average', db.interval, db.start, data[100][0])
+            self.assertEqual(result['count'], 0)
+        finally:
+            os.unlink(filename)
+
+    def testAggregateUpgraded(self):
+        filename, db = self.createDatabase(version=1)
+        try:
+            data, timestamp = [], db.start
+            for i in xrange(1500):
+                timestamp += datetime.timedelta(0, db.interval)
+                data.append((timestamp, i))
+            db.update(data)
+            db.close()
+            TimeSeriesDatabase.upgrade(filename)
+            db = TimeSeriesDatabase(filename)
+            self.assert_(all(archive['summary_offset'] for archive in db.archives))
+            self.assertAggregate(db, 'average', db.interval, db.start, timestamp)
+            self.assertEqual(db.aggregate('average', db.interval, db.start, timestamp)['count'], 1000)
+        finally:
+            os.unlink(filename)
+
+    def testEncodings(self):
+        values = [0.1, -2.5, 1000.3, 70000, -70000, float('nan'), 12.25]
+        expected = {'float32': [0.10000000149011612, -2.5, 1000.2999877929688, 70000, -70000, None, 12.25],
+                    'float64': [0.1, -2.5, 1000.3, 70000, -70000, None, 12.25],
+                    'float16': [0.0999755859375, -2.5, 1000.5, float('inf'), float('-inf'), None, 12.25],
+                    # Saturates at 1000 +/- 32767 * 0.5
+                    'int16': [0.0, -2.5, 1000.5, 17383.5, -15383.5, None, 12.0]}
+        archives = [{'aggregation_type': 'average',
+                     'aggregation': 1,
+                     'count': 10,
+                     'encoding': encoding,
+                     'scale': 0.5 if encoding == 'int16' else None,
+                     'value_offset': 1000 if encoding == 'int16' else None} for encoding in sorted(expected)]
+        filename, db = self.createDatabase(archives=archives)
+        try:
+            for archive in db._archives:
+                db._insert_data(archive, values)
+            db._sync_archive_meta()
+            db.close()
+            db = TimeSeriesDatabase(filename)
+            for archive in db.archives:
+                self.assertEqual(archive['size'], 10 * {'float64': 8, 'float32': 4}.get(archive['encoding'], 2))
+                stored = db._read_values(archive, 0, len(values))
+                self.assertEqual([None if isnan(v) else v for v in stored], expected[archive['encoding']])
+        finally:
+            os.unlink(filename)
+
+        self.assertRaises(ValueError, self.createDatabase, archives=archives, version=1)
+
+    def testCompressed(self):
+        # Small blocks, so that slots are reused many times over
+        archives = lambda kind: [{'aggregation_type': 'average',
+                                  'aggregation': 1,
+                                  'count': 200,
+                                  'kind': kind,
+                                  'block_length': 32},
+                                 {'aggregation_type': 'max',
+                                  'aggregation': 5,
+                                  'count': 100,
+                                  'kind': kind,
+                                  'encoding': 'float64',
+                                  'block_length': 16}]
+        filename, db = self.createDatabase(archives=archives('compressed'))
+        expected_filename, db_expected = self.createDatabase(archives=archives('ring'))
+        try:
+            random.seed(0)
+            timestamp = db.start
+            for i in xrange(200):
+                data = []
+                for j in xrange(random.choice([1, 10, 50])):
+                    timestamp += datetime.timedelta(0, db.interval * random.choice([1, 1, 1, 3, 1000]))
+                    data.append((timestamp, random.choice([20, 21, 21.5, random.random()])))
+                db.update(data)
+                db_expected.update(data)
+                if i % 10 == 0:
+                    db.close()
+                    db = TimeSeriesDatabase(filename)
+                for aggregation_type, interval in (('average', 1800), ('max', 9000), ('average', 3600)):
+                    period_start = timestamp - datetime.timedelta(0, 300 * db.interval)
+                    self.assertEqual(repr(list(db.fetch(aggregation_type, interval, period_start, timestamp))),
+                                     repr(list(db_expected.fetch(aggregation_type, interval, period_start, timestamp))))
+        finally:
+            os.unlink(filename)
+            os.unlink(expected_filename)
+
     def testCombineAverage(self):
         db = self.NullDatabase(**self._create_kwargs)
 
@@ -100,6 +416,92 @@ class TimeSeriesDatabaseTestCase(unittest2.TestCase):
         finally:
             os.unlink(filename)
 
+    def testFetchColumnar(self):
+        filename, db = self.createDatabase()
+        try:
+            data, timestamp = [], self._create_kwargs['start']
+            for i in xrange(1234):
+                timestamp += datetime.timedelta(0, self._create_kwargs['interval'])
+                data.append((timestamp, i))
+            db.update(data)
+
+            result = db.fetch('average', 1800, data[0][0], data[-1][0])
+            # Only the last 1000 readings fit in the archive, and they wrap around the end of it
+            self.assertEqual(len(result), 1000)
+            self.assertEqual(result.step, 1800)
+            self.assertEqual(result.start, _to_timestamp(data[-1000][0]))
+            self.assertEqual(result.end, _to_timestamp(data[-1][0]))
+            self.assertEqual(list(result.values), range(234, 1234))
+            self.assertEqual(list(result.timestamps()), [_to_timestamp(ts) for ts, val in data[-1000:]])
+            self.assertEqual(list(result), data[-1000:])
+        finally:
+            os.unlink(filename)
+
+    def testDownsample(self):
+        nan = float('nan')
+        values = array.array('d', [math.sin(i / 50.0) for i in xrange(10000)])
+        values[5000] = 10
+        values[6000:6400] = array.array('d', [nan] * 400)
+        result = FetchResult(1800, 1800, values)
+        self.assertIs(result.downsample(10000), result)
+
+        for method, points in (('lttb', 800), ('minmax', 800), ('lttb', 3), ('minmax', 2)):
+            downsampled = result.downsample(points, method)
+            self.assertLessEqual(len(downsampled), points, method)
+            self.assertEqual(list(downsampled.indices), sorted(set(downsampled.indices)), method)
+            self.assertEqual(list(downsampled.timestamps()), [1800 + 1800 * i for i in downsampled.indices])
+            self.assertEqual([(_to_timestamp(ts), val) for ts, val in downsampled][:1],
+                             [(1800 + 1800 * downsampled.indices[0], downsampled.values[0])])
+            # Samples are chosen, not made up
+            for index, value in zip(downsampled.indices, downsampled.values):
+                if not (isnan(value) and isnan(values[index])):
+                    self.assertEqual(value, values[index])
+            # The spike survives
+            self.assertIn(5000, downsampled.indices, method)
+            self.assertRaises(TypeError, downsampled.downsample, 2)
+            if points > 3:
+                # As does the gap, but isn't chosen over recorded values
+                self.assertTrue(any(isnan(value) for value in downsampled.values), method)
+                self.assertFalse(any(isnan(value) for index, value in zip(downsampled.indices, downsampled.values)
+                                     if not 6000 <= index < 6400), method)
+        self.assertEqual(downsample.lttb(values, 800)[::799], [0, 9999])
+        self.assertEqual(len(downsample.lttb(values, 800)), 800)
+
+    def testFetchPlan(self):
+        """
+        Fetches at resolutions without an archive of their own should be
+        rolled up from finer archives, taking each sample from the coarsest
+        archive that has the data for it.
+        """
+        archives = [{'aggregation_type': 'average', 'aggregation': 1, 'count': 1000},
+                    {'aggregation_type': 'average', 'aggregation': 4, 'count': 10},
+                    {'aggregation_type': 'max', 'aggregation': 1, 'count': 1000}]
+        filename, db = self.createDatabase(archives=archives)
+        try:
+            data, timestamp = [], db.start
+            for i in xrange(200):
+                timestamp += datetime.timedelta(0, 1800)
+                data.append((timestamp, i))
+            db.update(data)
+            fine, coarse, maximum = db._archives
+
+            start, end = _to_timestamp(db.start), _to_timestamp(timestamp)
+            plan = db._plan_fetch('average', 7200, start, end)
+            self.assertEqual(plan, [(fine, start + 7200, end - 10 * 7200),
+                                    (coarse, end - 9 * 7200, end)])
+
+            result = db.fetch('average', 7200, db.start, timestamp)
+            self.assertEqual(result.start, start + 7200)
+            self.assertEqual(list(result.values), [i * 4 + 1.5 for i in xrange(50)])
+
+            result = db.fetch('max', 14400, db.start, timestamp)
+            self.assertEqual(list(result.values), [i * 8 + 7 for i in xrange(25)])
+
+            self.assertRaises(ValueError, db.fetch, 'min', 7200, db.start, timestamp)
+            self.assertRaises(ValueError, db.fetch, 'average', 2700, db.start, timestamp)
+        finally:
+            os.unlink(filename)
+
     def testUpdateEmpty(self):
         filename, db = self.createDatabase()
         db.update([])
@@ -193,5 +595,134 @@ class TimeSeriesDatabaseTestCase(unittest2.TestCase):
             os.unlink(filename_once)
             os.unlink(filename_batch)
 
+    def testLongGap(self):
+        """
+        A gap of many times the length of each archive should wrap their
+        positions arithmetically and leave them full of NaNs.
+        """
+        filename, db = self.createDatabase()
+        try:
+            interval = self._create_kwargs['interval']
+            gap = 500 * 1000 + 1
+            data = [(db.start + datetime.timedelta(0, interval), 10),
+                    (db.start + datetime.timedelta(0, interval * gap), 20),
+                    (db.start + datetime.timedelta(0, interval * (gap + 1)), 30)]
+            started = time.time()
+            db.update(data)
+            self.assert_(time.time() - started < 1, "Update took too long")
+
+            for archive in db.archives:
+                cycles, position = divmod((gap + 1) // archive['aggregation'], archive['count'])
+                self.assertEqual((archive['cycles'], archive['position']), (cycles, position))
+
+            stored_data = db.fetch('average', interval, db.start, data[-1][0])
+            self.assertEqual(len(stored_data), 1000)
+            self.assertEqual(stored_data.end, _to_timestamp(data[-1][0]))
+            self.assertEqual(stored_data.values[-1], 30)
+            self.assert_(all(isnan(val) for val in stored_data.values[:-1]))
+        finally:
+            os.unlink(filename)
+
+    def testBatchUpdateIdenticalFiles(self):
+        """
+        Updating with a whole batch should write exactly the same bytes as
+        updating one reading at a time.
+        """
+        filename_once, db_once = self.createDatabase()
+        filename_single, db_single = self.createDatabase()
+        try:
+            data, timestamp = [], db_once.start
+            for i in xrange(1500):
+                timestamp += datetime.timedelta(0, random.randrange(1, 3600))
+                data.append((timestamp, random.random() * 100))
+
+            db_once.update(data)
+            for datum in data:
+                db_single.update([datum])
+            db_once.flush()
+            db_single.flush()
+
+            # Other than the count of updates written
+            self.assertEqual(db_once._sequence, 2)
+            self.assertEqual(db_single._sequence, 2 * len(data))
+            sequence = slice(TimeSeriesDatabase._v2_sequence_offset, TimeSeriesDatabase._v2_sequence_offset + 8)
+            with open(filename_once, 'rb') as f_once, open(filename_single, 'rb') as f_single:
+                data_once, data_single = bytearray(f_once.read()), bytearray(f_single.read())
+                data_once[sequence] = data_single[sequence] = '\0' * 8
+                self.assertEqual(data_once, data_single)
+        finally:
+            os.unlink(filename_once)
+            os.unlink(filename_single)
+
+    _simple_archives = [{'aggregation_type': aggregation_type,
+                         'aggregation': 1,
+                         'count': 100} for aggregation_type in ('average', 'min', 'max')]
+
+    def testGauge(self):
+        filename, db = self.createDatabase(series_type='gauge',
+                                           archives=copy.deepcopy(self._simple_archives))
+        try:
+            # Rising by 0.01 a second
+            db.update([(db.start + datetime.timedelta(0, 600), 0),
+                       (db.start + datetime.timedelta(0, 4200), 36)])
+            expected = {'average': 21, 'min': 12, 'max': 30}
+            for archive in db.archives:
+                result = db.fetch(archive['aggregation_type'], 1800, db.start, db.last)
+                self.assertEqual(len(result), 2)
+                # The first period isn't covered by readings
+                self.assert_(isnan(result.values[0]))
+                self.assertAlmostEqual(result.values[1], expected[archive['aggregation_type']], places=4)
+        finally:
+            os.unlink(filename)
+
+    def testCounter(self):
+        filename, db = self.createDatabase(series_type='counter',
+                                           archives=copy.deepcopy(self._simple_archives))
+        try:
+            counter = [4294967000, 4294967100, 4294967290, 4, 10, 50, 20]
+            db.update([(db.start + datetime.timedelta(0, 1800 * (i + 1)), value) for i, value in enumerate(counter)])
+            result = db.fetch('average', 1800, db.start, db.last)
+            self.assert_(isnan(result.values[0]))
+            # A 32-bit wrap-around, and then a reset
+            self.assertEqual(list(result.values[1:]), [100, 190, 10, 6, 40, 20])
+        finally:
+            os.unlink(filename)
+
+    def testContinuousBatchUpdate(self):
+        """
+        Gauge and counter series should be the same whether updated in one go
+        or in batches.
+        """
+        for series_type in ('gauge', 'counter'):
+            filename_once, db_once = self.createDatabase(series_type=series_type)
+            filename_batch, db_batch = self.createDatabase(series_type=series_type)
+            try:
+                data, timestamp, value = [], db_once.start, 0
+                for i in xrange(500):
+                    timestamp += datetime.timedelta(0, random.randrange(1, 20000))
+                    value += random.randrange(0, 100)
+                    data.append((timestamp, value))
+
+                db_once.update(data)
+                for i in xrange(0, len(data), 7):
+                    db_batch.update(data[i:i + 7])
+
+                for i, archive in enumerate(db_once.archives):
+                    data_once = db_once.fetch(archive['aggregation_type'],
+                                              archive['aggregation'] * db_once.interval,
+                                              db_once.start,
+                                              timestamp)
+                    data_batch = db_batch.fetch(archive['aggregation_type'],
+                                                archive['aggregation'] * db_batch.interval,
+                                                db_batch.start,
+                                                timestamp)
+                    self.assertEqual(len(data_once), len(data_batch))
+                    for once, batch in zip(data_once.values, data_batch.values):
+                        if not (isnan(once) and isnan(batch)):
+                            self.assertAlmostEqual(once, batch, places=2, msg="%s archive %d" % (series_type, i))
+            finally:
+                os.unlink(filename_once)
+                os.unlink(filename_batch)
+
 if __name__ == '__main__':
     unittest2.main()
@@ -5,7 +5,6 @@ import logging
 import os
 import sys
 import threading
-import time
 import traceback
 
 import dateutil.parser
@@ -31,7 +30,7 @@ class Command(BaseCommand):
         database_thread.start()
 
         try:
-            time.sleep(1)
+            database_thread.ready.wait(30)
             self.load_demo_data()
             call_command('runserver', use_reloader=False)
         except BaseException:
@@ -4,7 +4,7 @@ import dateutil.parser
 from django import forms
 from django.conf import settings
 from django.forms.util import ValidationError
-from django.forms.formsets import formset_factory
+from django.forms.formsets import BaseFormSet, formset_factory
 import pytz
 
 from . import models
@@ -16,6 +16,9 @@ class NewTimeSeriesForm(forms.ModelForm):
                                     initial='gauge',
                                     help_text='<b>gauge</b> is for things like temperature')
     interval = forms.IntegerField(required=False)
+    reorder_window = forms.IntegerField(required=False,
+                                        min_value=0,
+                                        help_text='Seconds for which to hold readings back, so that late ones can be put in order')
     timezone_name = forms.ChoiceField(choices=[(x, x) for x in pytz.all_timezones],
                                       required=False,
                                       initial=settings.TIME_ZONE)
@@ -55,15 +58,38 @@ class NewTimeSeriesForm(forms.ModelForm):
 
     class Meta:
         model = models.TimeSeries
-        fields = ('slug', 'title', 'is_public', 'is_virtual', 'interval', 'timezone_name', 'start', 'notes')
+        fields = ('slug', 'title', 'is_public', 'is_virtual', 'interval', 'timezone_name', 'start', 'reorder_window', 'notes')
 
 class ArchiveForm(forms.Form):
     aggregation_type = forms.ChoiceField(widget=forms.Select,
                                          choices=(('', '-' * 8),) + models.AGGREGATION_TYPE_CHOICES)
-    aggregation = forms.IntegerField()
-    count = forms.IntegerField()
+    aggregation = forms.IntegerField(min_value=1)
+    count = forms.IntegerField(min_value=1)
+    encoding = forms.ChoiceField(widget=forms.Select,
+                                 choices=(('', '-' * 8),) + models.ENCODING_CHOICES,
+                                 required=False,
+                                 help_text='Defaults to 32-bit floats')
+    scale = forms.FloatField(required=False,
+                             help_text='For scaled integers, the difference between adjacent stored values')
+    value_offset = forms.FloatField(required=False,
+                                    help_text='For scaled integers, the value stored as zero')
+    kind = forms.ChoiceField(widget=forms.Select,
+                             choices=(('', '-' * 8),) + models.ARCHIVE_KIND_CHOICES,
+                             required=False,
+                             help_text='Compression suits long archives of smooth data')
 
-ArchiveFormSet = formset_factory(ArchiveForm, extra=3)
+    def clean_scale(self):
+        scale = self.cleaned_data['scale']
+        if scale is not None and not scale > 0:
+            raise ValidationError('The scale must be positive.')
+        return scale
+
+class BaseArchiveFormSet(BaseFormSet):
+    def clean(self):
+        if not any(form.is_valid() and form.cleaned_data for form in self.forms):
+            raise ValidationError('At least one archive is required.')
+
+ArchiveFormSet = formset_factory(ArchiveForm, formset=BaseArchiveFormSet, extra=3)
 
 class TimeSeriesForm(forms.ModelForm):
     class Meta:
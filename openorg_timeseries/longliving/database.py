@@ -1,18 +1,26 @@
 from __future__ import with_statement
 
-import collections
+import contextlib
 import csv
+import datetime
 import functools
 import logging
 import os
+import re
+import struct
 import sys
 import threading
 import time
+import zlib
 
-import multiprocessing.managers
+import multiprocessing
+import signal
 
+import dateutil.parser
 from django.conf import settings
-from openorg_timeseries.database import TimeSeriesDatabase
+from openorg_timeseries.database import TimeSeriesDatabase, InconsistentRead
+from openorg_timeseries.database.base import _from_timestamp, _to_timestamp
+from openorg_timeseries.longliving import protocol
 
 logger = logging.getLogger(__name__)
 
@@ -38,22 +46,65 @@ def requireNotExists(f):
         return f(self, *args, **kwargs)
     return g
 
+_iso_timestamp_re = re.compile(r'^(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d*)?(?:Z|([+-])(\d\d):?(\d\d))?$')
+_epoch_ordinal = datetime.date(1970, 1, 1).toordinal()
+
+def parse_csv_timestamp(value):
+    """
+    Parses a timestamp as written to a CSV archive by append() into an epoch
+    timestamp, much faster than dateutil can.
+    """
+    match = _iso_timestamp_re.match(value)
+    if not match:
+        return _to_timestamp(dateutil.parser.parse(value))
+    year, month, day, hour, minute, second, sign, offset_hours, offset_minutes = match.groups()
+    timestamp = ((datetime.date(int(year), int(month), int(day)).toordinal() - _epoch_ordinal) * 86400
+                 + int(hour) * 3600 + int(minute) * 60 + int(second))
+    if sign:
+        offset = int(offset_hours) * 3600 + int(offset_minutes) * 60
+        timestamp += offset if sign == '-' else -offset
+    return timestamp
+
+def read_csv_readings(csv_file, end=None):
+    """
+    Yields (epoch timestamp, value) pairs from a CSV archive, a line at a
+    time, stopping at the byte offset end if given.
+    """
+    def lines():
+        position = csv_file.tell()
+        for line in csv_file:
+            position += len(line)
+            if end is not None and position > end:
+                return
+            yield line
+    for row in csv.reader(lines()):
+        yield parse_csv_timestamp(row[0]), float(row[1])
+
+def _csv_last_timestamp(csv_filename):
+    """
+    Returns the epoch timestamp of the last complete reading in a CSV archive,
+    or None if there isn't one.
+    """
+    with open(csv_filename, 'rb') as csv_file:
+        csv_file.seek(0, os.SEEK_END)
+        csv_file.seek(max(csv_file.tell() - 1024, 0))
+        lines = csv_file.read().split('\n')
+    # The last line is empty, or a partial one torn in being written
+    for line in reversed(lines[:-1]):
+        if line.strip():
+            return parse_csv_timestamp(line.split(',')[0])
+    return None
+
 def with_db(method=None, with_csv=False):
     if method is None:
         return functools.partial(with_db, with_csv=with_csv)
     @functools.wraps(method)
     def f(self, slug, *args, **kwargs):
         tsdb_filename, csv_filename = self.get_filenames(slug)
-        with self.main_lock:
-            lock = self.locks[slug]
-            if slug not in self.databases:
-                try:
-                    self.databases[slug] = TimeSeriesDatabase(tsdb_filename)
-                except IOError:
-                    raise SeriesNotFound
-            db = self.databases[slug]
-
-        with lock:
+        with self.databases.lock(slug):
+            # Looked up under the series lock, as the database may have been
+            # replaced while we waited for it.
+            db = self.get_database(slug)
             if with_csv:
                 with open(csv_filename, 'a+b') as csv_file:
                     csv_writer = csv.writer(csv_file)
@@ -62,98 +113,1097 @@ def with_db(method=None, with_csv=False):
                 return method(self, db, *args, **kwargs)
     return f
 
+class WriteAheadLog(object):
+    """
+    A log of appended readings, written before they're applied to the
+    databases so that they can be replayed if the process dies mid-update.
+
+    Records are committed in groups, with one fsync covering everything
+    written within a commit window (commit_interval seconds, or
+    commit_records records, whichever comes first). The fsync policy is one
+    of:
+
+    always    appends return only once their record has been fsynced
+    interval  records are fsynced each commit window, without waiting
+    never     records are left for the operating system to write out
+
+    Once the log exceeds checkpoint_size bytes the databases are flushed
+    with flush() and the log emptied. flush() returns any logged readings
+    still to be applied, as (slug, timestamps, values), which are logged
+    afresh.
+    """
+    policies = ('always', 'interval', 'never')
+
+    # Body length and CRC-32 of body
+    _header_format = '<LL'
+    _header_size = struct.calcsize(_header_format)
+
+    def __init__(self, filename, flush, fsync='interval', commit_interval=0.01,
+                 commit_records=1000, checkpoint_size=16 * 1024 * 1024):
+        if fsync not in self.policies:
+            raise ValueError("Unknown fsync policy %r" % fsync)
+        self.filename, self.flush = filename, flush
+        self.fsync, self.commit_interval = fsync, commit_interval
+        self.commit_records, self.checkpoint_size = commit_records, checkpoint_size
+
+        self._file = open(filename, 'ab')
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._committed = threading.Condition(self._lock)
+        self._applied = threading.Condition(self._lock)
+        # Counts of records written and fsynced, and of those written but
+        # not yet applied to their databases
+        self._sequence, self._synced, self._in_flight = 0, 0, 0
+        self._checkpointing, self._closed = False, False
+        self._committer = None
+
+    @classmethod
+    def _pack(cls, slug, timestamps, values):
+        slug, count = slug.encode('utf-8'), len(timestamps)
+        body = (struct.pack('<H', len(slug)) + slug + struct.pack('<L', count)
+                + struct.pack('<%dq' % count, *timestamps)
+                + struct.pack('<%dd' % count, *values))
+        return struct.pack(cls._header_format, len(body), zlib.crc32(body) & 0xffffffff) + body
+
+    @staticmethod
+    def _unpack(body):
+        slug_length, = struct.unpack_from('<H', body)
+        slug = body[2:2 + slug_length].decode('utf-8')
+        count, = struct.unpack_from('<L', body, 2 + slug_length)
+        offset = 6 + slug_length
+        timestamps = list(struct.unpack_from('<%dq' % count, body, offset))
+        values = list(struct.unpack_from('<%dd' % count, body, offset + 8 * count))
+        return slug, timestamps, values
+
+    def replay(self):
+        """
+        Yields (slug, timestamps, values) for each record in the log, up to
+        the first that was torn or corrupted in being written.
+        """
+        return self.read(self.filename)
+
+    @classmethod
+    def read(cls, filename):
+        with open(filename, 'rb') as f:
+            while True:
+                header = f.read(cls._header_size)
+                if len(header) < cls._header_size:
+                    break
+                length, crc = struct.unpack(cls._header_format, header)
+                body = f.read(length)
+                if len(body) < length or zlib.crc32(body) & 0xffffffff != crc:
+                    logger.warning("Ignoring torn record at the end of the write-ahead log")
+                    break
+                yield cls._unpack(body)
+
+    def write(self, slug, timestamps, values):
+        """
+        Logs readings about to be applied, returning a sequence number to
+        pass to commit(). Call applied() once they have been.
+        """
+        record = self._pack(slug, timestamps, values)
+        with self._lock:
+            self._hold()
+            self._file.write(record)
+            self._file.flush()
+            self._sequence += 1
+            self._written.notify()
+            return self._sequence
+
+    def hold(self):
+        """
+        Holds off checkpoints while applying readings logged earlier, until
+        applied() is called.
+        """
+        with self._lock:
+            self._hold()
+
+    def _hold(self):
+        while self._checkpointing:
+            self._applied.wait()
+        self._in_flight += 1
+
+    def applied(self):
+        with self._lock:
+            self._in_flight -= 1
+            self._applied.notify_all()
+
+    def commit(self, sequence):
+        """
+        Waits, if the fsync policy requires it, until the record with the
+        given sequence number is on disk.
+        """
+        if self.fsync != 'always':
+            return
+        with self._lock:
+            while self._synced < sequence and not self._closed:
+                self._committed.wait()
+
+    def start(self):
+        self._committer = threading.Thread(target=self._run)
+        self._committer.daemon = True
+        self._committer.start()
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._written.notify()
+        if self._committer:
+            self._committer.join()
+        self.checkpoint()
+        self._file.close()
+
+    def checkpoint(self):
+        with self._lock:
+            self._checkpoint()
+
+    def _checkpoint(self):
+        # Called with the log lock held. New records are held back until the
+        # databases are flushed, as they couldn't be replayed once the log
+        # is emptied.
+        self._checkpointing = True
+        try:
+            while self._in_flight:
+                self._applied.wait()
+            pending = self.flush()
+            self._file.seek(0)
+            self._file.truncate()
+            for slug, timestamps, values in pending:
+                self._file.write(self._pack(slug, timestamps, values))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._synced = self._sequence
+            self._committed.notify_all()
+        finally:
+            self._checkpointing = False
+            self._applied.notify_all()
+
+    def _run(self):
+        with self._lock:
+            while not self._closed:
+                if self._synced == self._sequence:
+                    self._written.wait()
+                    continue
+                # Let a group of records gather before committing them
+                deadline = time.time() + self.commit_interval
+                while not self._closed and self._sequence - self._synced < self.commit_records:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._written.wait(remaining)
+                sequence = self._sequence
+                if self.fsync != 'never':
+                    # Writes may carry on while we wait for the disk
+                    self._lock.release()
+                    try:
+                        os.fsync(self._file.fileno())
+                    finally:
+                        self._lock.acquire()
+                self._synced = max(self._synced, sequence)
+                self._committed.notify_all()
+                if self._file.tell() > self.checkpoint_size:
+                    self._checkpoint()
+
+
+def get_server_args():
+    """
+    Returns the arguments for the manager of each shard, from
+    TIME_SERIES_SERVER_ARGS, which may be those for a single server.
+    """
+    server_args = settings.TIME_SERIES_SERVER_ARGS
+    if isinstance(server_args, dict):
+        return [server_args]
+    return list(server_args)
+
+def get_shard(slug, count):
+    """
+    Returns the index of the shard that owns a series. This must not change
+    between processes or releases, so uses CRC-32 rather than hash().
+    """
+    return (zlib.crc32(slug.encode('utf-8')) & 0xffffffff) % count
+
+def get_log_filename(path, shard, count):
+    if count == 1:
+        return os.path.join(path, 'wal.log')
+    return os.path.join(path, 'wal-%d.log' % shard)
+
+def _fsync_directory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def partition_logs(path, count):
+    """
+    Moves records in the write-ahead logs of a previous number of shards
+    into the logs of the shards that now own their series.
+
+    The new logs are written alongside the old ones, and only once they're
+    all on disk is a marker written, recording the number of shards they're
+    for. The old logs are then replaced and the marker removed. Should that
+    be interrupted, the marker has the next call finish the job, while new
+    logs without one are incomplete, and are discarded.
+    """
+    marker = os.path.join(path, 'wal.partition')
+    if os.path.exists(marker):
+        with open(marker, 'rb') as f:
+            _replace_logs(path, int(f.read()))
+    for filename in os.listdir(path):
+        if re.match(r'^wal(-\d+)?\.log\.new$', filename):
+            os.unlink(os.path.join(path, filename))
+
+    filenames = [get_log_filename(path, shard, count) for shard in xrange(count)]
+    existing = [os.path.join(path, filename) for filename in sorted(os.listdir(path))
+                if re.match(r'^wal(-\d+)?\.log$', filename)]
+    def misplaced(filename):
+        if filename not in filenames:
+            return os.path.getsize(filename) > 0
+        shard = filenames.index(filename)
+        return any(get_shard(slug, count) != shard for slug, timestamps, values in WriteAheadLog.read(filename))
+    if not any(misplaced(filename) for filename in existing):
+        return
+
+    logger.info("Partitioning write-ahead logs between %d shards", count)
+    new_files = [open(filename + '.new', 'wb') for filename in filenames]
+    try:
+        for filename in existing:
+            for slug, timestamps, values in WriteAheadLog.read(filename):
+                new_files[get_shard(slug, count)].write(WriteAheadLog._pack(slug, timestamps, values))
+        for new_file in new_files:
+            new_file.flush()
+            os.fsync(new_file.fileno())
+    finally:
+        for new_file in new_files:
+            new_file.close()
+    with open(marker, 'wb') as f:
+        f.write(str(count))
+        f.flush()
+        os.fsync(f.fileno())
+    _fsync_directory(path)
+    _replace_logs(path, count)
+
+def _replace_logs(path, count):
+    # Replaces the old write-ahead logs with those partition_logs() wrote
+    # for count shards, which are all on disk, then removes its marker.
+    filenames = [get_log_filename(path, shard, count) for shard in xrange(count)]
+    for filename in filenames:
+        if os.path.exists(filename + '.new'):
+            os.rename(filename + '.new', filename)
+    for filename in sorted(os.listdir(path)):
+        filename = os.path.join(path, filename)
+        if re.match(r'^wal(-\d+)?\.log$', os.path.basename(filename)) and filename not in filenames:
+            os.unlink(filename)
+    _fsync_directory(path)
+    os.unlink(os.path.join(path, 'wal.partition'))
+
+class DatabasePool(object):
+    """
+    The databases open in the long-living process or a reader's thread, and
+    a lock for each series. At most max_open databases are kept open, closing the least
+    recently used to make room, and any not used for idle_timeout seconds
+    are closed by evict_idle(). A database is only closed while its series
+    lock is held, and a series' lock is only kept while it is open or in use.
+    """
+    def __init__(self, open_database, close_database, max_open=256, idle_timeout=300):
+        self.open_database, self.close_database = open_database, close_database
+        self.max_open, self.idle_timeout = max_open, idle_timeout
+        self.hits = self.misses = self.evictions = 0
+        # {slug: db} and {slug: time last used}
+        self._databases, self._used = {}, {}
+        # {slug: [lock, number of threads holding or waiting for it]}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, slug):
+        # Should be called with self._lock held
+        entry = self._locks.get(slug)
+        if entry is None:
+            entry = self._locks[slug] = [threading.Lock(), 0]
+        entry[1] += 1
+        return entry
+
+    def _release(self, slug):
+        with self._lock:
+            entry = self._locks[slug]
+            entry[0].release()
+            entry[1] -= 1
+            if not entry[1] and slug not in self._databases:
+                del self._locks[slug]
+
+    @contextlib.contextmanager
+    def lock(self, slug):
+        with self._lock:
+            entry = self._entry(slug)
+        entry[0].acquire()
+        try:
+            yield
+        finally:
+            self._release(slug)
+
+    def get(self, slug):
+        # Should be called with the series lock held
+        with self._lock:
+            db = self._databases.get(slug)
+            if db is not None:
+                self.hits += 1
+                self._used[slug] = time.time()
+                return db
+            self.misses += 1
+        db = self.open_database(slug)
+        self.put(slug, db)
+        return db
+
+    def put(self, slug, db):
+        """
+        Sets the database for a series, returning the one it replaces, if
+        any. Should be called with the series lock held.
+        """
+        with self._lock:
+            old_db = self._databases.get(slug)
+            self._databases[slug], self._used[slug] = db, time.time()
+        self._evict(slug)
+        return old_db
+
+    def pop(self, slug):
+        # Should be called with the series lock held
+        with self._lock:
+            self._used.pop(slug, None)
+            return self._databases.pop(slug, None)
+
+    def items(self):
+        with self._lock:
+            return self._databases.items()
+
+    def evict_idle(self):
+        self._evict(idle=True)
+
+    def _evict(self, keep=None, idle=False):
+        """
+        Closes the least recently used databases while there are too many
+        open, or those left idle if idle is true, skipping any whose series
+        are in use rather than waiting for them.
+        """
+        while True:
+            with self._lock:
+                excess = len(self._databases) - self.max_open
+                horizon = time.time() - self.idle_timeout
+                victim = None
+                for slug in sorted(self._used, key=self._used.get):
+                    if slug == keep:
+                        continue
+                    if (idle and self._used[slug] > horizon) or (not idle and excess <= 0):
+                        break
+                    entry = self._entry(slug)
+                    if entry[0].acquire(False):
+                        victim = slug
+                        break
+                    entry[1] -= 1
+                if victim is None:
+                    return
+                db = self._databases.pop(victim)
+                del self._used[victim]
+                self.evictions += 1
+            try:
+                self.close_database(victim, db)
+            except Exception:
+                logger.exception("Failed to close database for %s", victim)
+            finally:
+                self._release(victim)
+
+    def stats(self):
+        with self._lock:
+            return {'open': len(self._databases),
+                    'locks': len(self._locks),
+                    'max_open': self.max_open,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
 
 class DatabaseThread(threading.Thread):
     def __init__(self, bail):
         self._bail = bail
+        # Set once every shard is serving
+        self.ready = threading.Event()
         super(DatabaseThread, self).__init__()
 
     def run(self):
-        self.databases = {}
+        self.databases = DatabasePool(self.open_database, self.close_database,
+                                      max_open=getattr(settings, 'TIME_SERIES_MAX_OPEN', 256),
+                                      idle_timeout=getattr(settings, 'TIME_SERIES_IDLE_TIMEOUT', 300))
         self.main_lock = threading.Lock()
-        self.locks = collections.defaultdict(threading.Lock)
+        self.buffers = {}
+        self.log = None
 
-        for path in ('tsdb', 'csv'):
+        for path in ('tsdb', 'csv', 'late'):
             path = os.path.join(settings.TIME_SERIES_PATH, path)
             if not os.path.exists(path):
                 os.makedirs(path)
 
-        def get_client_func():
-            return _DatabaseClient(settings.TIME_SERIES_PATH, self.databases, self.main_lock, self.locks)
-
-        self.manager = multiprocessing.managers.BaseManager(**settings.TIME_SERIES_SERVER_ARGS)
-        self.manager.register('get_client', get_client_func)
+        # Each shard is a server with a process of its own, serving the
+        # series that get_shard() assigns to it.
+        server_args = get_server_args()
+        partition_logs(settings.TIME_SERIES_PATH, len(server_args))
+        stopping = multiprocessing.Event()
+        self.processes = []
+        for shard, args in enumerate(server_args):
+            ready = multiprocessing.Event()
+            process = multiprocessing.Process(target=self.serve,
+                                              args=(shard, len(server_args), args, ready, stopping))
+            process.start()
+            self.processes.append((process, ready))
 
         #self.bail_thread = threading.Thread(target=self.bail_watcher)
         #self.bail_thread.start()
 
-        self.manager.start()
+        try:
+            for process, ready in self.processes:
+                while not ready.wait(0.1):
+                    if not process.is_alive():
+                        raise Exception("A database server exited on starting.")
+            self.ready.set()
+            self._bail.wait()
+        finally:
+            stopping.set()
+            for process, ready in self.processes:
+                process.join()
+
+    def serve(self, shard, count, server_args, ready, stopping):
+        """
+        Runs in a shard's process, serving clients until stopping is set.
+        """
+        # Ctrl-C is for the parent, which will then stop us in good order
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        stop = self.start_server(shard, count)
+        try:
+            server = protocol.Server(server_args['address'], server_args['authkey'],
+                                     self.get_client(), _DatabaseClient.exposed)
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+            ready.set()
+            stopping.wait()
+            server.shutdown()
+            server_thread.join()
+            server.server_close()
+        finally:
+            stop()
+
+    def get_client(self):
+        return _DatabaseClient(settings.TIME_SERIES_PATH, self.databases, self.main_lock, self.log, self.buffers)
+
+    def open_database(self, slug):
+        try:
+            return TimeSeriesDatabase(os.path.join(settings.TIME_SERIES_PATH, 'tsdb', slug + '.tsdb'))
+        except IOError:
+            raise SeriesNotFound
+
+    def close_database(self, slug, db):
+        """
+        Closes a database evicted from the pool, first making it and its CSV
+        archive durable, as a checkpoint of the write-ahead log would.
+        """
+        db.flush()
+        self.sync_csv(slug)
+        db.close()
+
+    def sync_csv(self, slug):
+        csv_filename = os.path.join(settings.TIME_SERIES_PATH, 'csv', slug + '.csv')
+        if os.path.exists(csv_filename):
+            with open(csv_filename, 'ab') as csv_file:
+                os.fsync(csv_file.fileno())
+
+    def start_server(self, shard=0, count=1):
+        """
+        Called in a shard's process before it starts serving. Replays the
+        shard's write-ahead log, and starts the threads that commit it, and
+        that commit readings held back for reordering and close idle
+        databases. Returns a function that stops them.
+        """
+        self.log = WriteAheadLog(get_log_filename(settings.TIME_SERIES_PATH, shard, count), self.flush_databases,
+                                 fsync=getattr(settings, 'TIME_SERIES_WAL_FSYNC', 'interval'),
+                                 commit_interval=getattr(settings, 'TIME_SERIES_WAL_COMMIT_INTERVAL', 0.01),
+                                 commit_records=getattr(settings, 'TIME_SERIES_WAL_COMMIT_RECORDS', 1000),
+                                 checkpoint_size=getattr(settings, 'TIME_SERIES_WAL_CHECKPOINT_SIZE', 16 * 1024 * 1024))
+
+        client = self.get_client()
+        for slug, timestamps, values in self.log.replay():
+            client.replay(slug, timestamps, values)
+        self.log.checkpoint()
+        self.log.start()
 
-        self._bail.wait()
-        self.manager.shutdown()
+        stopping = threading.Event()
+        def commit_buffered():
+            while not stopping.wait(1):
+                client.commit_buffered()
+                self.databases.evict_idle()
+        committer = threading.Thread(target=commit_buffered)
+        committer.daemon = True
+        committer.start()
+
+        def stop():
+            stopping.set()
+            committer.join()
+            self.log.close()
+        return stop
+
+    def flush_databases(self):
+        """
+        Flushes databases and CSV archives to disk for a checkpoint of the
+        write-ahead log, returning the readings held back for reordering so
+        they can be logged again.
+        """
+        # Those evicted from the pool were made durable as they were closed
+        for slug, db in self.databases.items():
+            try:
+                db.flush()
+            except ValueError:
+                # Closed since, having been evicted, replaced or deleted
+                continue
+            self.sync_csv(slug)
+        pending = []
+        for slug, buffer in self.buffers.items():
+            if buffer:
+                timestamps = sorted(buffer)
+                pending.append((slug, timestamps, [buffer[ts] for ts in timestamps]))
+        return pending
 
 class _DatabaseClient(object):
-    def __init__(self, path, databases, main_lock, locks):
+    # Those methods that can be called through DatabaseClient
+    exposed = ('create', 'delete', 'reconfigure', 'replace', 'get_config', 'append', 'append_epoch',
+               'append_many', 'append_many_epoch', 'fetch', 'fetch_many', 'aggregate', 'get_pool_stats')
+
+    # The most threads fetch_many() uses at once
+    fetch_many_threads = 8
+
+    def __init__(self, path, databases, main_lock, log=None, buffers=None):
         self.path = path
+        # A DatabasePool
         self.databases = databases
+        # Guards buffers
         self.main_lock = main_lock
-        self.locks = locks
+        self.log = log
+        # Readings held back for reordering, as {slug: {timestamp: value}}
+        self.buffers = buffers if buffers is not None else {}
 
     def get_filenames(self, slug):
         return (os.path.join(self.path, 'tsdb', slug + '.tsdb'),
                 os.path.join(self.path, 'csv', slug + '.csv'))
 
-    def create(self, slug, series_type, start, interval, archives, timezone_name):
-        with self.main_lock:
-            lock = self.locks[slug]
-        with lock:
+    def get_late_filename(self, slug):
+        return os.path.join(self.path, 'late', slug + '.csv')
+
+    def get_database(self, slug):
+        # Should be called with the series lock held
+        return self.databases.get(slug)
+
+    def get_pool_stats(self):
+        """
+        Returns the number of databases open and the number allowed, and
+        how often a database was found open, had to be opened, and was
+        closed to make room or for being idle.
+        """
+        return self.databases.stats()
+
+    def create(self, slug, series_type, start, interval, archives, timezone_name, reorder_window=0):
+        with self.databases.lock(slug):
             tsdb_filename, csv_filename = self.get_filenames(slug)
             if os.path.exists(tsdb_filename):
                 raise SeriesAlreadyExists
-            db = TimeSeriesDatabase.create(tsdb_filename, series_type, start, interval, archives, timezone_name)
+            db = TimeSeriesDatabase.create(tsdb_filename, series_type, start, interval, archives, timezone_name,
+                                           reorder_window)
             with open(csv_filename, 'w') as f:
                 pass
-            with self.main_lock:
-                self.databases[slug] = db
+            self.databases.put(slug, db)
 
     def delete(self, slug):
-        with self.main_lock:
-            lock = self.locks[slug]
-            with lock:
-                if slug in self.databases:
-                    self.databases.pop(slug).close()
-                for filename in self.get_filenames(slug):
-                    os.unlink(filename)
+        with self.databases.lock(slug):
+            db = self.databases.pop(slug)
+            if db:
+                db.close()
+            self.buffers.pop(slug, None)
+            for filename in self.get_filenames(slug):
+                os.unlink(filename)
+            if os.path.exists(self.get_late_filename(slug)):
+                os.unlink(self.get_late_filename(slug))
+
+    def reconfigure(self, slug, archives):
+        with self.databases.lock(slug):
+            db = self.get_database(slug)
+            db = db.reconfigure(archives)
+            self.databases.put(slug, db)
+
+    def replace(self, slug, filename, csv_offset=0):
+        """
+        Swaps in a database rebuilt elsewhere from the CSV archive, after
+        catching it up with anything appended beyond csv_offset.
+        """
+        with self.databases.lock(slug):
+            tsdb_filename, csv_filename = self.get_filenames(slug)
+            db = TimeSeriesDatabase(filename)
+            with open(csv_filename, 'rb') as csv_file:
+                csv_file.seek(csv_offset)
+                readings = list(read_csv_readings(csv_file))
+            if readings:
+                db.update_epoch(*map(list, zip(*readings)))
+            db.flush()
+            os.rename(filename, tsdb_filename)
+            old_db = self.databases.put(slug, db)
+            if old_db:
+                old_db.close()
 
     @with_db
     def get_config(self, db):
         archives = []
         for archive in db.archives:
-            archives.append(dict((k, archive[k]) for k in ('aggregation_type', 'aggregation', 'count')))
-        return {'start': db.start,
-                'interval': db.interval,
-                'series_type': db.series_type,
-                'timezone_name': db.timezone_name,
-                'archives': archives}
-
-    @with_db(with_csv=True)
-    def append(self, db, csv_writer, readings):
-        last, tz = db.last, db.timezone
-        readings = sorted((r[0].astimezone(tz), float(r[1])) for r in readings if r[0] > last)
-        for ts, val in readings:
-            csv_writer.writerow([ts.isoformat('T'), val])
-        db.update(readings)
+            archive_config = dict((k, archive[k]) for k in ('aggregation_type', 'aggregation', 'count'))
+            if archive['encoding'] != 'float32':
+                archive_config.update((k, archive[k]) for k in ('encoding', 'scale', 'value_offset'))
+            if archive['kind'] != 'ring':
+                archive_config['kind'] = archive['kind']
+            archives.append(archive_config)
+        config = {'start': db.start,
+                  'interval': db.interval,
+                  'series_type': db.series_type,
+                  'timezone_name': db.timezone_name,
+                  'archives': archives}
+        if db.reorder_window:
+            config['reorder_window'] = db.reorder_window
+        return config
+
+    def append(self, slug, readings):
+        return self.append_epoch(slug, [_to_timestamp(r[0]) for r in readings], [r[1] for r in readings])
+
+    def append_epoch(self, slug, timestamps, values):
+        """
+        Appends readings given as epoch timestamps and their values, which is
+        how DatabaseClient sends them.
+        """
+        result, sequence = self._append(slug, zip(timestamps, values))
+        if sequence:
+            # Outside the series lock, so others can join the same commit
+            self.log.commit(sequence)
+        return result
+
+    def append_many(self, appends):
+        return self.append_many_epoch([(slug, [_to_timestamp(r[0]) for r in readings], [r[1] for r in readings])
+                                       for slug, readings in appends])
+
+    def append_many_epoch(self, appends):
+        """
+        Appends readings to several series, given as (slug, timestamps,
+        values) triples, waiting once for them all to be committed. Returns
+        the result of each append in order, with the exception raised in
+        place of any that failed.
+        """
+        results, last_sequence = [], None
+        for slug, timestamps, values in appends:
+            try:
+                result, sequence = self._append(slug, zip(timestamps, values))
+            except Exception, e:
+                results.append(e)
+                continue
+            results.append(result)
+            if sequence:
+                last_sequence = max(last_sequence, sequence)
+        if last_sequence:
+            # Which commits those before it too
+            self.log.commit(last_sequence)
+        return results
+
+    def _append(self, slug, readings):
+        """
+        Appends readings to a series, returning the result and the sequence
+        number of the log record to wait for, if any.
+        """
+        with self.databases.lock(slug):
+            return self._append_to(self.get_database(slug), slug, readings)
+
+    def _append_to(self, db, slug, readings):
+        # Should be called with the series lock held
+        last = _to_timestamp(db.last)
+        readings = [(ts, float(val)) for ts, val in readings]
+        late = [(ts, val) for ts, val in readings if ts <= last]
+        readings = [(ts, val) for ts, val in readings if ts > last]
+        if late:
+            self._write_late(db, slug, late)
+        sequence = None
+        if readings:
+            if self.log:
+                sequence = self.log.write(slug, *map(list, zip(*readings)))
+            try:
+                self.buffers.setdefault(slug, {}).update(readings)
+                self._commit_buffered(db, slug)
+            finally:
+                if self.log:
+                    self.log.applied()
         return {'appended': len(readings),
-                'last': db.last}
+                'late': len(late),
+                'pending': len(self.buffers.get(slug, ())),
+                'last': db.last}, sequence
+
+    def _commit_buffered(self, db, slug, csv_last=None):
+        """
+        Commits those readings held back for a series that have passed out
+        of its reorder window, which ends reorder_window seconds before the
+        later of now and the newest reading. Readings already in the CSV
+        archive, up to csv_last, aren't written to it again.
+        """
+        buffer = self.buffers.get(slug)
+        if not buffer:
+            return
+        horizon = max(max(buffer), time.time()) - db.reorder_window
+        timestamps = sorted(ts for ts in buffer if ts <= horizon)
+        if not timestamps:
+            return
+        values = [buffer.pop(ts) for ts in timestamps]
+        tz = db.timezone
+        with open(self.get_filenames(slug)[1], 'ab') as csv_file:
+            csv_writer = csv.writer(csv_file)
+            for ts, val in zip(timestamps, values):
+                if csv_last is None or ts > csv_last:
+                    csv_writer.writerow([_from_timestamp(ts).astimezone(tz).isoformat('T'), val])
+        db.update_epoch(timestamps, values)
+
+    def _write_late(self, db, slug, readings):
+        """
+        Sets aside readings no later than those already committed, in a CSV
+        file of their own.
+        """
+        tz = db.timezone
+        with open(self.get_late_filename(slug), 'ab') as late_file:
+            csv_writer = csv.writer(late_file)
+            for ts, val in readings:
+                csv_writer.writerow([_from_timestamp(ts).astimezone(tz).isoformat('T'), val])
+        logger.warning("%d late readings for %s set aside (should be after '%s')", len(readings), slug, db.last)
+
+    def commit_buffered(self):
+        """
+        Commits readings held back for reordering whose windows have passed.
+        """
+        with self.main_lock:
+            slugs = [slug for slug, buffer in self.buffers.items() if buffer]
+        for slug in slugs:
+            with self.databases.lock(slug):
+                if self.log:
+                    self.log.hold()
+                try:
+                    self._commit_buffered(self.get_database(slug), slug)
+                except SeriesNotFound:
+                    self.buffers.pop(slug, None)
+                finally:
+                    if self.log:
+                        self.log.applied()
+
+    def replay(self, slug, timestamps, values):
+        """
+        Reapplies readings from the write-ahead log, through the series'
+        reorder buffer, adding to the CSV archive any it doesn't already end
+        with.
+        """
+        with self.databases.lock(slug):
+            try:
+                db = self.get_database(slug)
+            except SeriesNotFound:
+                logger.warning("Not replaying readings for deleted series %s", slug)
+                return
+            # Anything up to the last reading was applied before we stopped
+            last = _to_timestamp(db.last)
+            self.buffers.setdefault(slug, {}).update((ts, val) for ts, val in zip(timestamps, values) if ts > last)
+            self._commit_buffered(db, slug, _csv_last_timestamp(self.get_filenames(slug)[1]))
 
     @with_db
-    def fetch(self, db, aggregation_type, interval, period_start, period_end):
-        return list(db.fetch(aggregation_type, interval, period_start, period_end))
+    def fetch(self, db, aggregation_type, interval, period_start, period_end, points=None, method='lttb'):
+        result = db.fetch(aggregation_type, interval, period_start, period_end)
+        if points:
+            # Downsample here, so as to send back only what will be used
+            result = result.downsample(points, method)
+        return result
+
+    def fetch_many(self, requests):
+        """
+        Makes several fetches, each given as a tuple of fetch()'s arguments,
+        those from different series at the same time. Returns their results
+        in order, with the exception raised in place of any that failed.
+        """
+        results, by_slug = [None] * len(requests), {}
+        for i, request in enumerate(requests):
+            by_slug.setdefault(request[0], []).append(i)
+        def fetch(indices):
+            for i in indices:
+                try:
+                    results[i] = self.fetch(*requests[i])
+                except Exception, e:
+                    results[i] = e
+        groups = by_slug.values()
+        threads = min(len(groups), self.fetch_many_threads)
+        if threads:
+            in_parallel([(fetch, (sum(groups[thread::threads], []),)) for thread in xrange(threads)])
+        return results
+
+    @with_db
+    def aggregate(self, db, aggregation_type, interval, period_start, period_end):
+        return db.aggregate(aggregation_type, interval, period_start, period_end)
+
+class DatabaseClient(protocol.Client):
+    """
+    A connection to the long-living process, with the exposed methods of
+    _DatabaseClient.
+    """
+    def append(self, slug, readings):
+        # Saves sending a datetime for each reading
+        return self.append_epoch(slug, [_to_timestamp(r[0]) for r in readings], [float(r[1]) for r in readings])
+
+    def append_many(self, appends):
+        return self.append_many_epoch([(slug, [_to_timestamp(r[0]) for r in readings],
+                                        [float(r[1]) for r in readings]) for slug, readings in appends])
+
+class ClientPool(object):
+    """
+    Connections to a server, kept open between calls so that each call
+    needn't connect and authenticate afresh. Stands in for a DatabaseClient,
+    taking an idle connection for each call and putting it back afterwards,
+    so may be shared by every thread in a process. Connections the server
+    has closed, as it does on restarting, are replaced with new ones. After
+    a fork, the child starts afresh rather than share the parent's sockets.
+    """
+    def __init__(self, connect, max_idle=4):
+        self.connect, self.max_idle = connect, max_idle
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def connection(self):
+        if self._pid != os.getpid():
+            # Closing our copies of the parent's sockets leaves its own open
+            for connection in self._idle:
+                connection.close()
+            self._reset()
+        connection = None
+        while connection is None:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            if not connection.usable():
+                connection.close()
+                connection = None
+        if connection is None:
+            connection = self.connect()
+        try:
+            yield connection
+        finally:
+            # Those that failed will have closed themselves
+            if not connection.closed:
+                with self._lock:
+                    if len(self._idle) < self.max_idle:
+                        self._idle.append(connection)
+                        connection = None
+                if connection is not None:
+                    connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+    def call_many(self, calls):
+        with self.connection() as connection:
+            return connection.call_many(calls)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            with self.connection() as connection:
+                return getattr(connection, name)(*args, **kwargs)
+        return call
+
+def _connect(server_args):
+    return DatabaseClient(server_args['address'], server_args['authkey'],
+                          getattr(settings, 'TIME_SERIES_CLIENT_TIMEOUT', 30))
+
+def _pool(server_args):
+    return ClientPool(functools.partial(_connect, server_args),
+                      getattr(settings, 'TIME_SERIES_CLIENT_POOL_SIZE', 4))
+
+_client = None
 
 def get_client():
-    manager = multiprocessing.managers.BaseManager(**settings.TIME_SERIES_SERVER_ARGS)
-    manager.connect()
-    return manager.get_client()
+    """
+    Returns the client of the long-living process shared by this process,
+    which keeps its connections open between calls.
+    """
+    global _client
+    if _client is None:
+        server_args = get_server_args()
+        if len(server_args) == 1:
+            _client = _pool(server_args[0])
+        else:
+            _client = ShardedClient(server_args)
+    return _client
+
+def in_parallel(calls):
+    """
+    Makes each of calls, a list of (function, args) pairs, in a thread of
+    its own, returning their results in order, or raising the first
+    exception raised.
+    """
+    if len(calls) == 1:
+        function, args = calls[0]
+        return [function(*args)]
+    results, errors = [None] * len(calls), [None] * len(calls)
+    def call(i, function, args):
+        try:
+            results[i] = function(*args)
+        except Exception:
+            errors[i] = sys.exc_info()
+    threads = [threading.Thread(target=call, args=(i, function, args)) for i, (function, args) in enumerate(calls)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for error in errors:
+        if error:
+            raise error[0], error[1], error[2]
+    return results
+
+class ShardedClient(object):
+    """
+    Stands in for the client of a single long-living process when there are
+    several shards, passing each call about a series to the shard that owns
+    it. Calls about every series go to every shard at once.
+    """
+    _routed = frozenset(['create', 'delete', 'reconfigure', 'replace', 'get_config', 'append', 'append_epoch',
+                         'fetch', 'aggregate'])
+
+    def __init__(self, server_args):
+        self.server_args = server_args
+        self._clients = {}
+
+    def get_shard_client(self, shard):
+        # Connects only to those shards asked about
+        client = self._clients.get(shard)
+        if client is None:
+            client = self._clients.setdefault(shard, _pool(self.server_args[shard]))
+        return client
+
+    def __getattr__(self, name):
+        if name not in self._routed:
+            raise AttributeError(name)
+        def call(slug, *args, **kwargs):
+            client = self.get_shard_client(get_shard(slug, len(self.server_args)))
+            return getattr(client, name)(slug, *args, **kwargs)
+        return call
+
+    def get_pool_stats(self):
+        stats = in_parallel([(lambda shard: self.get_shard_client(shard).get_pool_stats(), (shard,))
+                             for shard in xrange(len(self.server_args))])
+        return dict((key, sum(s[key] for s in stats)) for key in stats[0])
+
+    def _scatter(self, name, requests):
+        """
+        Calls the named method of each shard concerned at once, with those of
+        requests, each a tuple starting with a slug, that are about its
+        series. Returns the results in the order of requests.
+        """
+        by_shard = {}
+        for i, request in enumerate(requests):
+            by_shard.setdefault(get_shard(request[0], len(self.server_args)), []).append(i)
+        shards = by_shard.items()
+        shard_results = in_parallel([(getattr(self.get_shard_client(shard), name), ([requests[i] for i in indices],))
+                                     for shard, indices in shards])
+        results = [None] * len(requests)
+        for (shard, indices), values in zip(shards, shard_results):
+            for i, value in zip(indices, values):
+                results[i] = value
+        return results
+
+    def fetch_many(self, requests):
+        return self._scatter('fetch_many', requests)
+
+    def append_many(self, appends):
+        return self._scatter('append_many', appends)
+
+class DatabaseReader(object):
+    """
+    Fetches from databases by mapping their files read-only, rather than by
+    asking the long-living process, which remains their only writer. Each
+    thread keeps up to max_open databases open, closing the least recently
+    used to make room, and reopening any whose files have since been
+    replaced or deleted. Version 1 databases can't be checked for
+    consistency, so are fetched from through the long-living process, as are
+    those that couldn't be read consistently.
+    """
+    def __init__(self, path, max_open=64):
+        self.path = path
+        self.max_open = max_open
+        self._local = threading.local()
+
+    def get_database(self, slug):
+        databases = getattr(self._local, 'databases', None)
+        if databases is None:
+            # Only this thread uses it, so a database isn't closed while in use
+            databases = self._local.databases = DatabasePool(self.open_database, self.close_database,
+                                                             max_open=self.max_open)
+        with databases.lock(slug):
+            db = databases.get(slug)
+            if os.fstat(db.fileno()).st_nlink == 0:
+                databases.pop(slug).close()
+                db = databases.get(slug)
+        return db
+
+    def open_database(self, slug):
+        try:
+            return TimeSeriesDatabase(os.path.join(self.path, 'tsdb', slug + '.tsdb'), readonly=True)
+        except IOError:
+            raise SeriesNotFound
+
+    def close_database(self, slug, db):
+        db.close()
+
+    def fetch(self, slug, aggregation_type, interval, period_start, period_end, points=None, method='lttb'):
+        db = self.get_database(slug)
+        if db.version < 2:
+            return get_client().fetch(slug, aggregation_type, interval, period_start, period_end, points, method)
+        try:
+            result = db.fetch(aggregation_type, interval, period_start, period_end)
+        except InconsistentRead:
+            return get_client().fetch(slug, aggregation_type, interval, period_start, period_end, points, method)
+        if points:
+            result = result.downsample(points, method)
+        return result
+
+    def fetch_many(self, requests):
+        results = []
+        for request in requests:
+            try:
+                results.append(self.fetch(*request))
+            except Exception, e:
+                results.append(e)
+        return results
+
+    def aggregate(self, slug, aggregation_type, interval, period_start, period_end):
+        db = self.get_database(slug)
+        if db.version < 2:
+            return get_client().aggregate(slug, aggregation_type, interval, period_start, period_end)
+        try:
+            return db.aggregate(aggregation_type, interval, period_start, period_end)
+        except InconsistentRead:
+            return get_client().aggregate(slug, aggregation_type, interval, period_start, period_end)
+
+_reader = None
+
+def get_reader():
+    global _reader
+    if _reader is None:
+        _reader = DatabaseReader(settings.TIME_SERIES_PATH, getattr(settings, 'TIME_SERIES_READER_MAX_OPEN', 64))
+    return _reader
 
 def run():
     bail = threading.Event()
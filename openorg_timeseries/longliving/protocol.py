@@ -0,0 +1,482 @@
+"""
+The protocol spoken between the long-living process and its clients.
+
+Each message is a frame: a four-byte little-endian length, then that many
+bytes of body. A connection starts with the server sending a random
+challenge, to which the client replies with its HMAC under the shared
+authkey. After that, each request is a request id, a method name and its
+encoded arguments, and each response is the id of the request it answers,
+a status and the encoded result or exception. Requests are answered in
+order, and a client may send several before reading any of the responses.
+
+Values are not pickled. Those made only of built-in types are marshalled,
+and others are encoded with a type tag and a fixed-width or length-prefixed
+representation. Datetimes travel as epoch seconds, and fetched samples as
+their start and step and their values packed as floats, so that neither side
+builds a datetime for each sample.
+"""
+
+from __future__ import with_statement
+
+import array
+import calendar
+import datetime
+import functools
+import hashlib
+import hmac
+import marshal
+import os
+import select
+import socket
+import SocketServer
+import struct
+import sys
+import threading
+
+import pytz
+
+from openorg_timeseries.database import FetchResult, DownsampledResult
+
+class ProtocolError(Exception): pass
+class AuthenticationError(ProtocolError): pass
+class RemoteError(Exception):
+    """
+    Raised for an exception in the long-living process that can't be
+    raised as itself.
+    """
+
+_frame_header = struct.Struct('<L')
+# Request id and length of method name
+_request_header = struct.Struct('<LH')
+# Request id and status
+_response_header = struct.Struct('<LB')
+_OK, _ERROR = 0, 1
+
+_challenge_size = 20
+
+def send_frame(sock, body):
+    sock.sendall(_frame_header.pack(len(body)) + body)
+
+class FrameReader(object):
+    """
+    Reads frames from a socket. Socket file objects are written in Python,
+    and so too slow for the many small reads of a frame at a time; this
+    reads whatever has arrived and splits it into frames itself.
+    """
+    def __init__(self, sock):
+        self._socket, self._buffer = sock, ''
+
+    def _fill(self, size):
+        # Joined once at the end, as adding each chunk to the buffer in turn
+        # would copy it over and over for a large frame
+        chunks, length = [self._buffer], len(self._buffer)
+        try:
+            while length < size:
+                data = self._socket.recv(max(size - length, 65536))
+                if not data:
+                    raise EOFError
+                chunks.append(data)
+                length += len(data)
+        finally:
+            self._buffer = ''.join(chunks)
+
+    def read(self):
+        self._fill(_frame_header.size)
+        length, = _frame_header.unpack_from(self._buffer)
+        end = _frame_header.size + length
+        self._fill(end)
+        body, self._buffer = self._buffer[_frame_header.size:end], self._buffer[end:]
+        return body
+
+def _digest(authkey, challenge):
+    return hmac.new(authkey, challenge, hashlib.sha256).digest()
+
+def _compare_digest(a, b):
+    # hmac.compare_digest is only in Python 2.7.7 and later
+    if len(a) != len(b):
+        return False
+    return reduce(lambda result, (x, y): result | (ord(x) ^ ord(y)), zip(a, b), 0) == 0
+
+
+# Values
+
+# Arrays of these are sent as they are, and others as 64-bit integers
+_float_typecodes = 'fd'
+_int64 = struct.Struct('<q')
+_double = struct.Struct('<d')
+_length = struct.Struct('<L')
+_datetime = struct.Struct('<qL')
+_range = struct.Struct('<qq')
+
+def encode(value):
+    # marshal is quickest for the plain values most calls deal in. It
+    # refuses most else, but writes anything with a buffer, such as an
+    # array, as a string, so is checked to give back what it was given.
+    try:
+        data = marshal.dumps(value, 2)
+        if marshal.loads(data) == value:
+            return 'M' + data
+    except ValueError:
+        pass
+    parts = []
+    _encode(value, parts.append)
+    return ''.join(parts)
+
+def _encode_array(value, write):
+    if value.typecode in _float_typecodes:
+        if sys.byteorder == 'big':
+            value = array.array(value.typecode, value)
+            value.byteswap()
+        write('a' + value.typecode + _length.pack(len(value)) + value.tostring())
+    else:
+        write('q' + _length.pack(len(value)) + struct.pack('<%dq' % len(value), *value))
+
+def _encode_int(value, write):
+    if -2 ** 63 <= value < 2 ** 63:
+        write('i' + _int64.pack(value))
+    else:
+        value = str(value)
+        write('I' + _length.pack(len(value)) + value)
+
+def _encode_unicode(value, write):
+    value = value.encode('utf-8')
+    write('u' + _length.pack(len(value)) + value)
+
+def _encode_datetime(value, write):
+    # Naive datetimes are taken to be in UTC, and come back naive
+    zone = ''
+    if value.tzinfo is not None:
+        zone = getattr(value.tzinfo, 'zone', None) or 'UTC'
+    write('D' + _datetime.pack(calendar.timegm(value.utctimetuple()), value.microsecond)
+          + 's' + _length.pack(len(zone)) + zone)
+
+def _encode_fetch_result(value, write):
+    write('R' + _range.pack(value.start, value.step))
+    _encode(value.timezone_name, write)
+    _encode_array(value.values, write)
+
+def _encode_downsampled_result(value, write):
+    write('S' + _range.pack(value.start, value.step))
+    _encode(value.timezone_name, write)
+    _encode_array(value.indices, write)
+    _encode_array(value.values, write)
+
+def _encode_sequence(value, write):
+    write(('l' if isinstance(value, list) else 't') + _length.pack(len(value)))
+    for item in value:
+        _encode(item, write)
+
+def _encode_dict(value, write):
+    write('m' + _length.pack(len(value)))
+    for key, item in value.iteritems():
+        _encode(key, write)
+        _encode(item, write)
+
+def _encode_exception(value, write):
+    args = []
+    try:
+        _encode(value.args, args.append)
+    except TypeError:
+        args = []
+        _encode((str(value),), args.append)
+    write('E')
+    _encode(type(value).__module__, write)
+    _encode(type(value).__name__, write)
+    write(''.join(args))
+
+# Looked up by exact type, as that's quicker than a chain of isinstance()
+# tests for each value; subclasses fall back to _encoder_bases.
+_encoders = {type(None): lambda value, write: write('N'),
+             bool: lambda value, write: write('T' if value else 'F'),
+             int: _encode_int,
+             long: _encode_int,
+             float: lambda value, write: write('d' + _double.pack(value)),
+             str: lambda value, write: write('s' + _length.pack(len(value)) + value),
+             unicode: _encode_unicode,
+             datetime.datetime: _encode_datetime,
+             FetchResult: _encode_fetch_result,
+             DownsampledResult: _encode_downsampled_result,
+             array.array: _encode_array,
+             list: _encode_sequence,
+             tuple: _encode_sequence,
+             dict: _encode_dict}
+_encoder_bases = [(DownsampledResult, _encode_downsampled_result),
+                  (FetchResult, _encode_fetch_result),
+                  (BaseException, _encode_exception),
+                  (datetime.datetime, _encode_datetime),
+                  ((int, long), _encode_int),
+                  (float, _encoders[float]),
+                  (str, _encoders[str]),
+                  (unicode, _encode_unicode),
+                  ((list, tuple), _encode_sequence),
+                  (dict, _encode_dict)]
+
+def _encode(value, write):
+    encoder = _encoders.get(type(value))
+    if encoder is None:
+        for base, encoder in _encoder_bases:
+            if isinstance(value, base):
+                break
+        else:
+            raise TypeError("Can't encode %r" % (value,))
+    encoder(value, write)
+
+def decode(data, offset=0):
+    if data[offset] == 'M':
+        return marshal.loads(buffer(data, offset + 1))
+    value, offset = _decode(data, offset)
+    return value
+
+def _decode_string(data, offset):
+    length, = _length.unpack_from(data, offset)
+    return data[offset + 4:offset + 4 + length], offset + 4 + length
+
+def _decode_long(data, offset):
+    value, offset = _decode_string(data, offset)
+    return long(value), offset
+
+def _decode_unicode(data, offset):
+    value, offset = _decode_string(data, offset)
+    return value.decode('utf-8'), offset
+
+def _decode_datetime(data, offset):
+    timestamp, microsecond = _datetime.unpack_from(data, offset)
+    zone, offset = _decode(data, offset + _datetime.size)
+    if zone:
+        value = datetime.datetime.fromtimestamp(timestamp, pytz.timezone(zone))
+    else:
+        value = datetime.datetime.utcfromtimestamp(timestamp)
+    return value.replace(microsecond=microsecond), offset
+
+def _decode_fetch_result(data, offset):
+    start, step = _range.unpack_from(data, offset)
+    timezone_name, offset = _decode(data, offset + _range.size)
+    values, offset = _decode(data, offset)
+    return FetchResult(start, step, values, timezone_name), offset
+
+def _decode_downsampled_result(data, offset):
+    start, step = _range.unpack_from(data, offset)
+    timezone_name, offset = _decode(data, offset + _range.size)
+    indices, offset = _decode(data, offset)
+    values, offset = _decode(data, offset)
+    return DownsampledResult(start, step, array.array('L', indices), values, timezone_name), offset
+
+def _decode_array(data, offset):
+    typecode = data[offset]
+    length, = _length.unpack_from(data, offset + 1)
+    offset += 5
+    size = length * array.array(typecode).itemsize
+    value = array.array(typecode, data[offset:offset + size])
+    if sys.byteorder == 'big':
+        value.byteswap()
+    return value, offset + size
+
+def _decode_integers(data, offset):
+    length, = _length.unpack_from(data, offset)
+    offset += 4
+    return list(struct.unpack_from('<%dq' % length, data, offset)), offset + 8 * length
+
+def _decode_list(data, offset):
+    length, = _length.unpack_from(data, offset)
+    offset += 4
+    items = []
+    for i in xrange(length):
+        item, offset = _decode(data, offset)
+        items.append(item)
+    return items, offset
+
+def _decode_tuple(data, offset):
+    items, offset = _decode_list(data, offset)
+    return tuple(items), offset
+
+def _decode_dict(data, offset):
+    length, = _length.unpack_from(data, offset)
+    offset += 4
+    items = {}
+    for i in xrange(length):
+        key, offset = _decode(data, offset)
+        items[key], offset = _decode(data, offset)
+    return items, offset
+
+def _decode_exception(data, offset):
+    module, offset = _decode(data, offset)
+    name, offset = _decode(data, offset)
+    args, offset = _decode(data, offset)
+    return _exception(module, name, args), offset
+
+_decoders = {'N': lambda data, offset: (None, offset),
+             'T': lambda data, offset: (True, offset),
+             'F': lambda data, offset: (False, offset),
+             'i': lambda data, offset: (_int64.unpack_from(data, offset)[0], offset + 8),
+             'I': _decode_long,
+             'd': lambda data, offset: (_double.unpack_from(data, offset)[0], offset + 8),
+             's': _decode_string,
+             'u': _decode_unicode,
+             'D': _decode_datetime,
+             'R': _decode_fetch_result,
+             'S': _decode_downsampled_result,
+             'a': _decode_array,
+             'q': _decode_integers,
+             'l': _decode_list,
+             't': _decode_tuple,
+             'm': _decode_dict,
+             'E': _decode_exception}
+
+def _decode(data, offset):
+    try:
+        decoder = _decoders[data[offset]]
+    except KeyError:
+        raise ProtocolError("Unknown type tag %r" % data[offset])
+    return decoder(data, offset + 1)
+
+def _exception(module, name, args):
+    cls = getattr(sys.modules.get(module), name, None)
+    if isinstance(cls, type) and issubclass(cls, BaseException):
+        try:
+            return cls(*args)
+        except Exception:
+            pass
+    return RemoteError('%s.%s%r' % (module, name, args))
+
+
+# Server
+
+class _RequestHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        self.connection = self.request
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        frames = FrameReader(self.connection)
+        challenge = os.urandom(_challenge_size)
+        send_frame(self.connection, challenge)
+        try:
+            response = frames.read()
+        except (EOFError, socket.error):
+            return
+        if not _compare_digest(response, _digest(self.server.authkey, challenge)):
+            send_frame(self.connection, 'FAIL')
+            return
+        send_frame(self.connection, 'OK')
+
+        while True:
+            try:
+                body = frames.read()
+            except (EOFError, socket.error):
+                return
+            request_id, name_length = _request_header.unpack_from(body)
+            offset = _request_header.size
+            name = body[offset:offset + name_length]
+            try:
+                if name not in self.server.exposed:
+                    raise AttributeError("No such method: %s" % name)
+                args, kwargs = decode(body, offset + name_length)
+                result = getattr(self.server.target, name)(*args, **kwargs)
+                response = _response_header.pack(request_id, _OK) + encode(result)
+            except Exception, e:
+                response = _response_header.pack(request_id, _ERROR) + encode(e)
+            try:
+                send_frame(self.connection, response)
+            except socket.error:
+                return
+
+class Server(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Serves calls to the exposed methods of target, with a thread for each
+    connection.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, authkey, target, exposed):
+        self.authkey, self.target, self.exposed = authkey, target, frozenset(exposed)
+        SocketServer.TCPServer.__init__(self, address, _RequestHandler)
+
+
+# Client
+
+class Client(object):
+    """
+    A connection to a Server, on which any exposed method of its target can
+    be called as a method. Calls may be made from several threads, but are
+    then made one at a time; call_many() sends several calls at once. If
+    timeout is given, a call that waits longer than that many seconds on the
+    server raises socket.timeout, and the connection is closed.
+    """
+    closed = False
+
+    def __init__(self, address, authkey, timeout=None):
+        self._socket = socket.create_connection(address, timeout)
+        try:
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._frames = FrameReader(self._socket)
+            challenge = self._frames.read()
+            send_frame(self._socket, _digest(authkey, challenge))
+            if self._frames.read() != 'OK':
+                raise AuthenticationError("The long-living process didn't accept our authkey.")
+        except:
+            self._socket.close()
+            raise
+        self._lock = threading.Lock()
+        self._request_id = 0
+
+    def call(self, name, *args, **kwargs):
+        return self.call_many([(name, args, kwargs)])[0]
+
+    def call_many(self, calls):
+        """
+        Sends each of calls, (name, args, kwargs) triples, before reading
+        any of the responses, returning their results in order. If any
+        raised an exception, the first is raised once all are read.
+        """
+        with self._lock:
+            try:
+                return self._call_many(calls)
+            except (EOFError, socket.error, ProtocolError):
+                # The stream can't be trusted to be in step any more
+                self.close()
+                raise
+
+    def _call_many(self, calls):
+        frames, request_ids = [], []
+        for name, args, kwargs in calls:
+            self._request_id = (self._request_id + 1) & 0xffffffff
+            request_ids.append(self._request_id)
+            body = _request_header.pack(self._request_id, len(name)) + name + encode((tuple(args), kwargs))
+            frames.append(_frame_header.pack(len(body)) + body)
+        self._socket.sendall(''.join(frames))
+
+        results, error = [], None
+        for request_id in request_ids:
+            body = self._frames.read()
+            response_id, status = _response_header.unpack_from(body)
+            if response_id != request_id:
+                raise ProtocolError("Expected a response to request %d, not %d" % (request_id, response_id))
+            result = decode(body, _response_header.size)
+            if status == _ERROR and error is None:
+                error = result
+            results.append(result)
+        if error is not None:
+            raise error
+        return results
+
+    def usable(self):
+        """
+        Returns whether the connection is still open at both ends. Nothing
+        is sent unasked, so if there is anything to read between calls, the
+        server has closed the connection, as it does on stopping.
+        """
+        if self.closed:
+            return False
+        try:
+            readable, _, _ = select.select([self._socket], [], [], 0)
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def close(self):
+        self.closed = True
+        self._socket.close()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return functools.partial(self.call, name)
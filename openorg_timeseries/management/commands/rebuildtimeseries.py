@@ -0,0 +1,115 @@
+from __future__ import with_statement
+
+import datetime
+import itertools
+import multiprocessing
+import os
+import socket
+import time
+from optparse import make_option
+
+import pytz
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from openorg_timeseries.database import TimeSeriesDatabase
+from openorg_timeseries.longliving.database import get_client, read_csv_readings
+from openorg_timeseries.models import TimeSeries
+
+def rebuild(job):
+    """
+    Builds a new database for a series alongside its existing one, from
+    its CSV archive as it stands. Returns the slug, the new filename, the
+    length of CSV read, the number of readings, the time taken and any error.
+    """
+    slug, config, batch_size = job
+    started = time.time()
+    path = settings.TIME_SERIES_PATH
+    tsdb_filename = os.path.join(path, 'tsdb', slug + '.tsdb.rebuild')
+    csv_filename = os.path.join(path, 'csv', slug + '.csv')
+    try:
+        if os.path.exists(tsdb_filename):
+            os.unlink(tsdb_filename)
+        db = TimeSeriesDatabase.create(tsdb_filename, **config)
+        count, end = 0, os.path.getsize(csv_filename)
+        with open(csv_filename, 'rb') as csv_file:
+            readings = read_csv_readings(csv_file, end)
+            while True:
+                batch = list(itertools.islice(readings, batch_size))
+                if not batch:
+                    break
+                timestamps, values = map(list, zip(*batch))
+                db.update_epoch(timestamps, values)
+                count += len(batch)
+        db.flush()
+        db.close()
+        return slug, tsdb_filename, end, count, time.time() - started, None
+    except Exception, e:
+        if os.path.exists(tsdb_filename):
+            os.unlink(tsdb_filename)
+        return slug, None, None, 0, time.time() - started, e
+
+class Command(BaseCommand):
+    args = '[slug ...]'
+    help = ("Rebuilds time-series databases from their CSV archives, using each series' current "
+            "configuration. If the long-living database process is running, it swaps in each "
+            "rebuilt database once it has caught up with any readings appended meanwhile.")
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help='Number of worker processes (defaults to the number of CPUs)'),
+        make_option('--batch-size', type='int', dest='batch_size', default=10000,
+                    help='Number of readings to ingest at a time'),
+    )
+
+    def handle(self, *slugs, **options):
+        series = TimeSeries.objects.filter(is_virtual=False).order_by('slug')
+        if slugs:
+            series = series.filter(slug__in=slugs)
+            missing = set(slugs) - set(s.slug for s in series)
+            if missing:
+                raise CommandError("No such real time-series: %s" % ', '.join(sorted(missing)))
+        jobs = [(s.slug, s.config, options['batch_size']) for s in series]
+
+        try:
+            client = get_client()
+            # Checks that every shard is running
+            client.get_pool_stats()
+        except socket.error:
+            client = None
+            self.stdout.write("The long-living database process isn't running, so replacing files directly.\n")
+
+        started, rebuilt, failed, total_count = time.time(), 0, 0, 0
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            for slug, filename, csv_offset, count, duration, error in pool.imap_unordered(rebuild, jobs):
+                if not error:
+                    try:
+                        if client:
+                            client.replace(slug, filename, csv_offset)
+                        else:
+                            os.rename(filename, os.path.join(settings.TIME_SERIES_PATH, 'tsdb', slug + '.tsdb'))
+                        # So that conditional fetches see the readings have changed
+                        rebuilt_at = pytz.utc.localize(datetime.datetime.utcnow())
+                        TimeSeries.objects.filter(slug=slug).update(_rebuilt=rebuilt_at)
+                    except Exception, e:
+                        error = e
+                if error:
+                    failed += 1
+                    self.stderr.write("Failed to rebuild %s: %s\n" % (slug, error))
+                    continue
+                rebuilt, total_count = rebuilt + 1, total_count + count
+                if int(options['verbosity']) > 1:
+                    self.stdout.write("Rebuilt %s from %d readings in %.2fs (%.0f readings/s).\n"
+                                      % (slug, count, duration, count / max(duration, 1e-6)))
+        finally:
+            pool.close()
+            pool.join()
+
+        elapsed = time.time() - started
+        self.stdout.write("Rebuilt %d of %d time-series databases from %d readings in %.1fs "
+                          "(%.0f readings/s, %.1f series/s).\n"
+                          % (rebuilt, len(jobs), total_count, elapsed,
+                             total_count / max(elapsed, 1e-6), rebuilt / max(elapsed, 1e-6)))
+        if failed:
+            raise CommandError("%d time-series databases could not be rebuilt." % failed)
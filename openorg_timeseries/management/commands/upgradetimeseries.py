@@ -0,0 +1,51 @@
+from __future__ import with_statement
+
+import multiprocessing
+import os
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from openorg_timeseries.database import TimeSeriesDatabase
+
+def upgrade(filename):
+    try:
+        return filename, TimeSeriesDatabase.upgrade(filename), None
+    except Exception, e:
+        return filename, False, e
+
+class Command(BaseCommand):
+    args = '[slug ...]'
+    help = ("Converts time-series databases to the current file format in place. "
+            "Stop the long-living database process before running this.")
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help='Number of worker processes (defaults to the number of CPUs)'),
+    )
+
+    def handle(self, *slugs, **options):
+        path = os.path.join(settings.TIME_SERIES_PATH, 'tsdb')
+        if slugs:
+            filenames = [os.path.join(path, slug + '.tsdb') for slug in slugs]
+        else:
+            filenames = sorted(os.path.join(path, f) for f in os.listdir(path) if f.endswith('.tsdb'))
+
+        started, upgraded, failed = time.time(), 0, 0
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            for filename, was_upgraded, error in pool.imap_unordered(upgrade, filenames):
+                if error:
+                    failed += 1
+                    self.stderr.write("Failed to upgrade %s: %s\n" % (filename, error))
+                elif was_upgraded:
+                    upgraded += 1
+        finally:
+            pool.close()
+            pool.join()
+
+        self.stdout.write("Upgraded %d of %d time-series databases in %.1fs (%d already current).\n"
+                          % (upgraded, len(filenames), time.time() - started, len(filenames) - upgraded - failed))
+        if failed:
+            raise CommandError("%d time-series databases could not be upgraded." % failed)
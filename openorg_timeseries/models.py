@@ -6,12 +6,12 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.urlresolvers import reverse
 from django.db import IntegrityError
-from django.db import models
+from django.db import connection, models, transaction
 import object_permissions
 import pytz
 
 from . import combine
-from openorg_timeseries.longliving.database import get_client
+from openorg_timeseries.longliving.database import get_client, get_reader
 
 SERIES_TYPE_CHOICES = (
     ('counter', 'Counter'),
@@ -25,6 +25,18 @@ AGGREGATION_TYPE_CHOICES = (
     ('max', 'Maximum'),
 )
 
+ENCODING_CHOICES = (
+    ('float32', '32-bit float'),
+    ('float64', '64-bit float'),
+    ('float16', '16-bit float'),
+    ('int16', 'Scaled 16-bit integer'),
+)
+
+ARCHIVE_KIND_CHOICES = (
+    ('ring', 'Uncompressed'),
+    ('compressed', 'Compressed'),
+)
+
 class TimeSeries(models.Model):
     slug = models.SlugField(unique=True, db_index=True)
     title = models.CharField(max_length=80)
@@ -37,6 +49,9 @@ class TimeSeries(models.Model):
     _config = models.TextField(blank=True)
     _config_new = None
     _last = models.DateTimeField(null=True, blank=True)
+    # When the stored readings were last rebuilt, by reconfiguring archives
+    # or by replacing the database, neither of which changes _last
+    _rebuilt = models.DateTimeField(null=True, blank=True)
 
     # Virtual time-series data
     equation = models.TextField()
@@ -46,7 +61,7 @@ class TimeSeries(models.Model):
                                         blank=True)
 
     common_fields = ('slug', 'title', 'notes', 'is_public', 'is_virtual')
-    config_fields = ('interval', 'start', 'series_type', 'timezone_name')
+    config_fields = ('interval', 'start', 'series_type', 'timezone_name', 'reorder_window')
 
 
     def _get_config(self):
@@ -78,24 +93,43 @@ class TimeSeries(models.Model):
         if value.get('timezone_name') not in pytz.all_timezones:
             raise ValueError("timezone_name must be in the Olsen database (given %r)" % value.get('timezone_name'))
 
+        if value.get('reorder_window') is not None and not (isinstance(value['reorder_window'], int) and value['reorder_window'] >= 0):
+            raise ValueError("reorder_window member must be a non-negative integer")
+
 
-        archives = value.get('archives')
-        if not isinstance(archives, list):
-            raise ValueError("archives member must be a list")
+        self._check_archives(value.get('archives'))
+        self._config_new = value
+    config = property(_get_config, _set_config)
+
+    @staticmethod
+    def _check_archives(archives):
+        if not isinstance(archives, list) or not archives:
+            raise ValueError("archives member must be a non-empty list")
         for i, archive in enumerate(archives):
+            if not isinstance(archive, dict):
+                raise ValueError("element %d of archives must be an object" % i)
             if archive.get('aggregation_type') not in u'average min max'.split():
                 raise ValueError("aggregation_type for element %d must be one of {'average', 'min', 'max'}, not %r" % (i, archive.get('aggregation_type')))
-            if not isinstance(archive.get('count'), int):
-                raise ValueError("count for element %d must be an integer" % i)
-            if not isinstance(archive.get('aggregation'), int):
-                raise ValueError("aggregation for element %d must be an integer" % i)
-        self._config_new = value
-    config = property(_get_config, _set_config)
+            if not (isinstance(archive.get('count'), int) and archive['count'] > 0):
+                raise ValueError("count for element %d must be a positive integer" % i)
+            if not (isinstance(archive.get('aggregation'), int) and archive['aggregation'] > 0):
+                raise ValueError("aggregation for element %d must be a positive integer" % i)
+            if (archive.get('encoding') or 'float32') not in dict(ENCODING_CHOICES):
+                raise ValueError("encoding for element %d must be one of {'float32', 'float64', 'float16', 'int16'}, not %r" % (i, archive.get('encoding')))
+            if archive.get('scale') is not None and not (isinstance(archive['scale'], (int, float)) and archive['scale'] > 0):
+                raise ValueError("scale for element %d must be a positive number" % i)
+            if archive.get('value_offset') is not None and not isinstance(archive['value_offset'], (int, float)):
+                raise ValueError("value_offset for element %d must be a number" % i)
+            if (archive.get('kind') or 'ring') not in dict(ARCHIVE_KIND_CHOICES):
+                raise ValueError("kind for element %d must be one of {'ring', 'compressed'}, not %r" % (i, archive.get('kind')))
 
     def _get_last(self):
         if not self._last:
             return None
         tz = pytz.timezone(self.config['timezone_name'])
+        if self._last.tzinfo:
+            # As stored with USE_TZ
+            return self._last.astimezone(tz)
         return tz.localize(self._last)
     def _set_last(self, value):
         self._last = value.astimezone(pytz.utc)
@@ -149,9 +183,85 @@ class TimeSeries(models.Model):
         self.save()
         return result
 
-    def fetch(self, aggregation_type, interval, period_start=None, period_end=None):
+    @classmethod
+    def append_many(cls, appends):
+        """
+        Appends readings to each of several series as append() does, given
+        (series, readings) pairs, in one call to the long-living process and
+        one query to update when each was last appended to. Returns the
+        results in order, with the exception raised in place of any that
+        failed.
+        """
+        results = get_client().append_many([(series.slug, readings) for series, readings in appends])
+        lasts = []
+        for (series, readings), result in zip(appends, results):
+            if not isinstance(result, Exception):
+                series.last = result['last']
+                lasts.append((series.pk, series._last))
+        if lasts:
+            field, pk_field = cls._meta.get_field('_last'), cls._meta.pk
+            qn = connection.ops.quote_name
+            params = []
+            for pk, last in lasts:
+                params.extend([pk, field.get_db_prep_value(last, connection)])
+            params.extend(pk for pk, last in lasts)
+            # The ELSE gives the CASE the column's type, rather than text
+            sql = 'UPDATE %s SET %s = CASE %s %s ELSE %s END WHERE %s IN (%s)' % (
+                qn(cls._meta.db_table), qn(field.column), qn(pk_field.column),
+                ' '.join(['WHEN %s THEN %s'] * len(lasts)), qn(field.column),
+                qn(pk_field.column), ', '.join(['%s'] * len(lasts)))
+            connection.cursor().execute(sql, params)
+            transaction.commit_unless_managed()
+        return results
+
+    def reconfigure(self, archives):
+        """
+        Adds, removes or resizes the archives of an existing series, building
+        any new ones from the data already stored.
+        """
+        if self.is_virtual:
+            raise IntegrityError("Virtual series don't have archives.")
+        self._check_archives(archives)
         database_client = get_client()
-        return database_client.fetch(self.slug, aggregation_type, interval, period_start, period_end)
+        database_client.reconfigure(self.slug, archives)
+        self._config_new = dict(self.config, archives=archives)
+        self._rebuilt = pytz.utc.localize(datetime.datetime.utcnow())
+        self.save()
+
+    def fetch(self, aggregation_type, interval, period_start=None, period_end=None, points=None, method='lttb'):
+        """
+        Returns the samples of the given type and interval between the given
+        times, or at most points of them chosen by the given downsampling
+        method, either 'lttb' or 'minmax'.
+        """
+        if getattr(settings, 'TIME_SERIES_DIRECT_READS', True):
+            database_client = get_reader()
+        else:
+            database_client = get_client()
+        return database_client.fetch(self.slug, aggregation_type, interval, period_start, period_end,
+                                     points, method)
+
+    @classmethod
+    def fetch_many(cls, timeseries, aggregation_type, interval, period_start=None, period_end=None, points=None,
+                   method='lttb'):
+        """
+        Fetches from each of several series as fetch() does, in one call to
+        the long-living process rather than one each. Returns their results
+        in order, with the exception raised in place of any that failed.
+        """
+        if getattr(settings, 'TIME_SERIES_DIRECT_READS', True):
+            database_client = get_reader()
+        else:
+            database_client = get_client()
+        return database_client.fetch_many([(series.slug, aggregation_type, interval, period_start, period_end,
+                                            points, method) for series in timeseries])
+
+    def aggregate(self, aggregation_type, interval, period_start=None, period_end=None):
+        if getattr(settings, 'TIME_SERIES_DIRECT_READS', True):
+            database_client = get_reader()
+        else:
+            database_client = get_client()
+        return database_client.aggregate(self.slug, aggregation_type, interval, period_start, period_end)
 
     def get_admin_url(self):
         return reverse('timeseries-admin:detail', args=[self.slug])
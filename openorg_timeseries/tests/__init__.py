@@ -1,4 +1,8 @@
 from .combine import *
 from .admin import *
 from .endpoint import *
+from .server import *
+from .pool import *
+from .shards import *
+from .protocol import *
 from openorg_timeseries.database.tests import *
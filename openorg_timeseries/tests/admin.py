@@ -2,6 +2,7 @@ import copy
 import csv
 import httplib
 import os
+import time
 import urlparse
 
 try:
@@ -14,6 +15,7 @@ from django.conf import settings
 from django.test import TestCase
 from django.contrib.auth.models import User
 
+from openorg_timeseries.database.base import isnan
 from openorg_timeseries.models import TimeSeries
 from openorg_timeseries.longliving.database import get_client
 
@@ -34,7 +36,7 @@ class TimeSeriesTestCase(TestCase):
                                                 'aggregation': 1,
                                                 'count': 10000}]}}
     def tearDown(self):
-        for path in ('csv', 'tsdb'):
+        for path in ('csv', 'tsdb', 'late'):
             path = os.path.join(settings.TIME_SERIES_PATH, path)
             for filename in os.listdir(path):
                 os.unlink(os.path.join(path, filename))
@@ -194,6 +196,46 @@ class RESTDetailTestCase(DetailTestCase):
         body = json.loads(response._get_content())
         self.assertEqual(body['readings']['count'], len(self.readings['expected']))
         self.assertEqual(body['readings']['appended'], 0)
+        self.assertEqual(body['readings']['late'], len(self.readings['expected']))
+
+        # Late readings are set aside rather than dropped
+        with open(os.path.join(settings.TIME_SERIES_PATH, 'late', self.real_timeseries['slug'] + '.csv')) as f:
+            reader = csv.reader(f)
+            self.assertSequenceEqual(list(reader), self.readings['expected'])
+
+    def testReorderWindow(self):
+        data = copy.deepcopy(self.real_timeseries)
+        data['slug'] = 'reordered'
+        # A window that ends two hours into the series, and so holds back
+        # any readings after that.
+        data['config']['reorder_window'] = int(time.time()) - 7200
+        response = self.client.post('/admin/',
+                                    data=json.dumps(data),
+                                    content_type='application/json',
+                                    REMOTE_USER='withaddperm')
+        self.assertEqual(response.status_code, httplib.CREATED)
+        self.assertEqual(get_client().get_config('reordered')['reorder_window'], data['config']['reorder_window'])
+        location = response['Location']
+
+        results = []
+        for readings in ([['1970-01-01T00:30:00Z', 5], ['1970-01-01T04:00:00Z', 40],
+                          ['1970-01-01T03:00:00Z', 30], ['1970-01-01T01:30:00Z', 15]],
+                         [['1970-01-01T01:00:00Z', 10], ['1970-01-01T03:30:00Z', 35]]):
+            response = self.client.post(location,
+                                        data=json.dumps({'readings': readings}),
+                                        content_type='application/json',
+                                        REMOTE_USER='withaddperm',
+                                        HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, httplib.OK, response._get_content())
+            body = json.loads(response._get_content())['readings']
+            results.append((body['appended'], body['late'], body['pending']))
+        self.assertEqual(results, [(4, 0, 2), (1, 1, 3)])
+
+        with open(os.path.join(settings.TIME_SERIES_PATH, 'csv', 'reordered.csv')) as f:
+            self.assertSequenceEqual(list(csv.reader(f)), [['1970-01-01T01:30:00+01:00', '5.0'],
+                                                           ['1970-01-01T02:30:00+01:00', '15.0']])
+        with open(os.path.join(settings.TIME_SERIES_PATH, 'late', 'reordered.csv')) as f:
+            self.assertSequenceEqual(list(csv.reader(f)), [['1970-01-01T02:00:00+01:00', '10.0']])
 
     def testPostInvalidJSON(self):
         response = self.client.post(self.location,
@@ -236,6 +278,51 @@ class RESTDetailTestCase(DetailTestCase):
         self.assertEqual(series.title, request_body['title'])
         self.assertEqual(series.notes, request_body['notes'])
 
+    def testJSONReconfigure(self):
+        self.postReadings('application/json', 'json')
+        archives = [{'aggregation_type': 'average', 'aggregation': 1, 'count': 100},
+                    {'aggregation_type': 'average', 'aggregation': 2, 'count': 100}]
+        response = self.client.post(self.location,
+                                    data=json.dumps({'archives': archives}),
+                                    content_type='application/json',
+                                    REMOTE_USER='withaddperm')
+
+        self.assertEqual(response.status_code, httplib.OK, response._get_content())
+        body = json.loads(response._get_content())
+        self.assertEqual(body['updated'], ['archives'])
+
+        series = TimeSeries.objects.get(slug=self.real_timeseries['slug'])
+        self.assertEqual(series.config['archives'], archives)
+        self.assertEqual(get_client().get_config(series.slug)['archives'], archives)
+        # The new archive has been filled from the existing one. Its first
+        # hour is only partly covered by readings, so is NaN, as it would
+        # have been had the archive always existed.
+        values = [val for ts, val in series.fetch('average', 3600, series.config['start'])]
+        self.assertEqual(len(values), 2)
+        self.assertTrue(isnan(values[0]))
+        self.assertEqual(values[1], 15.0)
+
+    def testJSONReconfigureInvalid(self):
+        for archives in ([],
+                         [{'aggregation_type': 'average', 'aggregation': 1, 'count': 0}],
+                         [{'aggregation_type': 'average', 'aggregation': 0, 'count': 100}]):
+            response = self.client.post(self.location,
+                                        data=json.dumps({'archives': archives}),
+                                        content_type='application/json',
+                                        REMOTE_USER='withaddperm')
+            self.assertEqual(response.status_code, httplib.BAD_REQUEST, response._get_content())
+            self.assertEqual(json.loads(response._get_content())['error'], 'invalid-archives')
+        series = TimeSeries.objects.get(slug=self.real_timeseries['slug'])
+        self.assertEqual(get_client().get_config(series.slug)['archives'], series.config['archives'])
+
+    def testJSONReconfigureUnprivileged(self):
+        response = self.client.post(self.location,
+                                    data=json.dumps({'archives': []}),
+                                    content_type='application/json',
+                                    REMOTE_USER='withappendperm')
+
+        self.assertEqual(response.status_code, httplib.FORBIDDEN)
+
     def testJSONChangeUnprivileged(self):
         request_body = {'title': 'new title',
                         'notes': 'new notes'}
@@ -246,6 +333,91 @@ class RESTDetailTestCase(DetailTestCase):
 
         self.assertEqual(response.status_code, httplib.FORBIDDEN)
 
+class AppendManyTestCase(DetailTestCase):
+    readings = {
+        'json': json.dumps({'readings': [{'slug': 'test', 'ts': '1970-01-01T00:30:00+00:00', 'val': 5},
+                                         ['test-two', 3600000, 10],
+                                         {'slug': 'test', 'ts': '1970-01-01 01:30:00Z', 'val': 15}]}),
+        'csv': '\n'.join(["test,1970-01-01T00:30:00+00:00,5",
+                          "test-two,1970-01-01 01:00:00Z,10",
+                          "test,1970-01-01 01:30:00Z,15"])}
+
+    def setUp(self):
+        super(AppendManyTestCase, self).setUp()
+        data = copy.deepcopy(self.real_timeseries)
+        data['slug'] = 'test-two'
+        self.client.post('/admin/',
+                         data=json.dumps(data),
+                         content_type='application/json',
+                         REMOTE_USER='withaddperm')
+
+    def postReadings(self, content_type, key, username):
+        return self.client.post('/admin/append/',
+                                data=self.readings[key],
+                                content_type=content_type,
+                                REMOTE_USER=username,
+                                HTTP_ACCEPT='application/json')
+
+    def assertAppended(self, response):
+        self.assertEqual(response.status_code, httplib.OK, response._get_content())
+        body = json.loads(response._get_content())
+        self.assertEqual(body['series']['test']['appended'], 2)
+        self.assertEqual(body['series']['test-two']['appended'], 1)
+        with open(os.path.join(settings.TIME_SERIES_PATH, 'csv', 'test.csv')) as f:
+            self.assertSequenceEqual(list(csv.reader(f)), [['1970-01-01T01:30:00+01:00', '5.0'],
+                                                           ['1970-01-01T02:30:00+01:00', '15.0']])
+        lasts = dict(TimeSeries.objects.values_list('slug', '_last'))
+        self.assertEqual(lasts['test'], dateutil.parser.parse('1970-01-01T01:30:00Z'))
+        self.assertEqual(lasts['test-two'], dateutil.parser.parse('1970-01-01T01:00:00Z'))
+        self.assertEqual(lasts['already-existing'], None)
+
+    def testPostJSON(self):
+        # With permissions on each series
+        self.assertAppended(self.postReadings('application/json', 'json', 'withaddperm'))
+
+    def testPostCSV(self):
+        # With permission on every series
+        self.assertAppended(self.postReadings('text/csv', 'csv', 'withappendperm'))
+
+    def testUnprivileged(self):
+        response = self.postReadings('application/json', 'json', 'withobjectperm')
+        self.assertEqual(response.status_code, httplib.FORBIDDEN)
+        self.assertEqual(os.path.getsize(os.path.join(settings.TIME_SERIES_PATH, 'csv', 'test.csv')), 0)
+
+    def testNotFound(self):
+        readings = json.loads(self.readings['json'])
+        readings['readings'].append(['missing', 0, 1])
+        response = self.client.post('/admin/append/',
+                                    data=json.dumps(readings),
+                                    content_type='application/json',
+                                    REMOTE_USER='superuser',
+                                    HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, httplib.NOT_FOUND)
+        self.assertEqual(json.loads(response._get_content())['slugs'], ['missing'])
+
+    def testInvalidReadings(self):
+        for reading in ({'slug': 'test', 'ts': 0, 'val': 'abc'},
+                        {'slug': 'test', 'ts': 0, 'val': None},
+                        [['test'], 0, 1],
+                        ['test', 'not a date', 1],
+                        ['test', 10 ** 20, 1]):
+            response = self.client.post('/admin/append/',
+                                        data=json.dumps({'readings': [reading]}),
+                                        content_type='application/json',
+                                        REMOTE_USER='superuser',
+                                        HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, httplib.BAD_REQUEST, reading)
+            self.assertEqual(json.loads(response._get_content())['error'], 'invalid-readings')
+
+    def testPostHTML(self):
+        response = self.client.post('/admin/append/',
+                                    data=self.readings['csv'],
+                                    content_type='text/csv',
+                                    REMOTE_USER='withappendperm',
+                                    HTTP_ACCEPT='text/html')
+        self.assertEqual(response.status_code, httplib.OK)
+        self.assertTrue('/admin/test-two/' in response._get_content())
+
 class FormDetailTestCase(DetailTestCase):
     def testFormChange(self):
         form_data = {'title': 'new title',
@@ -1,9 +1,292 @@
+from __future__ import with_statement
+
+import datetime
 import httplib
+import StringIO
+import struct
+import zipfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.http import http_date, parse_http_date
+import mock
+import pytz
+
+from openorg_timeseries.longliving.database import SeriesNotFound
+from openorg_timeseries.models import TimeSeries
 
 class DocumentationTestCase(TestCase):
     def testOK(self):
         response = self.client.get('/endpoint/documentation/')
         self.assertEqual(response.status_code, httplib.OK)
 
+
+class FetchTestCase(TestCase):
+    def setUp(self):
+        self.series = TimeSeries(slug='aggregated', title='Aggregated', is_virtual=False)
+        self.series.config = {'start': '1970-01-01T00:00:00Z',
+                              'timezone_name': 'UTC',
+                              'series_type': 'period',
+                              'interval': 1800,
+                              'archives': [{'aggregation_type': 'average',
+                                            'aggregation': 1,
+                                            'count': 10000}]}
+        self.series.save()
+        start = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+        self.series.append([(start + datetime.timedelta(0, 1800 * i), i) for i in xrange(1, 1001)])
+
+    def tearDown(self):
+        self.series.delete()
+
+    def testAggregate(self):
+        response = self.client.get('/endpoint/',
+                                   {'action': 'aggregate',
+                                    'series': 'aggregated,missing',
+                                    'type': 'average',
+                                    'resolution': '1800',
+                                    'start': '1970-01-01T00:00:00Z',
+                                    'end': '1970-01-21T00:00:00Z'},
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, httplib.OK, response._get_content())
+        body = json.loads(response._get_content())
+        # Readings 1 to 960 fall within the twenty days
+        self.assertEqual(body['series']['aggregated'],
+                         {'name': 'aggregated', 'count': 960, 'sum': 461280.0, 'mean': 480.5, 'min': 1.0, 'max': 960.0})
+        self.assertEqual(body['series']['missing'], {'error': 'not-found'})
+
+    def testAggregateNothing(self):
+        response = self.client.get('/endpoint/',
+                                   {'action': 'aggregate',
+                                    'series': 'aggregated',
+                                    'type': 'average',
+                                    'resolution': '1800',
+                                    'start': '1980-01-01T00:00:00Z',
+                                    'end': '1980-01-02T00:00:00Z'},
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, httplib.OK, response._get_content())
+        body = json.loads(response._get_content())
+        self.assertEqual(body['series']['aggregated'],
+                         {'name': 'aggregated', 'count': 0, 'sum': 0.0, 'mean': None, 'min': None, 'max': None})
+
+    def testGraph(self):
+        for method in ('lttb', 'minmax'):
+            response = self.client.get('/endpoint/',
+                                       {'action': 'graph',
+                                        'series': 'aggregated',
+                                        'type': 'average',
+                                        'resolution': '1800',
+                                        'start': '1970-01-01T00:00:00Z',
+                                        'end': '1970-01-21T00:00:00Z',
+                                        'points': '100',
+                                        'method': method},
+                                       HTTP_ACCEPT='application/json')
+            self.assertEqual(response.status_code, httplib.OK, response._get_content())
+            data = json.loads(response._get_content())['series']['aggregated']['data']
+            self.assertLessEqual(len(data), 100)
+            self.assertEqual(data[-1]['val'], 960)
+            self.assertEqual(sorted(data, key=lambda datum: datum['ts']), data)
+
+    def testFetchPoints(self):
+        response = self.client.get('/endpoint/',
+                                   {'action': 'fetch',
+                                    'series': 'aggregated',
+                                    'type': 'average',
+                                    'resolution': '1800',
+                                    'start': '1970-01-01T00:00:00Z',
+                                    'end': '1970-01-21T00:00:00Z',
+                                    'points': '1'},
+                                   HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, httplib.BAD_REQUEST)
+
+    def testFetchMany(self):
+        missing = TimeSeries(slug='missing')
+        start = datetime.datetime(1970, 1, 1, tzinfo=pytz.utc)
+        for direct_reads in (True, False):
+            with override_settings(TIME_SERIES_DIRECT_READS=direct_reads):
+                results = TimeSeries.fetch_many([self.series, missing, self.series], 'average', 1800,
+                                                start, start + datetime.timedelta(20), points=10)
+            self.assertEqual(len(results[0].values), 10)
+            self.assertTrue(isinstance(results[1], SeriesNotFound))
+            self.assertEqual(list(results[2]), list(results[0]))
+
+    def testFetchManyFailed(self):
+        failing = TimeSeries(slug='failing', title='Failing', is_virtual=False)
+        failing.config = self.series.config
+        failing.save()
+        self.addCleanup(failing.delete)
+        fetch_many = TimeSeries.fetch_many
+        for error, expected in ((SeriesNotFound(), 'not-found'), (ValueError("No suitable archive"), 'fetch-failed')):
+            def fail(timeseries, *args, **kwargs):
+                # One series failing doesn't lose the others' results
+                return [error if series.slug == 'failing' else result
+                        for series, result in zip(timeseries, fetch_many(timeseries, *args, **kwargs))]
+            with mock.patch.object(TimeSeries, 'fetch_many', side_effect=fail):
+                response = self.client.get('/endpoint/',
+                                           {'action': 'fetch', 'series': 'aggregated,failing', 'type': 'average',
+                                            'resolution': '1800', 'start': '1970-01-01T00:30:00Z',
+                                            'end': '1970-01-01T01:30:00Z', 'format': 'json'})
+            self.assertEqual(response.status_code, httplib.OK, response.content)
+            self.assertEqual(json.loads(response.content)['series'],
+                             {'aggregated': {'name': 'aggregated', 'data': [{'ts': 3600000, 'val': 2.0},
+                                                                            {'ts': 5400000, 'val': 3.0}]},
+                              'failing': {'error': expected}})
+
+    def testFetchFormats(self):
+        def fetch(format, **params):
+            params.update({'action': 'fetch', 'series': 'aggregated,missing', 'type': 'average',
+                           'resolution': '1800', 'start': '1970-01-01T00:30:00Z', 'end': '1970-01-01T01:30:00Z',
+                           'format': format})
+            response = self.client.get('/endpoint/', params)
+            self.assertEqual(response.status_code, httplib.OK, response.content)
+            return response.content
+        data = [{'ts': 3600000, 'val': 2.0}, {'ts': 5400000, 'val': 3.0}]
+        self.assertEqual(json.loads(fetch('json')),
+                         {'series': {'aggregated': {'name': 'aggregated', 'data': data},
+                                     'missing': {'error': 'not-found'}}})
+        body = fetch('js', callback='f')
+        self.assertTrue(body.startswith('f(') and body.endswith(');'))
+        self.assertEqual(json.loads(body[2:-2])['series']['aggregated']['data'], data)
+        self.assertEqual(fetch('csv'), 'aggregated,"1970-01-01 01:00:00",2.0\n'
+                                       'aggregated,"1970-01-01 01:30:00",3.0\n')
+        # In the default time zone, as the date filter would give it
+        self.assertEqual(fetch('txt'), 'aggregated,1969-12-31T19:00:00-06:00,2.0\n'
+                                       'aggregated,1969-12-31T19:30:00-06:00,3.0\n')
+
+    def testFetchStreamed(self):
+        response = self.client.get('/endpoint/', {'action': 'fetch', 'series': 'aggregated', 'type': 'average',
+                                                  'resolution': '1800', 'start': '1970-01-01T00:00:00Z',
+                                                  'end': '1970-01-21T00:00:00Z', 'format': 'json'})
+        self.assertEqual(response.status_code, httplib.OK)
+        chunks = list(response)
+        self.assertTrue(len(chunks) > 1)
+        data = json.loads(''.join(chunks))['series']['aggregated']['data']
+        self.assertEqual([datum['val'] for datum in data], range(1, 961))
+
+    def testFetchBinary(self):
+        params = {'action': 'fetch', 'series': 'aggregated,missing', 'type': 'average', 'resolution': '1800',
+                  'start': '1970-01-01T00:30:00Z', 'end': '1970-01-01T01:30:00Z'}
+        response = self.client.get('/endpoint/', dict(params, format='bin'))
+        self.assertEqual(response['Content-Type'], 'application/octet-stream')
+        header = struct.Struct('<HcBqLL')
+        self.assertEqual(header.unpack_from(response.content), (10, 'f', 0, 3600, 1800, 2))
+        self.assertEqual(response.content[header.size:header.size + 10], 'aggregated')
+        self.assertEqual(struct.unpack_from('<2f', response.content, header.size + 10), (2.0, 3.0))
+        self.assertEqual(len(response.content), header.size + 10 + 8)
+
+        response = self.client.get('/endpoint/', dict(params, format='bin', points='2',
+                                                      end='1970-01-02T00:00:00Z'))
+        count = header.unpack_from(response.content)[-1]
+        self.assertEqual(header.unpack_from(response.content)[1:3], ('f', 1))
+        self.assertEqual(struct.unpack_from('<2I', response.content, header.size + 10 + 4 * count), (0, 46))
+
+    def assertNpy(self, content, descr, values):
+        self.assertEqual(content[:8], '\x93NUMPY\x01\x00')
+        header_length, = struct.unpack_from('<H', content, 8)
+        self.assertEqual((10 + header_length) % 64, 0)
+        header = eval(content[10:10 + header_length])
+        self.assertEqual(header, {'descr': descr, 'fortran_order': False, 'shape': (len(values),)})
+        data = content[10 + header_length:]
+        typecode = {'<f4': 'f', '<i8': 'q'}[descr]
+        self.assertEqual(list(struct.unpack('<%d%s' % (len(values), typecode), data)), values)
+
+    def testFetchNumPy(self):
+        params = {'action': 'fetch', 'series': 'aggregated,missing', 'type': 'average', 'resolution': '1800',
+                  'start': '1970-01-01T00:30:00Z', 'end': '1970-01-01T01:30:00Z'}
+        response = self.client.get('/endpoint/', dict(params, format='npy'))
+        self.assertEqual(response.status_code, httplib.OK)
+        self.assertNpy(response.content, '<f4', [2.0, 3.0])
+        self.assertEqual((response['X-Timeseries-Start'], response['X-Timeseries-Step']), ('3600', '1800'))
+
+        response = self.client.get('/endpoint/', dict(params, format='npz'))
+        npz = zipfile.ZipFile(StringIO.StringIO(response.content))
+        self.assertEqual(npz.namelist(), ['aggregated.npy', 'aggregated.ts.npy'])
+        self.assertNpy(npz.read('aggregated.npy'), '<f4', [2.0, 3.0])
+        self.assertNpy(npz.read('aggregated.ts.npy'), '<i8', [3600, 5400])
+
+        response = self.client.get('/endpoint/', dict(params, format='npz', points='2',
+                                                      end='1970-01-02T00:00:00Z'))
+        npz = zipfile.ZipFile(StringIO.StringIO(response.content))
+        self.assertNpy(npz.read('aggregated.ts.npy'), '<i8', [3600, 3600 + 46 * 1800])
+        # Downsampled samples aren't evenly spaced
+        response = self.client.get('/endpoint/', dict(params, format='npy', points='2',
+                                                      end='1970-01-02T00:00:00Z'))
+        self.assertNotEqual(response.status_code, httplib.OK)
+
+    def testConditionalFetch(self):
+        params = {'action': 'fetch', 'series': 'aggregated', 'type': 'average', 'resolution': '1800',
+                  'start': '1970-01-01T00:00:00Z', 'end': '1970-01-21T00:00:00Z', 'format': 'json'}
+        response = self.client.get('/endpoint/', params)
+        self.assertEqual(response.status_code, httplib.OK)
+        etag = response['ETag']
+        # The last reading appended, at 1970-01-21T20:00:00Z
+        self.assertEqual(response['Last-Modified'], http_date(1000 * 1800))
+
+        with mock.patch.object(TimeSeries, 'fetch_many') as fetch_many:
+            response = self.client.get('/endpoint/', params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, httplib.NOT_MODIFIED)
+            self.assertEqual(response['ETag'], etag)
+            response = self.client.get('/endpoint/', params, HTTP_IF_MODIFIED_SINCE=http_date(1000 * 1800))
+            self.assertEqual(response.status_code, httplib.NOT_MODIFIED)
+            # Another representation
+            response = self.client.get('/endpoint/', dict(params, format='csv'), HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, httplib.OK)
+        self.assertEqual(fetch_many.call_count, 1)
+
+        self.series.append([(datetime.datetime(1970, 1, 21, 20, 30, tzinfo=pytz.utc), 1001)])
+        response = self.client.get('/endpoint/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, httplib.OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def testConditionalFetchRebuilt(self):
+        params = {'action': 'fetch', 'series': 'aggregated', 'type': 'average', 'resolution': '1800',
+                  'start': '1970-01-01T00:00:00Z', 'end': '1970-01-21T00:00:00Z', 'format': 'json'}
+        response = self.client.get('/endpoint/', params)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+
+        # Neither rebuilding nor reconfiguring changes when the series was
+        # last appended to
+        call_command('rebuildtimeseries', 'aggregated', stdout=StringIO.StringIO())
+        response = self.client.get('/endpoint/', params, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, httplib.OK)
+        self.assertTrue(parse_http_date(response['Last-Modified']) > parse_http_date(last_modified))
+        response = self.client.get('/endpoint/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, httplib.OK)
+        etag = response['ETag']
+
+        series = TimeSeries.objects.get(slug='aggregated')
+        series.reconfigure([dict(series.config['archives'][0], count=20000)])
+        response = self.client.get('/endpoint/', params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, httplib.OK)
+
+    def testConditionalRelativeFetch(self):
+        params = {'action': 'fetch', 'series': 'aggregated', 'type': 'average', 'resolution': '1800', 'format': 'json'}
+        with mock.patch('time.time', return_value=1800 * 2000 + 10):
+            response = self.client.get('/endpoint/', params)
+            etag = response['ETag']
+            self.assertEqual(response['Last-Modified'], http_date(1800 * 2000))
+            response = self.client.get('/endpoint/', params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, httplib.NOT_MODIFIED)
+        with mock.patch('time.time', return_value=1800 * 2001):
+            response = self.client.get('/endpoint/', params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, httplib.OK)
+
+    def testConditionalInfoAndList(self):
+        for params in ({'action': 'info', 'series': 'aggregated', 'format': 'json'},
+                       {'action': 'list', 'format': 'json'}):
+            response = self.client.get('/endpoint/', params)
+            self.assertEqual(response.status_code, httplib.OK, response.content)
+            etag = response['ETag']
+            response = self.client.get('/endpoint/', params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, httplib.NOT_MODIFIED)
+            # Titles can change without the last reading changing
+            response = self.client.get('/endpoint/', params, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, httplib.OK)
+            TimeSeries.objects.filter(pk=self.series.pk).update(title='Retitled for %s' % params['action'])
+            response = self.client.get('/endpoint/', params, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, httplib.OK)
@@ -0,0 +1,114 @@
+from __future__ import with_statement
+
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import mock
+import pytz
+
+from openorg_timeseries.database import TimeSeriesDatabase, InconsistentRead
+from openorg_timeseries.longliving.database import DatabasePool, DatabaseReader, SeriesNotFound
+
+
+class DatabasePoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.opened, self.closed = [], []
+        def open_database(slug):
+            if slug == 'missing':
+                raise SeriesNotFound
+            self.opened.append(slug)
+            return mock.Mock(slug=slug)
+        def close_database(slug, db):
+            self.assertEqual(db.slug, slug)
+            self.closed.append(slug)
+        self.pool = DatabasePool(open_database, close_database, max_open=2, idle_timeout=60)
+
+    def get(self, slug):
+        with self.pool.lock(slug):
+            return self.pool.get(slug)
+
+    def testLeastRecentlyUsedEvicted(self):
+        with mock.patch('time.time') as time:
+            for i, slug in enumerate('abac'):
+                time.return_value = i
+                self.get(slug)
+        self.assertEqual(self.opened, ['a', 'b', 'c'])
+        self.assertEqual(self.closed, ['b'])
+        self.assertEqual(self.pool.stats(), {'open': 2, 'locks': 2, 'max_open': 2,
+                                             'hits': 1, 'misses': 3, 'evictions': 1})
+        self.assertRaises(SeriesNotFound, self.get, 'missing')
+        self.assertEqual(self.pool.stats()['locks'], 2)
+
+    def testBusyNotEvicted(self):
+        self.get('a')
+        self.get('b')
+        held = threading.Event()
+        release = threading.Event()
+        def hold():
+            with self.pool.lock('a'):
+                held.set()
+                release.wait()
+        thread = threading.Thread(target=hold)
+        thread.start()
+        try:
+            held.wait()
+            self.get('c')
+            self.assertEqual(self.closed, ['b'])
+        finally:
+            release.set()
+            thread.join()
+
+    def testIdleEvicted(self):
+        with mock.patch('time.time') as time:
+            time.return_value = 0
+            self.get('a')
+            time.return_value = 30
+            self.get('b')
+            time.return_value = 70
+            self.pool.evict_idle()
+        self.assertEqual(self.closed, ['a'])
+        self.assertEqual([slug for slug, db in self.pool.items()], ['b'])
+        self.assertEqual(self.pool.stats()['locks'], 1)
+
+
+class DatabaseReaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.path, 'tsdb'))
+        for slug in 'abc':
+            TimeSeriesDatabase.create(os.path.join(self.path, 'tsdb', slug + '.tsdb'), 'period',
+                                      datetime.datetime(2011, 1, 1, tzinfo=pytz.utc), 1800,
+                                      [{'aggregation_type': 'average', 'aggregation': 1, 'count': 100}],
+                                      'UTC').close()
+        self.reader = DatabaseReader(self.path, max_open=2)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testLeastRecentlyUsedClosed(self):
+        with mock.patch.object(TimeSeriesDatabase, 'close', autospec=True) as close:
+            with mock.patch('time.time') as time:
+                for i, slug in enumerate('abac'):
+                    time.return_value = i
+                    self.reader.get_database(slug)
+        self.assertEqual([db.filename for (db,), kwargs in close.call_args_list],
+                         [os.path.join(self.path, 'tsdb', 'b.tsdb')])
+        self.assertEqual(self.reader._local.databases.stats()['open'], 2)
+        self.assertRaises(SeriesNotFound, self.reader.get_database, 'missing')
+
+    def testReplacedReopened(self):
+        db = self.reader.get_database('a')
+        os.unlink(db.filename)
+        os.rename(os.path.join(self.path, 'tsdb', 'b.tsdb'), db.filename)
+        self.assertNotEqual(self.reader.get_database('a'), db)
+
+    def testInconsistentFetchedThroughClient(self):
+        with mock.patch.object(TimeSeriesDatabase, 'fetch', side_effect=InconsistentRead):
+            with mock.patch('openorg_timeseries.longliving.database.get_client') as get_client:
+                result = self.reader.fetch('a', 'average', 1800, None, None)
+        get_client.return_value.fetch.assert_called_once_with('a', 'average', 1800, None, None, None, 'lttb')
+        self.assertEqual(result, get_client.return_value.fetch.return_value)
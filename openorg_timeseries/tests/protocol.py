@@ -0,0 +1,167 @@
+from __future__ import with_statement
+
+import array
+import datetime
+import functools
+import socket
+import threading
+import unittest
+
+import mock
+import pytz
+
+from openorg_timeseries.database import FetchResult, DownsampledResult
+from openorg_timeseries.longliving import protocol
+from openorg_timeseries.longliving.database import ClientPool, SeriesNotFound
+
+
+class ProtocolTestCase(unittest.TestCase):
+    def assertRoundTrip(self, value):
+        decoded = protocol.decode(protocol.encode(value))
+        self.assertEqual(type(decoded), type(value))
+        self.assertEqual(decoded, value)
+        return decoded
+
+    def testValues(self):
+        for value in (None, True, False, 0, -2 ** 63 + 1, 2 ** 70, 1.5, 'abc', u'caf\xe9',
+                      (1, [2.5, {'a': (None,)}]), {u'x': [], 'y': ()}):
+            self.assertRoundTrip(value)
+        london = pytz.timezone('Europe/London')
+        for value in (london.localize(datetime.datetime(2011, 6, 1, 12, 30, 0, 500)),
+                      datetime.datetime(2011, 1, 1),
+                      [pytz.utc.localize(datetime.datetime(2011, 1, 1)), array.array('d', [1.0, 2.0])]):
+            self.assertRoundTrip(value)
+        decoded = self.assertRoundTrip(london.localize(datetime.datetime(2011, 6, 1, 12)))
+        self.assertEqual(decoded.tzinfo.zone, 'Europe/London')
+        # marshal would send this as a string
+        self.assertRoundTrip(('slug', array.array('f', [1.5])))
+
+    def testFetchResults(self):
+        result = protocol.decode(protocol.encode(FetchResult(1800, 1800, array.array('f', [1, 2]), 'Europe/London')))
+        self.assertEqual((result.start, result.step, result.timezone_name), (1800, 1800, 'Europe/London'))
+        self.assertEqual(result.values, array.array('f', [1, 2]))
+        result = protocol.decode(protocol.encode(DownsampledResult(0, 10, array.array('L', [0, 5]),
+                                                                   array.array('d', [1, 2]))))
+        self.assertEqual(list(result.timestamps()), [0, 50])
+        self.assertEqual(result.values, array.array('d', [1, 2]))
+
+    def testExceptions(self):
+        for exception in (SeriesNotFound(), ValueError("bad", 1), KeyError('k')):
+            decoded = protocol.decode(protocol.encode(exception))
+            self.assertEqual((type(decoded), decoded.args), (type(exception), exception.args))
+        decoded = protocol.decode(protocol.encode(ValueError(object())))
+        self.assertEqual(type(decoded), ValueError)
+        self.assertTrue(isinstance(decoded.args[0], str))
+
+    def testFrames(self):
+        a, b = socket.socketpair()
+        try:
+            reader = protocol.FrameReader(b)
+            bodies = ['x' * 3000000, '', 'y']
+            # Sent in a thread, as the large frame outgrows the socket buffer
+            sender = threading.Thread(target=lambda: [protocol.send_frame(a, body) for body in bodies])
+            sender.start()
+            self.assertEqual([reader.read() for body in bodies], bodies)
+            sender.join()
+            a.close()
+            self.assertRaises(EOFError, reader.read)
+        finally:
+            a.close()
+            b.close()
+
+
+class ServerTestCase(unittest.TestCase):
+    class Target(object):
+        def echo(self, *args, **kwargs):
+            return args, kwargs
+        def fail(self):
+            raise SeriesNotFound('missing')
+        def hidden(self):
+            return 'hidden'
+
+    class Server(protocol.Server):
+        def process_request(self, request, client_address):
+            self.connections.append(request)
+            protocol.Server.process_request(self, request, client_address)
+
+    def setUp(self):
+        self.server = self.Server(('localhost', 0), 'secret', self.Target(), ['echo', 'fail'])
+        self.server.connections = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def testCalls(self):
+        client = protocol.Client(self.server.server_address, 'secret')
+        try:
+            self.assertEqual(client.echo(1, u'two', three=3.0), ((1, u'two'), {'three': 3.0}))
+            self.assertRaises(SeriesNotFound, client.fail)
+            self.assertRaises(AttributeError, client.hidden)
+            # The connection is still in step
+            self.assertEqual(client.echo(), ((), {}))
+        finally:
+            client.close()
+
+    def testPipelined(self):
+        client = protocol.Client(self.server.server_address, 'secret')
+        try:
+            calls = [('echo', (i,), {}) for i in xrange(100)]
+            self.assertEqual(client.call_many(calls), [((i,), {}) for i in xrange(100)])
+            self.assertRaises(SeriesNotFound, client.call_many, calls[:10] + [('fail', (), {})] + calls[10:])
+            self.assertEqual(client.call_many(calls[:2]), [((0,), {}), ((1,), {})])
+        finally:
+            client.close()
+
+    def testAuthentication(self):
+        self.assertRaises(protocol.AuthenticationError, protocol.Client, self.server.server_address, 'wrong')
+
+
+class ClientPoolTestCase(ServerTestCase):
+    def setUp(self):
+        super(ClientPoolTestCase, self).setUp()
+        self.released = threading.Event()
+        self.server.target.wait = self.released.wait
+        self.server.exposed |= set(['wait'])
+        self.connect = mock.Mock(side_effect=functools.partial(protocol.Client, self.server.server_address,
+                                                               'secret', 0.5))
+        self.pool = ClientPool(self.connect, max_idle=2)
+
+    def tearDown(self):
+        self.released.set()
+        self.pool.close()
+        super(ClientPoolTestCase, self).tearDown()
+
+    def testReused(self):
+        for i in xrange(3):
+            self.assertEqual(self.pool.echo(i), ((i,), {}))
+        self.assertRaises(SeriesNotFound, self.pool.fail)
+        self.assertEqual(self.pool.call_many([('echo', (), {})] * 2), [((), {})] * 2)
+        self.assertEqual(self.connect.call_count, 1)
+
+    def testServerClosed(self):
+        self.pool.echo()
+        # As when the long-living process restarts
+        for connection in self.server.connections:
+            connection.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(self.pool.echo(1), ((1,), {}))
+        self.assertEqual(self.connect.call_count, 2)
+
+    def testTimeout(self):
+        self.assertRaises(socket.timeout, self.pool.wait)
+        self.released.set()
+        # The connection, which is now out of step, was dropped
+        self.assertEqual(self.pool.echo(), ((), {}))
+        self.assertEqual(self.connect.call_count, 2)
+
+    def testForked(self):
+        self.pool.echo()
+        with self.pool.connection() as connection:
+            pass
+        with mock.patch('os.getpid', return_value=-1):
+            self.pool.echo()
+        self.assertTrue(connection.closed)
+        self.assertEqual(self.connect.call_count, 2)
@@ -11,6 +11,7 @@ class TestSuiteRunner(DjangoTestSuiteRunner):
         self.bail = threading.Event()
         self.database_thread = DatabaseThread(self.bail)
         self.database_thread.start()
+        self.database_thread.ready.wait(30)
 
         super(TestSuiteRunner, self).setup_test_environment()
 
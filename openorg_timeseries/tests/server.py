@@ -0,0 +1,61 @@
+from __future__ import with_statement
+
+import datetime
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import pytz
+from django.test.utils import override_settings
+
+from openorg_timeseries.longliving.database import DatabaseThread, _connect, get_server_args
+
+
+class DatabaseThreadTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = override_settings(TIME_SERIES_PATH=self.path,
+                                          TIME_SERIES_SERVER_ARGS={'address': ('localhost', 18697),
+                                                                   'authkey': 'abracadabra'},
+                                          TIME_SERIES_WAL_FSYNC='always')
+        self.settings.enable()
+        self.bail = threading.Event()
+        self.thread = DatabaseThread(self.bail)
+        self.thread.start()
+
+    def tearDown(self):
+        self.bail.set()
+        self.thread.join()
+        self.settings.disable()
+        shutil.rmtree(self.path)
+
+    def getClient(self):
+        # Not get_client(), which would be that of the suite's own server
+        for i in xrange(100):
+            try:
+                client = _connect(get_server_args()[0])
+                break
+            except socket.error:
+                time.sleep(0.05)
+        else:
+            client = _connect(get_server_args()[0])
+        self.addCleanup(client.close)
+        return client
+
+    def testAppendCommitted(self):
+        client = self.getClient()
+        start = datetime.datetime(2011, 1, 1, tzinfo=pytz.utc)
+        client.create('committed', 'period', start, 1800,
+                      [{'aggregation_type': 'average', 'aggregation': 1, 'count': 100}], 'UTC')
+        results = []
+        # With fsync='always' each append waits for the log to be committed
+        append = threading.Thread(target=lambda: results.append(
+            client.append('committed', [(start + datetime.timedelta(0, 1800), 1.0)])))
+        append.daemon = True
+        append.start()
+        append.join(10)
+        self.assertFalse(append.is_alive(), "The append wasn't committed")
+        self.assertEqual(results[0]['appended'], 1)
@@ -0,0 +1,111 @@
+from __future__ import with_statement
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from openorg_timeseries.longliving.database import (WriteAheadLog, ShardedClient, SeriesNotFound,
+                                                    get_shard, partition_logs)
+
+
+class ShardsTestCase(unittest.TestCase):
+    slugs = ['a', 'b', 'c', 'd', 'e', 'f', u'caf\xe9']
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def testStableShards(self):
+        # Clients and shards must agree, whatever process or release they're in
+        self.assertEqual([get_shard(slug, 4) for slug in self.slugs], [3, 1, 3, 0, 2, 0, 1])
+        self.assertEqual(set(get_shard(slug, 1) for slug in self.slugs), set([0]))
+
+    def writeLog(self, filename, slugs):
+        with open(os.path.join(self.path, filename), 'wb') as f:
+            for i, slug in enumerate(slugs):
+                f.write(WriteAheadLog._pack(slug, [i], [float(i)]))
+
+    def readLog(self, filename):
+        return list(WriteAheadLog.read(os.path.join(self.path, filename)))
+
+    def testPartitionLogs(self):
+        self.writeLog('wal.log', self.slugs)
+        partition_logs(self.path, 3)
+        self.assertEqual(sorted(os.listdir(self.path)), ['wal-0.log', 'wal-1.log', 'wal-2.log'])
+        records = []
+        for shard in xrange(3):
+            for slug, timestamps, values in self.readLog('wal-%d.log' % shard):
+                self.assertEqual(get_shard(slug, 3), shard)
+                records.append((timestamps[0], slug, values[0]))
+        self.assertEqual(sorted(records), [(i, slug, float(i)) for i, slug in enumerate(self.slugs)])
+
+        partition_logs(self.path, 1)
+        self.assertEqual(os.listdir(self.path), ['wal.log'])
+        self.assertEqual(sorted(slug for slug, timestamps, values in self.readLog('wal.log')), sorted(self.slugs))
+
+    def testPartitionInterrupted(self):
+        self.writeLog('wal.log', self.slugs)
+        rename = os.rename
+        def rename_once(src, dst):
+            # Dies having replaced just one of the logs
+            rename(src, dst)
+            rename_mock.side_effect = SystemExit
+        with mock.patch('os.rename', side_effect=rename_once) as rename_mock:
+            self.assertRaises(SystemExit, partition_logs, self.path, 2)
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'wal.partition')))
+
+        partition_logs(self.path, 2)
+        self.assertEqual(sorted(os.listdir(self.path)), ['wal-0.log', 'wal-1.log'])
+        self.assertEqual(sorted(slug for shard in xrange(2) for slug, timestamps, values
+                                in self.readLog('wal-%d.log' % shard)), sorted(self.slugs))
+
+    def testIncompletePartitionDiscarded(self):
+        self.writeLog('wal.log', self.slugs)
+        # Died before the new logs were all written
+        self.writeLog('wal-0.log.new', self.slugs[:1])
+        partition_logs(self.path, 1)
+        self.assertEqual(os.listdir(self.path), ['wal.log'])
+        self.assertEqual([slug for slug, timestamps, values in self.readLog('wal.log')], self.slugs)
+
+    def testPartitionedLogsLeftAlone(self):
+        self.writeLog('wal-0.log', [slug for slug in self.slugs if get_shard(slug, 2) == 0])
+        self.writeLog('wal-1.log', [slug for slug in self.slugs if get_shard(slug, 2) == 1])
+        self.writeLog('wal.log', [])
+        with mock.patch('os.rename') as rename:
+            partition_logs(self.path, 2)
+        self.assertFalse(rename.called)
+
+    def testShardedClient(self):
+        clients = [mock.Mock(name='shard%d' % shard) for shard in xrange(4)]
+        for shard, client in enumerate(clients):
+            client.get_pool_stats.return_value = {'hits': shard, 'misses': 1}
+        server_args = [{'address': ('localhost', shard)} for shard in xrange(4)]
+        with mock.patch('openorg_timeseries.longliving.database._connect',
+                        lambda args: clients[args['address'][1]]):
+            client = ShardedClient(server_args)
+            client.append('a', [])
+            client.fetch('d', 'average', 1800, None, None)
+            self.assertEqual(client.get_pool_stats(), {'hits': 6, 'misses': 4})
+            clients[0].delete.side_effect = SeriesNotFound
+            self.assertRaises(SeriesNotFound, client.delete, 'f')
+            self.assertRaises(AttributeError, getattr, client, 'replay')
+        clients[3].append.assert_called_once_with('a', [])
+        clients[0].fetch.assert_called_once_with('d', 'average', 1800, None, None)
+
+    def testFetchMany(self):
+        clients = [mock.Mock(name='shard%d' % shard) for shard in xrange(4)]
+        for client in clients:
+            client.fetch_many.side_effect = lambda requests: [request[0] for request in requests]
+        server_args = [{'address': ('localhost', shard)} for shard in xrange(4)]
+        with mock.patch('openorg_timeseries.longliving.database._connect',
+                        lambda args: clients[args['address'][1]]):
+            client = ShardedClient(server_args)
+            requests = [(slug, 'average', 1800, None, None) for slug in self.slugs]
+            self.assertEqual(client.fetch_many(requests), self.slugs)
+        self.assertEqual([c.fetch_many.call_count for c in clients], [1, 1, 1, 1])
+        clients[3].fetch_many.assert_called_once_with([requests[0], requests[2]])
@@ -101,6 +101,24 @@ class TimeSeriesView(JSONView):
     def filtered_dict(self, d, keys):
         return dict((k, d.get(k)) for k in keys)
 
+    def parse_timestamp(self, value, i):
+        """
+        Parses the timestamp of reading i, either an ISO 8601 string or a
+        JavaScript timestamp, which must be in milliseconds.
+        """
+        if not isinstance(value, (basestring, int, long, float)):
+            raise ValueError("Timestamp in reading %i must be a string or a number." % i)
+        try:
+            if isinstance(value, basestring):
+                ts = dateutil.parser.parse(value)
+            else:
+                ts = pytz.utc.localize(datetime.datetime.utcfromtimestamp(value / 1000))
+        except (OverflowError, TypeError, ValueError):
+            raise ValueError("Timestamp in reading %i isn't a valid date-time." % i)
+        if not ts.tzinfo:
+            raise ValueError("Timestamp in reading %i is missing a timezone part." % i)
+        return ts
+
 class ListView(TimeSeriesView, HTMLView, JSONPView):
     @method_decorator(login_required)
     def get(self, request):
@@ -188,6 +206,119 @@ class CreateView(TimeSeriesView, HTMLView):
             return self.get(request, context)
         return HttpResponseSeeOther(time_series.get_admin_url())
 
+class AppendView(TimeSeriesView, HTMLView):
+    """
+    Appends readings to many series at once, given as (slug, ts, val)
+    readings, either in a JSON object's 'readings' member or as CSV rows.
+    Nothing is appended unless every series exists and can be appended to.
+    """
+    def allowed(self, perm, series):
+        """
+        Returns those of series on which the user has perm, as has_perm()
+        would, with one query rather than one for each.
+        """
+        perm = 'openorg_timeseries.%s_timeseries' % perm
+        if self.request.user.has_perm(perm):
+            return list(series)
+        pks = self.request.user.get_objects_any_perms(TimeSeries, [perm]) \
+                                .filter(pk__in=[s.pk for s in series]).values_list('pk', flat=True)
+        pks = set(pks)
+        return [s for s in series if s.pk in pks]
+
+    @method_decorator(login_required)
+    def post(self, request):
+        data = None
+        if request.META.get('CONTENT_TYPE') == 'application/json':
+            try:
+                data = json.load(request)
+            except ValueError, e:
+                return self.invalid_json(e)
+        try:
+            readings = self.get_readings(request, data)
+        except ValueError, e:
+            return self.bad_request('invalid-readings', e.args[0])
+
+        # Readings by slug, in the order each slug was first seen
+        by_slug, slugs = {}, []
+        for slug, ts, val in readings:
+            if slug not in by_slug:
+                by_slug[slug] = []
+                slugs.append(slug)
+            by_slug[slug].append((ts, val))
+
+        series = dict((s.slug, s) for s in TimeSeries.objects.filter(slug__in=slugs))
+        missing = [slug for slug in slugs if slug not in series]
+        if missing:
+            return self.timeseries_error(httplib.NOT_FOUND,
+                                         error='not-found',
+                                         slugs=missing,
+                                         message='No time-series with the slugs %s.' % ', '.join(missing))
+        series = [series[slug] for slug in slugs]
+        virtual = [s.slug for s in series if s.is_virtual]
+        if virtual:
+            return self.bad_request("append-to-virtual", "You cannot append readings to a virtual time-series")
+        allowed = set(s.slug for s in self.allowed('append', series))
+        if len(allowed) < len(series):
+            return self.lacking_privilege("append to %s" % ', '.join(s.slug for s in series if s.slug not in allowed))
+
+        results = TimeSeries.append_many([(s, by_slug[s.slug]) for s in series])
+        context = {'series': {}}
+        for s, result in zip(series, results):
+            if isinstance(result, Exception):
+                context['series'][s.slug] = {'error': 'append-failed',
+                                             'message': unicode(result)}
+            else:
+                context['series'][s.slug] = {'count': len(by_slug[s.slug]),
+                                             'appended': result['appended'],
+                                             'late': result['late'],
+                                             'pending': result['pending'],
+                                             'last': result['last']}
+        return self.render(request, context, 'timeseries-admin/append')
+
+    def get_readings(self, request, data):
+        if data is not None:
+            if not isinstance(data, dict) or not isinstance(data.get('readings'), list):
+                raise ValueError('The request body should be an object with a "readings" member that is a list.')
+            readings = []
+            for i, reading in enumerate(data['readings']):
+                if isinstance(reading, dict):
+                    try:
+                        reading = reading['slug'], reading['ts'], reading['val']
+                    except KeyError, e:
+                        raise ValueError("Reading %i was missing a '%s' member" % (i, e.args[0]))
+                elif not (isinstance(reading, list) and len(reading) == 3):
+                    raise ValueError("Reading %i must be either an object with 'slug', 'ts' and 'val' members, "
+                                     "or a three-element list." % i)
+                slug, ts, val = reading
+                if not isinstance(slug, basestring):
+                    raise ValueError("Slug in reading %i isn't a string" % i)
+                try:
+                    val = float(val)
+                except (TypeError, ValueError):
+                    raise ValueError("Value in reading %i isn't a number" % i)
+                readings.append((slug, ts, val))
+        elif request.META.get('CONTENT_TYPE') == 'text/csv':
+            readings = self.parse_csv(request)
+        elif 'readings' in request.FILES:
+            readings = self.parse_csv(request.FILES['readings'])
+        else:
+            raise ValueError('Readings should be given as JSON or CSV.')
+        return [(slug, self.parse_timestamp(ts, i), val) for i, (slug, ts, val) in enumerate(readings)]
+
+    def parse_csv(self, fileobj):
+        readings = []
+        try:
+            for i, row in enumerate(csv.reader(fileobj)):
+                if len(row) != 3:
+                    raise ValueError("Row %i doesn't have three columns" % i)
+                try:
+                    readings.append((row[0], row[1], float(row[2])))
+                except ValueError:
+                    raise ValueError("Value in row %i isn't a number" % i)
+        except csv.Error:
+            raise ValueError("Couldn't parse CSV from request.")
+        return readings
+
 class SecureView(View):
     force_https = getattr(settings, 'FORCE_ADMIN_HTTPS', True)
 
@@ -245,6 +376,8 @@ class DetailView(TimeSeriesView, HTMLView):
             result = series.append(readings)
             context['readings'] = {'count': len(readings),
                                    'appended': result['appended'],
+                                   'late': result['late'],
+                                   'pending': result['pending'],
                                    'last': result['last']}
 
         editable_fields = ('title', 'notes', 'is_public')
@@ -260,6 +393,17 @@ class DetailView(TimeSeriesView, HTMLView):
                     context['updated'].append(f)
             series.save()
 
+        if request.json_data and 'archives' in request.json_data:
+            if series.is_virtual:
+                return self.bad_request("reconfigure-virtual", "Virtual time-series don't have archives")
+            if not self.has_perm('change', series):
+                return self.lacking_privilege("modify this time-series")
+            try:
+                series.reconfigure(request.json_data['archives'])
+            except ValueError, e:
+                return self.bad_request("invalid-archives", e.args[0])
+            context.setdefault('updated', []).append('archives')
+
         if form.is_valid():
             if not self.has_perm('change', series):
                 return self.lacking_privilege("modify this time-series")
@@ -307,17 +451,7 @@ class DetailView(TimeSeriesView, HTMLView):
         else:
             return None
 
-        parsed_readings = []
-        for reading in readings:
-            if isinstance(reading[0], basestring):
-                ts = dateutil.parser.parse(reading[0])
-            elif isinstance(reading[0], (int, float)):
-                ts = pytz.utc.localize(datetime.datetime.utcfromtimestamp(reading[0] / 1000))
-            if not ts.tzinfo:
-                raise ValueError("Timestamp in reading %i is missing a timezone part.")
-            parsed_readings.append((ts, reading[1]))
-
-        return parsed_readings
+        return [(self.parse_timestamp(reading[0], i), reading[1]) for i, reading in enumerate(readings)]
 
     def parse_csv(self, fileobj, readings):
         try:
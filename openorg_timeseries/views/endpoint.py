@@ -1,8 +1,23 @@
+from __future__ import with_statement
+
+import array
 import calendar
+import contextlib
 import datetime
+import hashlib
 import httplib
+import itertools
+import logging
 import os
+import struct
+import sys
 import time
+import zipfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import dateutil.parser
 import pytz
@@ -15,16 +30,81 @@ except ImportError: # rdflib 2.4
 
 from django.conf import settings
 from django.core.urlresolvers import reverse
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseNotModified
+try:
+    from django.http import StreamingHttpResponse
+except ImportError:
+    class StreamingHttpResponse(HttpResponse):
+        """
+        Before Django 1.5, a HttpResponse is sent as its iterator yields.
+        This keeps its content once read, as by middleware, so that reading
+        it doesn't leave nothing to send.
+        """
+        def _get_content(self):
+            content = HttpResponse._get_content(self)
+            self._set_content(content)
+            return content
+        content = property(_get_content, HttpResponse._set_content)
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
 
 from django_conneg.views import ContentNegotiatedView, HTMLView, TextView, JSONPView
 from django_conneg.decorators import renderer
 
-from openorg_timeseries.longliving.database import get_client, SeriesNotFound, TimeSeriesException
+from openorg_timeseries.database.base import _from_timestamp
+from openorg_timeseries.longliving.database import get_client, SeriesNotFound
 from openorg_timeseries.models import TimeSeries
 
+logger = logging.getLogger(__name__)
+
 TS = rdflib.Namespace('http://purl.org/NET/time-series/')
 
+_inf = float('inf')
+
+def _little_endian(values):
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    return values.tostring()
+
+def _npy(descr, count, data):
+    """
+    Returns a NumPy .npy file, without needing NumPy, of a one-dimensional
+    array of count items of the given dtype, whose data are already packed.
+    """
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (descr, count)
+    # Padded with spaces so that the data are aligned, ending with a newline
+    header += ' ' * (63 - (len(header) + 10) % 64) + '\n'
+    return '\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header + data
+
+# The dtypes of the arrays we read values from
+_npy_descrs = {'f': '<f4', 'd': '<f8'}
+
+class _Spool(object):
+    """
+    A file for zipfile to write an archive to, as it's being streamed out.
+    """
+    def __init__(self):
+        self._chunks, self._position = [], 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._position += len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """
+        Returns what has been written since last called.
+        """
+        chunks, self._chunks = self._chunks, []
+        return ''.join(chunks)
+
 class RDFView(ContentNegotiatedView):
     def render_rdflib(self, request, context, format, mimetype):
         graph = self.get_graph(request, context)
@@ -66,7 +146,67 @@ class TabularView(ContentNegotiatedView):
 
     @renderer(format='csv', mimetypes=('text/csv',), name='CSV')
     def render_csv(self, request, context, template_name):
-        return HttpResponse(self._spool_csv(request, context), mimetype="text/csv")
+        return StreamingHttpResponse(self._spool_csv(request, context), content_type="text/csv")
+
+class ConditionalView(ContentNegotiatedView):
+    """
+    Answers a conditional GET with 304 Not Modified, before getting or
+    rendering anything, if the validators that get_validators() returns
+    match those the client has.
+    """
+    # Whether Last-Modified changes whenever the response does, and so can
+    # be relied on without an ETag
+    last_modified_is_complete = True
+
+    def get_validators(self, request):
+        """
+        Returns an unquoted ETag and a last-modified time in seconds since
+        the epoch, either of which may be None.
+        """
+        return None, None
+
+    def get_series_validators(self, request, series, *extra):
+        """
+        Returns an ETag covering the request and the given series as stored,
+        as well as anything in extra, and the time any was last appended to
+        or rebuilt.
+        """
+        state = [sorted(request.GET.items()), request.META.get('HTTP_ACCEPT')] + list(extra)
+        last_modified = 0
+        for s in series:
+            last = calendar.timegm(s._last.utctimetuple()) if s._last else 0
+            rebuilt = calendar.timegm(s._rebuilt.utctimetuple()) if s._rebuilt else 0
+            state.append((s.pk, s.slug, s.title, s.notes, s._config, last, rebuilt))
+            last_modified = max(last_modified, last, rebuilt)
+        return hashlib.md5(repr(state)).hexdigest(), last_modified
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return super(ConditionalView, self).dispatch(request, *args, **kwargs)
+        etag, last_modified = self.get_validators(request)
+
+        not_modified = False
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        if if_none_match:
+            # Which takes precedence over If-Modified-Since
+            etags = parse_etags(if_none_match)
+            not_modified = etag is not None and (etag in etags or '*' in etags)
+        elif if_modified_since and last_modified is not None and self.last_modified_is_complete:
+            not_modified = last_modified <= if_modified_since
+
+        if not_modified:
+            response = HttpResponseNotModified()
+            patch_vary_headers(response, ('Accept',))
+        else:
+            response = super(ConditionalView, self).dispatch(request, *args, **kwargs)
+            if response.status_code != httplib.OK:
+                return response
+        if etag is not None:
+            response['ETag'] = quote_etag(etag)
+        if last_modified is not None:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
 
 class IndexView(HTMLView):
     def get(self, request):
@@ -85,14 +225,23 @@ class ErrorView(HTMLView, JSONPView, TextView):
         }
         return self.render(request, context, 'timeseries/error')
 
-class FetchView(JSONPView, TextView, TabularView):
+class SeriesView(ConditionalView, JSONPView, TextView, TabularView):
+    """
+    Finds the series and the range and resolution asked for, for the views
+    that fetch from them or summarise what they would fetch.
+    """
     _json_indent = 1
 
-    def get(self, request):
+    def get_fetch_arguments(self, request):
+        """
+        Returns the names of the series asked for and the arguments with
+        which to fetch from them, raising ValueError with a message for the
+        user if the query string doesn't provide them.
+        """
         try:
             series_names = set(request.GET['series'].split(','))
         except KeyError:
-            return EndpointView._error_view(request, 400, "You must supply a series parameter.")
+            raise ValueError("You must supply a series parameter.")
 
         fetch_arguments = {}
         try:
@@ -100,7 +249,7 @@ class FetchView(JSONPView, TextView, TabularView):
             if fetch_arguments['aggregation_type'] not in ('average', 'min', 'max'):
                 raise ValueError
         except (KeyError, ValueError):
-            return EndpointView._error_view(request, 400, "Missing required parameter 'type', which must be one of 'average', 'min', 'max'.")
+            raise ValueError("Missing required parameter 'type', which must be one of 'average', 'min', 'max'.")
 
         for argument, parameter in (('period_start', 'start'), ('period_end', 'end')):
             if parameter in request.GET:
@@ -112,18 +261,45 @@ class FetchView(JSONPView, TextView, TabularView):
                         timestamp = int(request.GET[parameter])
                         timestamp = datetime.datetime.utcfromtimestamp(timestamp)
                     except (OverflowError, ValueError):
-                        return EndpointView._error_view(request, 400, "%s should be a W3C-style ISO8601 datetime, or a Unix timestamp, which will be assumed to be UTC in the absence of any timezone information." % parameter)
+                        raise ValueError("%s should be a W3C-style ISO8601 datetime, or a Unix timestamp, which will be assumed to be UTC in the absence of any timezone information." % parameter)
                 if not timestamp.tzinfo:
                     timestamp = pytz.utc.localize(timestamp)
                 fetch_arguments[argument] = timestamp
         try:
             fetch_arguments['interval'] = int(request.GET['resolution'])
         except (KeyError, ValueError):
-            return EndpointView._error_view(request, 400, "resolution query parameter should be an integer number of seconds.")
+            raise ValueError("resolution query parameter should be an integer number of seconds.")
 
-        print fetch_arguments
+        return series_names, fetch_arguments
 
-        timeseries = TimeSeries.objects.filter(is_public=True, slug__in=series_names)
+    def get_validators(self, request):
+        try:
+            series_names, fetch_arguments = self.get_fetch_arguments(request)
+        except ValueError:
+            return None, None
+        timeseries, context = self.get_series(series_names)
+        for series in timeseries:
+            # Held-back readings are committed without _last changing
+            if series.is_virtual or series.config.get('reorder_window'):
+                return None, None
+        if 'period_start' in fetch_arguments and 'period_end' in fetch_arguments:
+            return self.get_series_validators(request, timeseries)
+        # The range is relative to now, so moves on with each interval
+        interval = fetch_arguments['interval']
+        now = int(time.time()) // interval * interval
+        etag, last_modified = self.get_series_validators(request, timeseries, now)
+        return etag, max(last_modified, now)
+
+    def get_series(self, series_names):
+        """
+        Returns the public series with the given names, and a context noting
+        any not found.
+        """
+        if getattr(self, '_series', None) is not None:
+            # Already found for get_validators()
+            timeseries = self._series
+        else:
+            timeseries = self._series = list(TimeSeries.objects.filter(is_public=True, slug__in=series_names))
         found_series = set(s.slug for s in timeseries)
         context = {
             'series': {}
@@ -132,47 +308,259 @@ class FetchView(JSONPView, TextView, TabularView):
         for series_name in series_names:
             if series_name not in found_series:
                 context['series'][series_name] = {'error': 'not-found'}
-
-        for series in timeseries:
+        return timeseries, context
+
+class FetchView(SeriesView):
+    # The number of samples to downsample to if no points parameter is given
+    default_points = None
+
+    def get_downsample_arguments(self, request):
+        """
+        Returns the points and method parameters with which to downsample
+        fetched samples, raising ValueError as get_fetch_arguments does.
+        """
+        downsample_arguments = {'points': self.default_points,
+                                'method': request.GET.get('method', 'lttb')}
+        if 'points' in request.GET:
             try:
-                result = series.fetch(**fetch_arguments)
-            except TimeSeriesException:
-                raise
-                context['series'][series.slug] = {'error': 'type-not-available'}
+                downsample_arguments['points'] = int(request.GET['points'])
+                if downsample_arguments['points'] < 2:
+                    raise ValueError
+            except ValueError:
+                raise ValueError("points query parameter should be an integer of at least two.")
+        if downsample_arguments['method'] not in ('lttb', 'minmax'):
+            raise ValueError("method query parameter should be one of 'lttb', 'minmax'.")
+        return downsample_arguments
+
+    def get(self, request):
+        try:
+            series_names, fetch_arguments = self.get_fetch_arguments(request)
+            fetch_arguments.update(self.get_downsample_arguments(request))
+        except ValueError, e:
+            return EndpointView._error_view(request, 400, e.args[0])
+        timeseries, context = self.get_series(series_names)
+
+        timeseries = list(timeseries)
+        results = TimeSeries.fetch_many(timeseries, **fetch_arguments)
+        for series, result in zip(timeseries, results):
+            if isinstance(result, SeriesNotFound):
+                # Its database has gone missing
+                context['series'][series.slug] = {'error': 'not-found'}
+                continue
+            elif isinstance(result, Exception):
+                logger.error("Failed to fetch from %r: %r", series.slug, result)
+                context['series'][series.slug] = {'error': 'fetch-failed'}
                 continue
+            # The fetched samples themselves, which the renderers below
+            # stream out without building a datum for each
             context['series'][series.slug] = {
                 'name': series.slug,
-                'data': [{'ts': ts, 'val': val if val == val else None} for ts, val in result],
+                'data': result,
             }
 
         return self.render(request, context, 'timeseries/fetch')
 
+    # The number of samples rendered into each chunk of a response
+    _chunk_size = 1000
+
+    def _chunks(self, result, format_sample):
+        timestamps, values = iter(result.timestamps()), iter(result.values)
+        while True:
+            chunk = ''.join(itertools.imap(format_sample, itertools.islice(timestamps, self._chunk_size),
+                                           itertools.islice(values, self._chunk_size)))
+            if not chunk:
+                break
+            yield chunk
+
+    def _spool_json(self, context):
+        def format_sample(timestamp, val):
+            # NaN, not being equal to itself, has no JSON representation
+            if val != val or val in (_inf, -_inf):
+                return '{"ts": %d, "val": null}, ' % (timestamp * 1000)
+            return '{"ts": %d, "val": %r}, ' % (timestamp * 1000, val)
+        yield '{"series": {'
+        for i, (name, series) in enumerate(context['series'].iteritems()):
+            yield '%s%s: ' % (', ' if i else '', json.dumps(name))
+            if 'data' not in series:
+                yield json.dumps(series)
+                continue
+            yield '{"name": %s, "data": [' % json.dumps(series['name'])
+            last = ''
+            for chunk in self._chunks(series['data'], format_sample):
+                yield last
+                last = chunk
+            # Without the trailing separator
+            yield last[:-2] + ']}'
+        yield '}}'
+
+    @renderer(format='json', mimetypes=('application/json',), name='JSON')
+    def render_json(self, request, context, template_name):
+        if self._default_jsonp_callback_parameter in request.GET:
+            return self.render_js(request, context, template_name)
+        return StreamingHttpResponse(self._spool_json(context), content_type='application/json')
+
+    @renderer(format='js', mimetypes=('text/javascript', 'application/javascript'), name='JavaScript (JSONP)')
+    def render_js(self, request, context, template_name):
+        callback_name = request.GET.get(self._default_jsonp_callback_parameter, self._default_jsonp_callback)
+        content = itertools.chain(['%s(' % callback_name], self._spool_json(context), [');'])
+        return StreamingHttpResponse(content, content_type='application/javascript')
+
+    @renderer(format='txt', mimetypes=('text/plain',), priority=1, name='Plain text')
+    def render_text(self, request, context, template_name):
+        def spool():
+            for name, series in context['series'].iteritems():
+                if 'data' not in series:
+                    continue
+                # As the date filter would show them
+                if settings.USE_TZ:
+                    tz = timezone.get_current_timezone()
+                else:
+                    tz = pytz.timezone(series['data'].timezone_name)
+                def format_sample(timestamp, val):
+                    ts = _from_timestamp(timestamp).astimezone(tz)
+                    return '%s,%s,%s\n' % (name, ts.isoformat(), unicode(val) if val == val else '')
+                for chunk in self._chunks(series['data'], format_sample):
+                    yield chunk
+        return StreamingHttpResponse(spool(), content_type='text/plain')
+
+    # Name length, value typecode, whether indices follow, start, step and count
+    _binary_header = struct.Struct('<HcBqLL')
+
+    @renderer(format='bin', mimetypes=('application/octet-stream',), name='Packed binary')
+    def render_bin(self, request, context, template_name):
+        """
+        Each series found, as a little-endian header of the length of its
+        name, the typecode of its values ('f' for float32, 'd' for float64),
+        whether indices follow, and its first timestamp, step and number of
+        samples; then its name in UTF-8 and its values, packed as they were
+        read from the database. Downsampled samples are followed by the
+        uint32 index of each, counting steps from the first timestamp.
+        """
+        def spool():
+            for name, series in context['series'].iteritems():
+                if 'data' not in series:
+                    continue
+                result, name = series['data'], name.encode('utf-8')
+                indices = getattr(result, 'indices', None)
+                yield self._binary_header.pack(len(name), result.values.typecode, indices is not None,
+                                               result.start, result.step, len(result.values)) + name
+                yield _little_endian(result.values)
+                if indices is not None:
+                    yield _little_endian(array.array('I', indices))
+        return StreamingHttpResponse(spool(), content_type='application/octet-stream')
+
+    @renderer(format='npy', mimetypes=('application/x-npy',), name='NumPy array')
+    def render_npy(self, request, context, template_name):
+        """
+        The values of the one series asked for as a NumPy array, with its
+        first timestamp and step in X-Timeseries-Start and -Step headers.
+        Downsampled samples aren't evenly spaced, so need render_npz().
+        """
+        found = [series['data'] for series in context['series'].itervalues() if 'data' in series]
+        if len(found) != 1 or getattr(found[0], 'indices', None) is not None:
+            return NotImplemented
+        result = found[0]
+        def spool():
+            yield _npy(_npy_descrs[result.values.typecode], len(result.values), '')
+            yield _little_endian(result.values)
+        response = StreamingHttpResponse(spool(), content_type='application/x-npy')
+        response['X-Timeseries-Start'] = str(result.start)
+        response['X-Timeseries-Step'] = str(result.step)
+        return response
+
+    @renderer(format='npz', mimetypes=('application/x-npz',), name='NumPy arrays (zipped)')
+    def render_npz(self, request, context, template_name):
+        """
+        Each series found as a NumPy array of its values, named by its slug,
+        and an int64 array of their timestamps, named by its slug and '.ts',
+        in an uncompressed .npz archive streamed out a series at a time.
+        """
+        def spool():
+            archive = _Spool()
+            with contextlib.closing(zipfile.ZipFile(archive, 'w', zipfile.ZIP_STORED)) as npz:
+                for name, series in context['series'].iteritems():
+                    if 'data' not in series:
+                        continue
+                    result, name = series['data'], name.encode('utf-8')
+                    count = len(result.values)
+                    npz.writestr(name + '.npy', _npy(_npy_descrs[result.values.typecode], count,
+                                                     _little_endian(result.values)))
+                    npz.writestr(name + '.ts.npy', _npy('<i8', count,
+                                                        struct.pack('<%dq' % count, *result.timestamps())))
+                    yield archive.take()
+            yield archive.take()
+        return StreamingHttpResponse(spool(), content_type='application/x-npz')
+
     def get_table(self, request, context):
         for series in context['series']:
-            name, data = series, context['series'][series].get('data', [])
-            for datum in data:
+            name, data = series, context['series'][series].get('data', ())
+            for ts, val in data:
                 # val may be NaN, which is not equal to itself. math.isnan()
                 # is only available in >=Py2.6, so use this (somewhat weird-
                 # looking) test.
-                val = datum['val']
                 val = str(val) if val == val else ''
-                yield (name, datum['ts'].strftime('%Y-%m-%d %H:%M:%S'), val)
+                yield (name, ts.strftime('%Y-%m-%d %H:%M:%S'), val)
 
-class InfoView(HTMLView, JSONPView, RDFView):
-    _json_indent = 2
-
-    series_types = {'period': 'gauge', 'gauge': 'rate', 'counter': 'gauge', 'absolute': 'cumulative'}
+class AggregateView(SeriesView):
+    """
+    Summarises the samples that fetch would return, without returning them.
+    """
+    statistics = ('count', 'sum', 'mean', 'min', 'max')
 
     def get(self, request):
         try:
+            series_names, fetch_arguments = self.get_fetch_arguments(request)
+        except ValueError, e:
+            return EndpointView._error_view(request, 400, e.args[0])
+        timeseries, context = self.get_series(series_names)
+
+        for series in timeseries:
+            result = series.aggregate(**fetch_arguments)
+            context['series'][series.slug] = {'name': series.slug}
+            for statistic in self.statistics:
+                value = result[statistic]
+                context['series'][series.slug][statistic] = value if value == value else None
+
+        return self.render(request, context, 'timeseries/aggregate')
+
+    def get_table(self, request, context):
+        for name, series in context['series'].iteritems():
+            if 'error' not in series:
+                yield (name,) + tuple('' if series[statistic] is None else str(series[statistic])
+                                      for statistic in self.statistics)
+
+class InfoView(ConditionalView, HTMLView, JSONPView, RDFView):
+    _json_indent = 2
+
+    # Titles, notes and configuration can change without _last changing
+    last_modified_is_complete = False
+
+    # Counters are stored as their rate of increase, and period readings as
+    # amounts per interval (what RRDtool calls an "absolute" data source).
+    series_types = {'period': 'absolute', 'gauge': 'gauge', 'counter': 'counter'}
+
+    def get_series(self, request):
+        """
+        Returns the public series named in the series parameter, or all of
+        them for '*', raising KeyError if there isn't one.
+        """
+        if getattr(self, '_series', None) is None:
             series_names = request.GET['series']
             series = TimeSeries.objects.filter(is_public=True)
-            missing = []
             if series_names != '*':
-                series_names = set(series_names.split(','))
-                series = series.filter(slug__in=series_names)
-                found_names = set(s.slug for s in series)
-                missing_names = series_names - found_names
+                series = series.filter(slug__in=set(series_names.split(',')))
+            self._series = list(series)
+        return self._series
+
+    def get_validators(self, request):
+        try:
+            return self.get_series_validators(request, self.get_series(request))
+        except KeyError:
+            return None, None
+
+    def get(self, request):
+        try:
+            series = self.get_series(request)
         except KeyError:
             return EndpointView._error_view(request, 400, "You must supply a series parameter.")
 
@@ -224,18 +612,28 @@ class InfoView(HTMLView, JSONPView, RDFView):
     def preprocess_context_for_json(self, context):
         return {'series': context['series']}
 
-class GraphView(HTMLView, JSONPView):
+class GraphView(FetchView):
+    """
+    Fetches samples downsampled for drawing, by default to about as many as
+    there are pixels across a typical graph.
+    """
+    default_points = 800
+
+class ListView(ConditionalView, HTMLView, JSONPView, TabularView):
     _json_indent = 2
 
-    def get(self, request):
-        #return self.render(request, {}, 'timeseries/graph')
-        return EndpointView._error_view(request, 501, 'Not yet implemented')
+    last_modified_is_complete = False
 
-class ListView(HTMLView, JSONPView, TabularView):
-    _json_indent = 2
+    def get_series(self):
+        if getattr(self, '_series', None) is None:
+            self._series = list(TimeSeries.objects.filter(is_public=True))
+        return self._series
+
+    def get_validators(self, request):
+        return self.get_series_validators(request, self.get_series())
 
     def get(self, request):
-        series = TimeSeries.objects.filter(is_public=True)
+        series = self.get_series()
         context = {
             'series': series,
             'names': [s.slug for s in series],
@@ -254,6 +652,7 @@ class EndpointView(ContentNegotiatedView):
     _error_view = staticmethod(ErrorView.as_view())
 
     _views_by_action = {'fetch': FetchView.as_view(),
+                        'aggregate': AggregateView.as_view(),
                         'info': InfoView.as_view(),
                         'graph': GraphView.as_view(),
                         'list': ListView.as_view()}